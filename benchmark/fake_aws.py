@@ -0,0 +1,518 @@
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+from botocore.exceptions import ClientError
+
+# In-memory stand-ins for the EC2, SSM, CloudWatch, SNS and SQS clients used by the lambda functions.
+# Only the operations and fields the functions read are implemented. Time is virtual, every fake api
+# call and every command takes its latency on a clock that runs `speedup` times faster than real time.
+
+
+class VirtualClock:
+
+    def __init__(self, speedup=50.0):
+        self.speedup = float(speedup)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.slept = 0.0
+
+    def time(self):
+        return self.started + (time.time() - self.started)*self.speedup
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.time(), datetime.timezone.utc)
+
+    def sleep(self, seconds):
+        # Used in place of time.sleep by the functions, counted as time spent sleeping.
+        with self.lock:
+            self.slept += seconds
+        self.pause(seconds)
+
+    def pause(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds/self.speedup)
+
+
+class FakeContext:
+
+    def __init__(self, clock, timeout=900):
+        self.clock = clock
+        self.deadline = clock.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - self.clock.time())*1000)
+
+
+def client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def new_volume_id(rng):
+    return 'vol-' + ''.join(rng.choice('0123456789abcdef') for _ in range(17))
+
+
+def build_fleet(size, windows_ratio=0.2, nvme_ratio=0.7, max_disks=3, offline_ratio=0.0, seed=1, first_id=1, hot_ratio=0.0):
+    # Mixed linux (nvme or xen) and windows instances with one root disk and up to max_disks-1 data disks.
+    # A hot_ratio share of the volumes is tagged for high resolution monitoring.
+    rng = random.Random(seed)
+    instances = []
+    for i in range(size):
+        instance = {
+            'InstanceId': 'i-%017x' % (first_id + i),
+            'Platform': 'windows' if rng.random() < windows_ratio else None,
+            'Online': rng.random() >= offline_ratio,
+            'Tags': {},
+            'Disks': []
+        }
+        nvme = rng.random() < nvme_ratio
+        for n in range(rng.randint(1, max_disks)):
+            disk = {'VolumeId': new_volume_id(rng), 'Size': rng.choice([8, 20, 50, 100, 500]), 'VolumeType': rng.choice(['gp2', 'gp3', 'gp3', 'io1'])}
+            disk['Iops'] = {'gp2': max(100, 3*disk['Size']), 'gp3': rng.choice([3000, 6000]), 'io1': 50*disk['Size']}[disk['VolumeType']]
+            if disk['VolumeType'] == 'gp3':
+                disk['Throughput'] = rng.choice([125, 250])
+            disk['Tags'] = {'ebs-scale-up:monitoring': 'high-resolution'} if hot_ratio and rng.random() < hot_ratio else {}
+            if instance['Platform'] == 'windows':
+                disk.update(drive='CDEFGH'[n], disk_number=n, device_name='/dev/sda1' if n == 0 else '/dev/xvd' + 'bcdefg'[n])
+            elif nvme:
+                disk.update(disk='nvme%dn1' % n, partition='1' if n == 0 else '', fstype='xfs' if n == 0 else rng.choice(['xfs', 'ext4']),
+                            mountpoint='/' if n == 0 else '/data%d' % n, device_name='/dev/xvda' if n == 0 else '/dev/sd' + 'fghijk'[n])
+            else:
+                disk.update(disk='xvda' if n == 0 else 'xvd' + 'fghijk'[n], partition='1' if n == 0 else '',
+                            fstype='ext4' if n == 0 else rng.choice(['xfs', 'ext4']), mountpoint='/' if n == 0 else '/data%d' % n,
+                            device_name='/dev/sda1' if n == 0 else '/dev/sd' + 'fghijk'[n])
+            instance['Disks'].append(disk)
+        instances.append(instance)
+    return instances
+
+
+class FakeService:
+
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.clock = backend.clock
+
+    def _call(self, operation):
+        backend = self.backend
+        backend.count(self.name, operation)
+        self.clock.pause(backend.rng_uniform(0.5, 1.5)*backend.api_latency)
+        if backend.throttle_rate and backend.rng_random() < backend.throttle_rate:
+            backend.count(self.name, operation + ':Throttled')
+            raise client_error('ThrottlingException', 'Rate exceeded', operation)
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+
+class FakePaginator:
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        if PaginationConfig and 'PageSize' in PaginationConfig:
+            kwargs['MaxResults'] = PaginationConfig['PageSize']
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+
+def page_of(items, kwargs, default_size):
+    start = int(kwargs.get('NextToken') or 0)
+    size = kwargs.get('MaxResults') or default_size
+    end = start + size
+    return items[start:end], (str(end) if end < len(items) else None)
+
+
+class FakeEC2(FakeService):
+
+    def __init__(self, backend):
+        super().__init__('ec2', backend)
+
+    def describe_instances(self, InstanceIds=None, Filters=(), **kwargs):
+        self._call('DescribeInstances')
+        backend = self.backend
+        instances = [backend.instances[i] for i in InstanceIds if i in backend.instances] if InstanceIds else list(backend.instances.values())
+        for f in Filters:
+            values = f['Values']
+            if f['Name'] == 'instance-state-name':
+                instances = [i for i in instances if 'running' in values]
+            elif f['Name'] == 'instance-id':
+                instances = [i for i in instances if i['InstanceId'] in values]
+            elif f['Name'] == 'platform':
+                instances = [i for i in instances if i['Platform'] in values]
+            elif f['Name'].startswith('tag:'):
+                instances = [i for i in instances if i['Tags'].get(f['Name'][4:]) in values]
+        items, token = page_of(instances, kwargs, 1000)
+        page = {'Reservations': [{'Instances': [backend.describe_instance(i) for i in items]}]}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def describe_instance_attribute(self, Attribute, InstanceId):
+        self._call('DescribeInstanceAttribute')
+        return {'BlockDeviceMappings': self.backend.block_device_mappings(self.backend.instances[InstanceId])}
+
+    def create_tags(self, Resources, Tags):
+        self._call('CreateTags')
+        with self.backend.lock:
+            for instance_id in Resources:
+                self.backend.instances[instance_id]['Tags'].update({tag['Key']: tag['Value'] for tag in Tags})
+        return {}
+
+    def describe_volumes(self, VolumeIds=(), Filters=(), **kwargs):
+        # Besides volume ids only the tag-key filter is supported.
+        self._call('DescribeVolumes')
+        volumes = []
+        if not VolumeIds:
+            keys = [value for f in Filters if f['Name'] == 'tag-key' for value in f['Values']]
+            VolumeIds = sorted(volume_id for volume_id, (_, disk) in self.backend.volumes.items() if any(key in disk['Tags'] for key in keys))
+        for volume_id in VolumeIds:
+            if volume_id not in self.backend.volumes:
+                raise client_error('InvalidVolume.NotFound', "The volume '" + volume_id + "' does not exist.", 'DescribeVolumes')
+            instance, disk = self.backend.volumes[volume_id]
+            volumes.append({
+                'VolumeId': volume_id,
+                'Size': disk['Size'],
+                'VolumeType': disk['VolumeType'],
+                'Iops': disk['Iops'],
+                'Throughput': disk.get('Throughput'),
+                'Tags': [{'Key': key, 'Value': value} for key, value in disk['Tags'].items()],
+                'Attachments': [{'InstanceId': instance['InstanceId'], 'State': 'attached', 'Device': disk['device_name']}]
+            })
+        items, token = page_of(volumes, kwargs, 500)
+        page = {'Volumes': items}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def modify_volume(self, VolumeId, Size=None, VolumeType=None, Iops=None, Throughput=None, **kwargs):
+        self._call('ModifyVolume')
+        backend = self.backend
+        latency = backend.modify_latency*backend.rng_uniform(0.5, 1.5)
+        with backend.lock:
+            if VolumeId not in backend.volumes:
+                raise client_error('InvalidVolume.NotFound', "The volume '" + VolumeId + "' does not exist.", 'ModifyVolume')
+            latest = backend.modifications.get(VolumeId)
+            if latest and self.clock.time() - latest['StartTime'].timestamp() < 6*3600:
+                raise client_error('VolumeModificationRateExceeded', 'You have reached the maximum modification rate per volume limit.', 'ModifyVolume')
+            disk = backend.volumes[VolumeId][1]
+            backend.modifications[VolumeId] = {
+                'VolumeId': VolumeId,
+                'OriginalSize': disk['Size'],
+                'TargetSize': Size or disk['Size'],
+                'StartTime': self.clock.now(),
+                'OptimizingAt': self.clock.time() + latency
+            }
+            disk['Size'] = Size or disk['Size']
+            disk['VolumeType'] = VolumeType or disk['VolumeType']
+            disk['Iops'] = Iops or disk['Iops']
+            disk['Throughput'] = Throughput or disk.get('Throughput')
+        return {'VolumeModification': {'VolumeId': VolumeId, 'ModificationState': 'modifying'}}
+
+    def describe_volumes_modifications(self, VolumeIds=(), Filters=(), **kwargs):
+        self._call('DescribeVolumesModifications')
+        volume_ids = list(VolumeIds)
+        for f in Filters:
+            if f['Name'] == 'volume-id':
+                volume_ids.extend(f['Values'])
+        modifications = []
+        for volume_id in volume_ids:
+            modification = self.backend.modifications.get(volume_id)
+            if modification is None:
+                continue
+            state = 'optimizing' if self.clock.time() >= modification['OptimizingAt'] else 'modifying'
+            modifications.append(dict(
+                {key: value for key, value in modification.items() if key != 'OptimizingAt'},
+                ModificationState=state
+            ))
+        items, token = page_of(modifications, kwargs, 500)
+        page = {'VolumesModifications': items}
+        if token:
+            page['NextToken'] = token
+        return page
+
+
+class FakeSSM(FakeService):
+
+    def __init__(self, backend):
+        super().__init__('ssm', backend)
+        self.commands = {}
+        self.parameters = {}
+
+    def describe_instance_information(self, Filters=(), **kwargs):
+        self._call('DescribeInstanceInformation')
+        instances = list(self.backend.instances.values())
+        for f in Filters:
+            if f['Key'] == 'InstanceIds':
+                instances = [self.backend.instances[i] for i in f['Values'] if i in self.backend.instances]
+            elif f['Key'] == 'PingStatus':
+                instances = [i for i in instances if i['Online']]
+        items, token = page_of(instances, kwargs, 50)
+        page = {'InstanceInformationList': [{'InstanceId': i['InstanceId'], 'PingStatus': 'Online'} for i in items]}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def send_command(self, InstanceIds, DocumentName, Parameters, **kwargs):
+        self._call('SendCommand')
+        backend = self.backend
+        for instance_id in InstanceIds:
+            if instance_id not in backend.instances or not backend.instances[instance_id]['Online']:
+                raise client_error('InvalidInstanceId', 'Instances not in a valid state for account', 'SendCommand')
+        command_id = str(uuid.uuid4())
+        invocations = collections.OrderedDict()
+        for instance_id in InstanceIds:
+            instance = backend.instances[instance_id]
+            failed = backend.rng_random() < backend.failure_rate
+            invocations[instance_id] = {
+                'InstanceId': instance_id,
+                'DoneAt': self.clock.time() + backend.command_latency*backend.rng_uniform(0.5, 1.5),
+                'Status': 'Failed' if failed else 'Success',
+                'Output': '' if failed else backend.command_output(instance, DocumentName, Parameters)
+            }
+            if DocumentName == 'CloudWatchAgent' and not failed:
+                instance['AgentConfig'] = Parameters['configurationLocation'][0]
+        with backend.lock:
+            self.commands[command_id] = invocations
+        return {'Command': {'CommandId': command_id, 'DocumentName': DocumentName}}
+
+    def list_command_invocations(self, CommandId, InstanceId=None, Details=False, **kwargs):
+        self._call('ListCommandInvocations')
+        invocations = self.commands[CommandId]
+        if InstanceId:
+            invocations = {InstanceId: invocations[InstanceId]}
+        items, token = page_of(list(invocations.values()), kwargs, 50)
+        page = {'CommandInvocations': [self._invocation(invocation, Details) for invocation in items]}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def get_command_invocation(self, CommandId, InstanceId, **kwargs):
+        self._call('GetCommandInvocation')
+        invocation = self._invocation(self.commands[CommandId][InstanceId], True)
+        return {'Status': invocation['Status'], 'StandardOutputContent': invocation['CommandPlugins'][0]['Output']}
+
+    def _invocation(self, invocation, details):
+        done = self.clock.time() >= invocation['DoneAt']
+        status = invocation['Status'] if done else 'InProgress'
+        result = {'InstanceId': invocation['InstanceId'], 'Status': status, 'StatusDetails': status}
+        if details:
+            output = invocation['Output'] if done else ''
+            result['CommandPlugins'] = [{'Name': 'aws:runShellScript', 'Output': output[:2500]}]
+        return result
+
+    def get_parameter(self, Name, **kwargs):
+        self._call('GetParameter')
+        if Name not in self.parameters:
+            raise client_error('ParameterNotFound', 'Parameter ' + Name + ' not found.', 'GetParameter')
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+    def get_parameters_by_path(self, Path, Recursive=False, **kwargs):
+        self._call('GetParametersByPath')
+        names = sorted(name for name in self.parameters if name.startswith(Path.rstrip('/') + '/'))
+        if not Recursive:
+            names = [name for name in names if '/' not in name[len(Path.rstrip('/')) + 1:]]
+        items, token = page_of(names, kwargs, 10)
+        page = {'Parameters': [{'Name': name, 'Value': self.parameters[name]} for name in items]}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def put_parameter(self, Name, Value, Overwrite=False, **kwargs):
+        self._call('PutParameter')
+        with self.backend.lock:
+            if Name in self.parameters and not Overwrite:
+                raise client_error('ParameterAlreadyExists', 'The parameter already exists.', 'PutParameter')
+            self.parameters[Name] = Value
+        return {'Version': 1}
+
+
+class FakeCloudWatch(FakeService):
+
+    def __init__(self, backend):
+        super().__init__('cloudwatch', backend)
+        self.alarms = {}
+
+    def describe_alarms(self, AlarmNamePrefix='', AlarmTypes=(), **kwargs):
+        self._call('DescribeAlarms')
+        alarms = [self.alarms[name] for name in sorted(self.alarms) if name.startswith(AlarmNamePrefix)]
+        items, token = page_of(alarms, kwargs, 100)
+        page = {'MetricAlarms': items}
+        if token:
+            page['NextToken'] = token
+        return page
+
+    def put_metric_alarm(self, **kwargs):
+        self._call('PutMetricAlarm')
+        with self.backend.lock:
+            self.alarms[kwargs['AlarmName']] = dict(kwargs, Threshold=float(kwargs['Threshold']))
+        return {}
+
+    def delete_alarms(self, AlarmNames):
+        self._call('DeleteAlarms')
+        with self.backend.lock:
+            for name in AlarmNames:
+                self.alarms.pop(name, None)
+        return {}
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        # Utilisation grows linearly from 70% to 92% over the requested window, one sample every period.
+        self._call('GetMetricData')
+        results = []
+        for query in MetricDataQueries:
+            period = query['MetricStat']['Period']
+            count = max(1, int((EndTime - StartTime).total_seconds()//period))
+            timestamps = [StartTime + datetime.timedelta(seconds=period*(n + 1)) for n in range(count)]
+            used = [70 + 22.0*(n + 1)/count for n in range(count)]
+            if query['MetricStat']['Metric']['MetricName'] == 'LogicalDisk % Free Space':
+                used = [100 - value for value in used]
+            results.append({'Id': query['Id'], 'Timestamps': timestamps[::-1], 'Values': used[::-1], 'StatusCode': 'Complete'})
+        return {'MetricDataResults': results}
+
+
+class FakeSNS(FakeService):
+
+    def __init__(self, backend):
+        super().__init__('sns', backend)
+
+    def publish(self, TopicArn, Message, **kwargs):
+        self._call('Publish')
+        return {'MessageId': str(uuid.uuid4())}
+
+
+class FakeSQS(FakeService):
+
+    def __init__(self, backend):
+        super().__init__('sqs', backend)
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0, **kwargs):
+        self._call('SendMessage')
+        with self.backend.lock:
+            self.messages.append({'Body': MessageBody, 'VisibleAt': self.clock.time() + DelaySeconds})
+        return {'MessageId': str(uuid.uuid4())}
+
+
+class FakeAWS:
+    # One simulated account shared by all fake clients.
+
+    def __init__(self, fleet, clock, api_latency=0.05, command_latency=3.0, modify_latency=20.0,
+                 failure_rate=0.0, throttle_rate=0.0, seed=1):
+        self.clock = clock
+        self.api_latency = api_latency
+        self.command_latency = command_latency
+        self.modify_latency = modify_latency
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.calls = collections.Counter()
+        self.instances = collections.OrderedDict((instance['InstanceId'], instance) for instance in fleet)
+        self.volumes = {disk['VolumeId']: (instance, disk) for instance in fleet for disk in instance['Disks']}
+        self.modifications = {}
+        self.clients = {
+            'ec2': FakeEC2(self),
+            'ssm': FakeSSM(self),
+            'cloudwatch': FakeCloudWatch(self),
+            'sns': FakeSNS(self),
+            'sqs': FakeSQS(self)
+        }
+
+    def client(self, service_name, *args, **kwargs):
+        # Drop-in replacement for boto3.client.
+        return self.clients[service_name]
+
+    def count(self, service, operation):
+        with self.lock:
+            self.calls[service + ':' + operation] += 1
+
+    def rng_random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def rng_uniform(self, a, b):
+        with self.lock:
+            return self.rng.uniform(a, b)
+
+    def describe_instance(self, instance):
+        description = {
+            'InstanceId': instance['InstanceId'],
+            'State': {'Name': 'running'},
+            'Tags': [{'Key': key, 'Value': value} for key, value in instance['Tags'].items()],
+            'BlockDeviceMappings': self.block_device_mappings(instance)
+        }
+        if instance['Platform']:
+            description['Platform'] = instance['Platform']
+        return description
+
+    def block_device_mappings(self, instance):
+        return [{'DeviceName': disk['device_name'], 'Ebs': {'VolumeId': disk['VolumeId'], 'Status': 'attached'}} for disk in instance['Disks']]
+
+    def command_output(self, instance, document, parameters):
+        script = '\n'.join(parameters.get('commands', []))
+        if 'lsblk -J' in script:
+            return json.dumps({'blockdevices': [self.lsblk_device(disk) for disk in instance['Disks']]})
+        if 'ConvertTo-Json' in script:
+            return json.dumps([{
+                'DriveLetter': disk['drive'],
+                'DiskNumber': disk['disk_number'],
+                'PartitionNumber': 2 if disk['disk_number'] == 0 else 1,
+                'SerialNumber': disk['VolumeId'].replace('-', '') + '_00000001.',
+                'FileSystem': 'NTFS'
+            } for disk in instance['Disks']])
+        if 'lsblk -o NAME,SERIAL' in script or 'get-partition -DriveLetter' in script:
+            # Volume id lookup of a single disk by scale-ebs.
+            for disk in instance['Disks']:
+                if ('-DriveLetter ' + str(disk.get('drive')) + ' ') in script or ("'" + str(disk.get('disk')) + "'") in script:
+                    return disk['VolumeId'].replace('-', '') + '\n'
+            return ''
+        return ''
+
+    def lsblk_device(self, disk):
+        nvme = disk['disk'].startswith('nvme')
+        device = {'name': disk['disk'], 'pkname': None, 'type': 'disk', 'fstype': None, 'mountpoint': None,
+                  'serial': disk['VolumeId'].replace('-', '') if nvme else None}
+        if disk['partition']:
+            device['children'] = [{
+                'name': disk['disk'] + ('p' if nvme else '') + disk['partition'], 'pkname': disk['disk'], 'type': 'part',
+                'fstype': disk['fstype'], 'mountpoint': disk['mountpoint'], 'serial': None
+            }]
+        else:
+            device.update(fstype=disk['fstype'], mountpoint=disk['mountpoint'])
+        return device
+
+    def api_calls(self):
+        # {service: {operation: count}}
+        services = {}
+        with self.lock:
+            for key, count in self.calls.items():
+                service, operation = key.split(':', 1)
+                services.setdefault(service, {})[operation] = count
+        return services
+
+
+class FakeEstate:
+    # Several simulated regions, boto3.client is answered by the region named in region_name.
+
+    def __init__(self, regions):
+        self.regions = regions
+        self.default = next(iter(regions.values()))
+
+    def client(self, service_name, *args, **kwargs):
+        return self.regions.get(kwargs.get('region_name'), self.default).client(service_name)
+
+    def api_calls(self):
+        services = {}
+        for aws in self.regions.values():
+            for service, operations in aws.api_calls().items():
+                for operation, count in operations.items():
+                    services.setdefault(service, {})[operation] = services.get(service, {}).get(operation, 0) + count
+        return services
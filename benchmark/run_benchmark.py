@@ -0,0 +1,242 @@
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+import boto3
+from fake_aws import VirtualClock, FakeContext, FakeAWS, FakeEstate, build_fleet
+
+# Runs create-metric-alarm-function and scale-ebs-function against a simulated fleet and reports
+# wall clock time (virtual and real), api calls per service, ssm polls and time spent sleeping.
+#
+#   $ python benchmark/run_benchmark.py --fleet-sizes 10,100,1000 --json results.json
+#   $ python benchmark/run_benchmark.py --fleet-sizes 10,100,1000 --baseline results.json
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+
+
+def load_function(file_name, clock, env):
+    # boto3.client is replaced by run_fleet, the functions create their clients on first use.
+    os.environ.update(env)
+    import ssm_command
+    spec = importlib.util.spec_from_file_location(file_name.replace('-', '_')[:-3], os.path.join(LAMBDA_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    ssm_command.time = clock
+    if hasattr(module, 'time'):
+        module.time = clock
+    return module
+
+
+def alarm_message(alarm, clock):
+    return {
+        'AlarmName': alarm['AlarmName'],
+        'AlarmDescription': alarm.get('AlarmDescription', ''),
+        'NewStateValue': 'ALARM',
+        'StateChangeTime': clock.now().isoformat(),
+        'Trigger': {
+            'Namespace': alarm['Namespace'],
+            'MetricName': alarm['MetricName'],
+            'Dimensions': [{'name': dimension['Name'], 'value': dimension['Value']} for dimension in alarm['Dimensions']]
+        }
+    }
+
+
+def measure(name, fleet_size, aws, clock, run):
+    calls_before = aws.api_calls()
+    slept_before = clock.slept
+    virtual_start = clock.time()
+    real_start = time.time()
+    output = run()
+    calls = aws.api_calls()
+    for service, operations in calls_before.items():
+        for operation, count in operations.items():
+            calls[service][operation] -= count
+    return {
+        'Scenario': name,
+        'FleetSize': fleet_size,
+        'VirtualSeconds': round(clock.time() - virtual_start, 1),
+        'RealSeconds': round(time.time() - real_start, 2),
+        'SleepSeconds': round(clock.slept - slept_before, 1),
+        'ApiCalls': {service: sum(operations.values()) for service, operations in calls.items() if sum(operations.values())},
+        'Operations': {service + ':' + operation: count for service, operations in calls.items() for operation, count in operations.items() if count},
+        'Output': output
+    }
+
+
+def run_fleet(args, fleet_size):
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    import aws_clients
+    client = boto3.client
+    aws_clients.clear()
+    try:
+        return run_scenarios(args, fleet_size)
+    finally:
+        boto3.client = client
+        aws_clients.clear()
+
+
+def run_scenarios(args, fleet_size):
+    # Every region holds a fleet of fleet_size instances, the scale scenarios run in the first one.
+    clock = VirtualClock(args.speedup)
+    regions = {}
+    for i, region in enumerate(args.regions):
+        fleet = build_fleet(fleet_size, args.windows_ratio, args.nvme_ratio, args.max_disks, args.offline_ratio, args.seed + i, i*fleet_size + 1, args.hot_ratio if args.high_resolution else 0.0)
+        regions[region] = FakeAWS(fleet, clock, args.api_latency, args.command_latency, args.modify_latency, args.failure_rate, args.throttle_rate, args.seed + i)
+        with open(os.path.join(LAMBDA_DIR, '..', 'ssm', 'cloudwatch-config-linux.json')) as f:
+            regions[region].clients['ssm'].parameters['/CWAgent/Linux/Disk'] = f.read()
+        with open(os.path.join(LAMBDA_DIR, '..', 'ssm', 'cloudwatch-config-windows.json')) as f:
+            regions[region].clients['ssm'].parameters['/CWAgent/Windows/Disk'] = f.read()
+    estate = FakeEstate(regions)
+    aws = estate.default
+    boto3.client = estate.client
+    targets = [{'Region': region} for region in args.regions] if len(args.regions) > 1 else None
+    results = []
+
+    if 'onboard' in args.scenarios:
+        create = load_function('create-alarm.py', clock, {
+            'THRESHOLD_UTILISATION': '80',
+            'UTIL_EXCEEDED_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:123456789012:ebs-utilisation-exceeded-topic',
+            'ONBOARDING_CONCURRENCY': str(args.concurrency),
+            'IO_ALARMS': 'yes' if args.io_alarms else 'no',
+            'HIGH_RESOLUTION_MONITORING': 'yes' if args.high_resolution else 'no'
+        })
+        def onboard(incremental=False):
+            request = {'InstanceIds': '*', 'Incremental': incremental}
+            if targets:
+                request['Targets'] = targets
+            response = create.lambda_handler(request, FakeContext(clock))
+            return {'Summary': response['Summary'], 'Commands': response['Commands']}
+        results.append(measure('onboard', fleet_size, estate, clock, onboard))
+        # A second sweep of the unchanged fleet, in full and incremental.
+        results.append(measure('resweep', fleet_size, estate, clock, onboard))
+        results.append(measure('delta', fleet_size, estate, clock, lambda: onboard(True)))
+
+    if 'scale' in args.scenarios:
+        scale = load_function('scale-ebs.py', clock, {
+            'ENABLE_SNS': 'no',
+            'SNS_NOTIFICATION_TOPIC_ARN': '',
+            'DESIRED_UTILISATION': '60',
+            'THRESHOLD_UTILISATION': '80',
+            'SIZING_MODE': args.sizing_mode
+        })
+        alarms = sorted(aws.clients['cloudwatch'].alarms.values(), key=lambda alarm: alarm['AlarmName'])
+        if not alarms:
+            print('No alarms to trigger, run the onboard scenario as well.')
+            return results
+        alarms = alarms[:args.scale_events]
+        def scale_all():
+            for alarm in alarms:
+                scale.lambda_handler({'Records': [{'Sns': {'Message': json.dumps(alarm_message(alarm, clock))}}]}, FakeContext(clock))
+            modified = sum(1 for alarm in alarms if json.loads(alarm.get('AlarmDescription') or '{}').get('VolumeId') in aws.modifications)
+            return {'Events': len(alarms), 'ModifiedVolumes': len(aws.modifications), 'ModifiedFromDescription': modified}
+        results.append(measure('scale', fleet_size, aws, clock, scale_all))
+        # The same alarms fire again while their volumes are in the modification cooldown.
+        results.append(measure('rescale', fleet_size, aws, clock, scale_all))
+    
+    if 'storm' in args.scenarios:
+        # Every alarm fires twice (it flaps) and the intake queue delivers them in batches of --batch-size.
+        scale = load_function('scale-ebs.py', clock, {
+            'ENABLE_SNS': 'no',
+            'SNS_NOTIFICATION_TOPIC_ARN': '',
+            'DESIRED_UTILISATION': '60',
+            'THRESHOLD_UTILISATION': '80',
+            'SIZING_MODE': args.sizing_mode
+        })
+        alarms = sorted(aws.clients['cloudwatch'].alarms.values(), key=lambda alarm: alarm['AlarmName'])
+        alarms = alarms[-args.scale_events:]
+        def storm():
+            records = []
+            for repeat in range(2):
+                for alarm in alarms:
+                    message = {'Type': 'Notification', 'Message': json.dumps(alarm_message(alarm, clock))}
+                    records.append({'eventSource': 'aws:sqs', 'messageId': str(len(records)), 'body': json.dumps(message)})
+                    clock.sleep(0.01)
+            failures = 0
+            for i in range(0, len(records), args.batch_size):
+                response = scale.lambda_handler({'Records': records[i:i+args.batch_size]}, FakeContext(clock))
+                failures += len(response['batchItemFailures'])
+            return {'Messages': len(records), 'Batches': (len(records) + args.batch_size - 1)//args.batch_size, 'FailedMessages': failures}
+        results.append(measure('storm', fleet_size, aws, clock, storm))
+    return results
+
+
+def print_results(results, baseline):
+    print()
+    print('%-8s %7s %10s %9s %9s %8s %8s  %s' % ('scenario', 'fleet', 'virtual_s', 'real_s', 'sleep_s', 'calls', 'polls', 'calls per service'))
+    for result in results:
+        polls = result['Output'].get('Commands', {}).get('Polls', '-')
+        line = '%-8s %7d %10.1f %9.2f %9.1f %8d %8s  %s' % (
+            result['Scenario'], result['FleetSize'], result['VirtualSeconds'], result['RealSeconds'],
+            result['SleepSeconds'], sum(result['ApiCalls'].values()), polls, json.dumps(result['ApiCalls'], sort_keys=True)
+        )
+        previous = baseline.get((result['Scenario'], result['FleetSize']))
+        if previous:
+            line += '  (virtual %+.1f%%, calls %+.1f%% vs baseline)' % (
+                change(previous['VirtualSeconds'], result['VirtualSeconds']),
+                change(sum(previous['ApiCalls'].values()), sum(result['ApiCalls'].values()))
+            )
+        print(line)
+
+
+def change(before, after):
+    return (after - before)*100.0/before if before else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark onboarding and scaling against a simulated fleet.')
+    parser.add_argument('--fleet-sizes', default='10,100,1000,5000', help='comma separated fleet sizes')
+    parser.add_argument('--scenarios', default='onboard,scale', help='onboard (includes a full and a delta resweep), scale and/or storm')
+    parser.add_argument('--windows-ratio', type=float, default=0.2)
+    parser.add_argument('--nvme-ratio', type=float, default=0.7, help='share of linux instances with nvme disks, the rest is xen')
+    parser.add_argument('--max-disks', type=int, default=3)
+    parser.add_argument('--offline-ratio', type=float, default=0.0, help='share of instances whose ssm agent is offline')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='virtual seconds per api call')
+    parser.add_argument('--command-latency', type=float, default=3.0, help='virtual seconds for a command to finish on an instance')
+    parser.add_argument('--modify-latency', type=float, default=20.0, help='virtual seconds for a volume to reach optimizing')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of command invocations that fail')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of api calls that are throttled')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--regions', default='us-east-1', help='comma separated regions, each with a fleet of every fleet size, onboarded by one invocation')
+    parser.add_argument('--scale-events', type=int, default=50, help='alarms triggered in the scale scenario')
+    parser.add_argument('--sizing-mode', default='ratio')
+    parser.add_argument('--batch-size', type=int, default=10, help='intake queue batch size of the storm scenario')
+    parser.add_argument('--io-alarms', action='store_true', help='create i/o saturation alarms, the scale scenario triggers those first')
+    parser.add_argument('--high-resolution', action='store_true', help='tiered monitoring, tagged volumes are collected every 10 seconds')
+    parser.add_argument('--hot-ratio', type=float, default=0.1, help='share of volumes tagged for high resolution monitoring')
+    parser.add_argument('--speedup', type=float, default=50.0, help='virtual seconds per real second')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='results file of an earlier run to compare against')
+    parser.add_argument('--verbose', action='store_true', help='keep the output of the functions')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(',')
+    args.regions = args.regions.split(',')
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(result['Scenario'], result['FleetSize']): result for result in json.load(f)}
+
+    results = []
+    for fleet_size in [int(size) for size in args.fleet_sizes.split(',')]:
+        stdout = sys.stdout
+        if not args.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            results.extend(run_fleet(args, fleet_size))
+        finally:
+            if not args.verbose:
+                sys.stdout.close()
+                sys.stdout = stdout
+        print('Fleet of ' + str(fleet_size) + ' instance(s) done.')
+    print_results(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
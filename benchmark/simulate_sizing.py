@@ -0,0 +1,279 @@
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# Replays disk usage series through the sizing of scale-ebs-function for every combination of threshold,
+# target, sizing mode and growth horizon, and reports how each policy would have done.
+#
+#   $ python benchmark/simulate_sizing.py --synthetic 5000 --thresholds 70,80,90 --targets 50,60,70
+#   $ python benchmark/simulate_sizing.py --csv usage.csv --sizing-modes ratio,growth --json results.json
+#   $ python benchmark/simulate_sizing.py --metric-data export.json --sizes sizes.csv
+#
+# Every volume is stepped through time together, the sizing functions of lambda/sizing.py are only called
+# for the volumes whose alarm fires at that step. Like a CloudWatch alarm, a volume only notifies when it
+# crosses the threshold; if that happens during the modification cooldown the job is skipped and nothing
+# is scaled until usage drops below the threshold and crosses it again.
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+sys.path.insert(0, LAMBDA_DIR)
+from sizing import ratio_target_size, growth_target_size, MODIFICATION_COOLDOWN_HOURS, MAX_VOLUME_SIZE_GB
+
+
+class UsageSeries:
+    # Used GB of every volume on a common time grid, NaN where a volume has no sample.
+
+    def __init__(self, volume_ids, grid, used, initial_size):
+        self.volume_ids = volume_ids
+        self.grid = grid
+        self.used = used
+        self.initial_size = initial_size
+
+
+def parse_timestamp(value):
+    # Epoch seconds or ISO 8601, as written by the console, the cli and boto3.
+    try:
+        return float(value)
+    except ValueError:
+        timestamp = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+        return timestamp.timestamp()
+
+
+def read_csv(path, initial_size):
+    # volume_id,timestamp and either used_gb or used_percent. size_gb, when present, is the size of the volume
+    # at the time of the sample so that used percent can be turned into GB.
+    samples = {}
+    sizes = {}
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            volume_id = row['volume_id']
+            if row.get('size_gb'):
+                sizes.setdefault(volume_id, []).append(float(row['size_gb']))
+            size = sizes[volume_id][-1] if volume_id in sizes else initial_size
+            if row.get('used_gb'):
+                used = float(row['used_gb'])
+            else:
+                used = float(row['used_percent'])*size/100.0
+            samples.setdefault(volume_id, []).append((parse_timestamp(row['timestamp']), used))
+    return samples, {volume_id: values[0] for volume_id, values in sizes.items()}
+
+
+def read_metric_data(path, sizes, initial_size, free_space=False):
+    # A get_metric_data response, or a list of them, with one result per volume. The label (or id) of the
+    # result names the volume. Windows reports free space, pass free_space to turn it into used space.
+    with open(path) as f:
+        responses = json.load(f)
+    if isinstance(responses, dict):
+        responses = [responses]
+    samples = {}
+    for response in responses:
+        for result in response['MetricDataResults']:
+            volume_id = result.get('Label') or result['Id']
+            size = sizes.get(volume_id, initial_size)
+            for timestamp, value in zip(result['Timestamps'], result['Values']):
+                percent = 100.0 - value if free_space else value
+                samples.setdefault(volume_id, []).append((parse_timestamp(str(timestamp)), percent*size/100.0))
+    return samples
+
+
+def read_sizes(path):
+    with open(path, newline='') as f:
+        return {row['volume_id']: float(row['size_gb']) for row in csv.DictReader(f)}
+
+
+def to_grid(samples, sizes, initial_size, step_minutes):
+    volume_ids = sorted(samples)
+    start = min(min(t for t, _ in samples[volume_id]) for volume_id in volume_ids)
+    end = max(max(t for t, _ in samples[volume_id]) for volume_id in volume_ids)
+    grid = np.arange(start, end + 1, step_minutes*60.0)
+    used = np.full((len(volume_ids), len(grid)), np.nan)
+    for i, volume_id in enumerate(volume_ids):
+        points = np.array(sorted(samples[volume_id]))
+        inside = (grid >= points[0, 0]) & (grid <= points[-1, 0])
+        used[i, inside] = np.interp(grid[inside], points[:, 0], points[:, 1])
+    initial = np.array([int(sizes.get(volume_id, initial_size)) for volume_id in volume_ids], dtype=np.int64)
+    return UsageSeries(volume_ids, grid, used, initial)
+
+
+def synthetic_series(volumes, days, step_minutes, seed):
+    # Steady growth with daily cleanups and occasional bursts (logs, deploys, dumps) that are deleted a few
+    # hours later. Generated for all volumes at once.
+    rng = np.random.default_rng(seed)
+    steps = int(days*24*60/step_minutes)
+    hours = np.arange(steps)*step_minutes/60.0
+    size = rng.choice([20, 50, 100, 200, 500, 1000], volumes)
+    start = rng.uniform(0.3, 0.7, volumes)*size
+    rate = np.maximum(rng.normal(0.002, 0.002, volumes), 0)*size
+    used = start[:, None] + rate[:, None]*hours[None, :]
+    cleanup = rng.uniform(0, 0.1, volumes)*size
+    used -= cleanup[:, None]*np.floor(hours/24.0)[None, :]*(rng.random(volumes) < 0.3)[:, None]
+    bursts = rng.random((volumes, steps)) < step_minutes/(60.0*24*7)
+    burst_size = rng.uniform(0.05, 0.3, (volumes, steps))*size[:, None]*bursts
+    lasting = max(1, int(rng.uniform(2, 8)*60/step_minutes))
+    kernel = np.ones(lasting)
+    used += np.apply_along_axis(lambda row: np.convolve(row, kernel)[:steps], 1, burst_size)
+    used += rng.normal(0, 0.002, (volumes, steps))*size[:, None]
+    used = np.maximum(used, 0.01*size[:, None])
+    grid = time.time() - days*86400 + hours*3600
+    return UsageSeries(['vol-synthetic-%05d' % i for i in range(volumes)], grid, used, size.astype(np.int64))
+
+
+def simulate(series, threshold, target, sizing_mode, horizon, near_miss, history_hours, reference):
+    used = series.used
+    grid = series.grid
+    step_hours = (grid[1] - grid[0])/3600.0 if len(grid) > 1 else 0.0
+    size = series.initial_size.copy()
+    last_modified = np.full(len(size), -np.inf)
+    # Sizes over time, scale-ebs reads the usage history in percent of the size the volume had at the time.
+    changes = [[(grid[0], int(s))] for s in size]
+    in_alarm = np.zeros(len(size), dtype=bool)
+    near = np.zeros(len(size), dtype=bool)
+    full = np.zeros(len(size), dtype=bool)
+    report = {'ScaleEvents': 0, 'FailedEvents': 0, 'SkippedAlarms': 0, 'NearMissIntervals': 0, 'NearMissHours': 0.0,
+              'OutOfSpaceIntervals': 0, 'OutOfSpaceHours': 0.0, 'OverProvisionedGB': 0.0, 'ProvisionedGB': 0.0}
+    started = time.time()
+    for t in range(len(grid)):
+        u = used[:, t]
+        valid = ~np.isnan(u)
+        utilisation = np.where(valid, u, 0.0)*100.0/size
+        alarm = valid & (utilisation > threshold)
+        notified = alarm & ~in_alarm
+        in_alarm = alarm
+        ready = grid[t] - last_modified >= MODIFICATION_COOLDOWN_HOURS*3600
+        report['SkippedAlarms'] += int(np.count_nonzero(notified & ~ready))
+        for v in np.flatnonzero(notified & ready):
+            new_size = target_size(series, changes[v], v, t, int(size[v]), threshold, target, sizing_mode, horizon, history_hours)
+            # modify_volume rejects sizes above the maximum and sizes that do not grow the volume.
+            if new_size > MAX_VOLUME_SIZE_GB or new_size <= size[v]:
+                report['FailedEvents'] += 1
+                continue
+            size[v] = new_size
+            last_modified[v] = grid[t]
+            changes[v].append((grid[t], new_size))
+            report['ScaleEvents'] += 1
+        # Intervals are counted on the utilisation before the volume was scaled, that is what the disk went through.
+        near_now = valid & (utilisation >= near_miss)
+        full_now = valid & (utilisation >= 100.0)
+        report['NearMissIntervals'] += int(np.count_nonzero(near_now & ~near))
+        report['OutOfSpaceIntervals'] += int(np.count_nonzero(full_now & ~full))
+        report['NearMissHours'] += np.count_nonzero(near_now)*step_hours
+        report['OutOfSpaceHours'] += np.count_nonzero(full_now)*step_hours
+        near = near_now
+        full = full_now
+        # Space above what the usage needs at the reference utilisation, the same yardstick for every policy.
+        report['OverProvisionedGB'] += float(np.sum(np.where(valid, np.maximum(size - np.where(valid, u, 0.0)*100.0/reference, 0.0), 0.0)))
+        report['ProvisionedGB'] += float(np.sum(np.where(valid, size, 0)))
+    steps = max(1, len(grid))
+    report['OverProvisionedGB'] = round(report['OverProvisionedGB']/steps, 1)
+    report['ProvisionedGB'] = round(report['ProvisionedGB']/steps, 1)
+    report['NearMissHours'] = round(report['NearMissHours'], 1)
+    report['OutOfSpaceHours'] = round(report['OutOfSpaceHours'], 1)
+    report['VolumesScaled'] = int(np.count_nonzero(size > series.initial_size))
+    report['GBAdded'] = int(np.sum(size - series.initial_size))
+    report['SimulationSeconds'] = round(time.time() - started, 2)
+    return report
+
+
+def target_size(series, changes, v, t, current_size, threshold, target, sizing_mode, horizon, history_hours):
+    # The same calls target_sizes of scale-ebs makes, with the history it would have read from CloudWatch.
+    if sizing_mode != 'growth':
+        return ratio_target_size(current_size, threshold, target)
+    window = (series.grid > series.grid[t] - history_hours*3600) & (series.grid <= series.grid[t]) & ~np.isnan(series.used[v])
+    if not np.any(window):
+        return ratio_target_size(current_size, threshold, target)
+    timestamps = series.grid[window]
+    change_times = np.array([change[0] for change in changes])
+    change_sizes = np.array([change[1] for change in changes], dtype=float)
+    sizes = change_sizes[np.searchsorted(change_times, timestamps, side='right') - 1]
+    used_percent = series.used[v][window]*100.0/sizes
+    return growth_target_size(
+        current_size, timestamps.tolist(), used_percent.tolist(), threshold, target,
+        horizon_hours=horizon, max_size=MAX_VOLUME_SIZE_GB
+    )
+
+
+def policies(args):
+    for threshold, target, sizing_mode, horizon in itertools.product(args.thresholds, args.targets, args.sizing_modes, args.growth_horizons):
+        if target >= threshold:
+            continue
+        if sizing_mode != 'growth' and horizon != args.growth_horizons[0]:
+            continue
+        yield {'Threshold': threshold, 'Target': target, 'SizingMode': sizing_mode, 'GrowthHorizonHours': horizon if sizing_mode == 'growth' else None}
+
+
+def print_results(results, series):
+    print()
+    print('Volumes: ' + str(len(series.volume_ids)) + ', samples per volume: ' + str(len(series.grid)) +
+          ', hours: ' + str(round((series.grid[-1] - series.grid[0])/3600.0, 1)))
+    print('%9s %6s %7s %7s %7s %7s %7s %9s %9s %9s %9s %11s %10s' % (
+        'threshold', 'target', 'mode', 'horizon', 'events', 'failed', 'skipped', 'near_miss', 'near_h', 'full', 'full_h', 'overprov_gb', 'added_gb'))
+    for result in results:
+        print('%9d %6d %7s %7s %7d %7d %7d %9d %9.1f %9d %9.1f %11.1f %10d' % (
+            result['Threshold'], result['Target'], result['SizingMode'], result['GrowthHorizonHours'] or '-',
+            result['ScaleEvents'], result['FailedEvents'], result['SkippedAlarms'], result['NearMissIntervals'], result['NearMissHours'],
+            result['OutOfSpaceIntervals'], result['OutOfSpaceHours'], result['OverProvisionedGB'], result['GBAdded']
+        ))
+
+
+def numbers(value, cast=int):
+    return [cast(part) for part in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay disk usage series through the sizing of scale-ebs-function.')
+    parser.add_argument('--csv', help='usage samples with columns volume_id, timestamp, used_percent or used_gb and optionally size_gb')
+    parser.add_argument('--metric-data', help='exported get_metric_data response(s), one result per volume labelled with its volume id')
+    parser.add_argument('--free-space', action='store_true', help='the metric data is free space in percent (windows)')
+    parser.add_argument('--sizes', help='csv with columns volume_id, size_gb, the size at the start of the series')
+    parser.add_argument('--initial-size', type=float, default=100, help='size in GB of volumes without a known size')
+    parser.add_argument('--synthetic', type=int, default=0, help='generate usage of this many volumes instead')
+    parser.add_argument('--days', type=float, default=14, help='days of synthetic usage')
+    parser.add_argument('--step-minutes', type=float, default=5, help='resolution of the replay, scale-ebs reads 5 minute averages')
+    parser.add_argument('--thresholds', default='70,80,90', help='comma separated threshold utilisation percents')
+    parser.add_argument('--targets', default='50,60,70', help='comma separated target utilisation percents')
+    parser.add_argument('--sizing-modes', default='ratio,growth')
+    parser.add_argument('--growth-horizons', default='24', help='comma separated growth horizon hours, used by growth sizing')
+    parser.add_argument('--history-hours', type=float, default=24, help='usage history growth sizing fits')
+    parser.add_argument('--near-miss', type=float, default=95, help='utilisation percent counted as a near miss')
+    parser.add_argument('--reference', type=float, default=80, help='utilisation percent over provisioned space is measured against')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    args.thresholds = numbers(args.thresholds)
+    args.targets = numbers(args.targets)
+    args.sizing_modes = args.sizing_modes.split(',')
+    args.growth_horizons = numbers(args.growth_horizons, float)
+
+    sizes = read_sizes(args.sizes) if args.sizes else {}
+    if args.synthetic:
+        series = synthetic_series(args.synthetic, args.days, args.step_minutes, args.seed)
+    elif args.csv:
+        samples, first_sizes = read_csv(args.csv, args.initial_size)
+        first_sizes.update(sizes)
+        series = to_grid(samples, first_sizes, args.initial_size, args.step_minutes)
+    elif args.metric_data:
+        series = to_grid(read_metric_data(args.metric_data, sizes, args.initial_size, args.free_space), sizes, args.initial_size, args.step_minutes)
+    else:
+        parser.error('one of --csv, --metric-data or --synthetic is required')
+
+    results = []
+    for policy in policies(args):
+        result = dict(policy)
+        result.update(simulate(series, policy['Threshold'], policy['Target'], policy['SizingMode'],
+                               policy['GrowthHorizonHours'] or 0, args.near_miss, args.history_hours, args.reference))
+        results.append(result)
+    print_results(results, series)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
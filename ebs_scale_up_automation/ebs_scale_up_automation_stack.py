@@ -1,8 +1,12 @@
 from aws_cdk import (
+    aws_dynamodb as dynamodb,
+    aws_events as events,
+    aws_events_targets as targets,
     aws_lambda as _lambda,
     aws_iam as iam,
     aws_sns as sns,
     aws_sns_subscriptions as sns_sub,
+    aws_sqs as sqs,
     aws_ssm as ssm,
     core
 )
@@ -41,6 +45,78 @@ class EbsScaleUpAutomationStack(core.Stack):
             description='If selected \"Yes\". Topic arn to which notification will be sent.'
         )
         
+        sizing_mode = core.CfnParameter(
+            self, "Sizing-Mode",
+            type="String",
+            allowed_values=["ratio","growth"],
+            default="ratio",
+            description='Select "growth" to size volumes for their recent growth rate, so the threshold is not reached again within the growth horizon after the 6 hour modification cooldown.'
+        )
+        
+        growth_horizon = core.CfnParameter(
+            self, "Growth-Horizon-Hours",
+            type="Number",
+            default=24,
+            min_value=1,
+            description='Hours beyond the modification cooldown a volume must last before reaching threshold again. Used when Sizing-Mode is "growth".'
+        )
+        
+        performance_scaling = core.CfnParameter(
+            self, "Performance-Scaling",
+            type="String",
+            allowed_values=["yes","no"],
+            default="yes",
+            description='Select "yes" to grow provisioned IOPS and throughput of gp3, io1 and io2 volumes in proportion to their size.'
+        )
+        
+        convert_gp2 = core.CfnParameter(
+            self, "Convert-Gp2-To-Gp3",
+            type="String",
+            allowed_values=["yes","no"],
+            default="no",
+            description='Select "yes" to convert gp2 volumes to gp3 with at least the IOPS and throughput gp2 would offer at the new size when they are scaled.'
+        )
+        
+        io_alarms = core.CfnParameter(
+            self, "Io-Saturation-Alarms",
+            type="String",
+            allowed_values=["yes","no"],
+            default="no",
+            description='Select "yes" to also alarm on EBS VolumeQueueLength and BurstBalance. These alarms raise provisioned IOPS and throughput (converting gp2 to gp3) instead of growing the volume.'
+        )
+        
+        high_resolution = core.CfnParameter(
+            self, "High-Resolution-Monitoring",
+            type="String",
+            allowed_values=["yes","no"],
+            default="no",
+            description='Select "yes" to collect the disk metrics of hot volumes every 10 seconds and alarm on them at high resolution. Volumes are hot when tagged "ebs-scale-up:monitoring" = "high-resolution" (on the volume or its instance) or when their usage grew faster than Hot-Growth-Percent-Per-Hour over the last 6 hours, every other volume stays at 60 seconds.'
+        )
+        
+        hot_growth_rate = core.CfnParameter(
+            self, "Hot-Growth-Percent-Per-Hour",
+            type="Number",
+            default=10,
+            min_value=0,
+            description='Growth of used space in percent points per hour above which a volume gets high resolution monitoring.'
+        )
+        
+        sweep_minutes = core.CfnParameter(
+            self, "Onboarding-Sweep-Minutes",
+            type="Number",
+            default=60,
+            min_value=2,
+            description='Minutes between incremental onboarding sweeps, which onboard new instances and instances whose volumes changed since they were onboarded.'
+        )
+        
+        scaling_concurrency = core.CfnParameter(
+            self, "Scaling-Max-Concurrency",
+            type="Number",
+            default=5,
+            min_value=2,
+            description='Maximum number of scale-ebs-function invocations consuming alarms at the same time. Alarm storms queue up instead of starting an invocation per alarm.'
+        )
+        
         ce_agent_doc={}
         with open('ssm/cloudwatch-agent-installation-document.json', 'r') as f:
              cw_agent_doc = json.load(f)
@@ -79,6 +155,14 @@ class EbsScaleUpAutomationStack(core.Stack):
             topic_name='ebs-utilisation-exceeded-topic'
         )
         
+        state_table = dynamodb.Table(
+            self, 'EBSScaleUpStateTable',
+            table_name='ebs-scale-up-state',
+            partition_key=dynamodb.Attribute(name='Key', type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='ExpiresAt'
+        )
+        
         create_metric_alarm_policy = iam.PolicyDocument(
             statements=[
                 iam.PolicyStatement(
@@ -89,27 +173,39 @@ class EbsScaleUpAutomationStack(core.Stack):
                 ),
                 iam.PolicyStatement(
                     sid="describeEC2Instance",
-                    actions=["ec2:DescribeInstances"],
+                    actions=["ec2:DescribeInstances","ec2:CreateTags","ec2:DescribeVolumes"],
                     effect=iam.Effect.ALLOW,
                     resources=["*"]
                 ),
                 iam.PolicyStatement(
                     sid="ssmParameterAccess",
-                    actions=["ssm:GetParameter","ssm:PutParameter"],
+                    actions=["ssm:GetParameter","ssm:PutParameter","ssm:GetParametersByPath"],
                     effect=iam.Effect.ALLOW,
                     resources= ['*']    
                 ),
                 iam.PolicyStatement(
                     sid="ssmCommandInvocation",
-                    actions=["ssm:SendCommand","ssm:GetCommandInvocation"],
+                    actions=["ssm:SendCommand","ssm:GetCommandInvocation","ssm:ListCommandInvocations","ssm:DescribeInstanceInformation"],
                     effect=iam.Effect.ALLOW,
                     resources= ['*']    
                 ),
                 iam.PolicyStatement(
                     sid="cwCreateAlarm",
-                    actions=["cloudwatch:PutMetricAlarm"],
+                    actions=["cloudwatch:PutMetricAlarm","cloudwatch:DescribeAlarms","cloudwatch:DeleteAlarms","cloudwatch:GetMetricData"],
                     effect=iam.Effect.ALLOW,
                     resources= ['*']    
+                ),
+                iam.PolicyStatement(
+                    sid="onboardOtherAccounts",
+                    actions=["sts:AssumeRole"],
+                    effect=iam.Effect.ALLOW,
+                    resources=['*']
+                ),
+                iam.PolicyStatement(
+                    sid="onboardingState",
+                    actions=["dynamodb:GetItem","dynamodb:BatchGetItem","dynamodb:PutItem","dynamodb:DeleteItem"],
+                    effect=iam.Effect.ALLOW,
+                    resources=[state_table.table_arn]
                 )
             ]
         )
@@ -132,10 +228,73 @@ class EbsScaleUpAutomationStack(core.Stack):
             ),
             environment={
                 'THRESHOLD_UTILISATION': theshold_util.value_as_string,
-                'UTIL_EXCEEDED_SNS_TOPIC_ARN':ebs_util_exceeded_topic.topic_arn
+                'UTIL_EXCEEDED_SNS_TOPIC_ARN':ebs_util_exceeded_topic.topic_arn,
+                'ONBOARDING_CONCURRENCY':'10',
+                'TARGET_CONCURRENCY':'10',
+                'IO_ALARMS':io_alarms.value_as_string,
+                'HIGH_RESOLUTION_MONITORING':high_resolution.value_as_string,
+                'HOT_GROWTH_PERCENT_PER_HOUR':hot_growth_rate.value_as_string,
+                'STATE_TABLE':state_table.table_name
             }
         )
         
+        # Incremental onboarding, instances are onboarded when they start or a volume is attached and a periodic
+        # sweep catches whatever the events missed. Instances that did not change are skipped.
+        events.Rule(
+            self, 'OnboardingInstanceStateRule',
+            event_pattern=events.EventPattern(
+                source=['aws.ec2'],
+                detail_type=['EC2 Instance State-change Notification'],
+                detail={'state': ['running', 'terminated']}
+            ),
+            targets=[targets.LambdaFunction(create_metric_alarm_lambda)]
+        )
+        
+        # EBS only sends a volume notification when an attachment fails, a successful one is seen in CloudTrail.
+        events.Rule(
+            self, 'OnboardingVolumeAttachRule',
+            event_pattern=events.EventPattern(
+                source=['aws.ec2'],
+                detail_type=['AWS API Call via CloudTrail'],
+                detail={'eventSource': ['ec2.amazonaws.com'], 'eventName': ['AttachVolume']}
+            ),
+            targets=[targets.LambdaFunction(create_metric_alarm_lambda)]
+        )
+        
+        events.Rule(
+            self, 'OnboardingSweepRule',
+            schedule=events.Schedule.expression('rate(' + sweep_minutes.value_as_string + ' minutes)'),
+            targets=[targets.LambdaFunction(
+                create_metric_alarm_lambda,
+                event=events.RuleTargetInput.from_object({'InstanceIds': '*', 'Incremental': True})
+            )]
+        )
+        
+        # Messages stay invisible for six times the function timeout, as recommended for Lambda event sources, so a
+        # batch is not delivered again while the invocation working on it is still running.
+        scale_ebs_timeout = 300
+        
+        scaling_resume_queue = sqs.Queue(
+            self, 'EBSScalingResumeQueue',
+            queue_name='ebs-scaling-resume-queue',
+            visibility_timeout=core.Duration.seconds(6*scale_ebs_timeout)
+        )
+        
+        # Alarms are buffered here and consumed in batches, messages that keep failing end up in the dead letter queue.
+        scaling_intake_queue = sqs.Queue(
+            self, 'EBSScalingIntakeQueue',
+            queue_name='ebs-scaling-intake-queue',
+            visibility_timeout=core.Duration.seconds(6*scale_ebs_timeout),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=3,
+                queue=sqs.Queue(
+                    self, 'EBSScalingIntakeDeadLetterQueue',
+                    queue_name='ebs-scaling-intake-dlq',
+                    retention_period=core.Duration.days(14)
+                )
+            )
+        )
+        
         scale_ebs_policy = iam.PolicyDocument(
             statements=[
                 iam.PolicyStatement(
@@ -146,13 +305,13 @@ class EbsScaleUpAutomationStack(core.Stack):
                 ),
                 iam.PolicyStatement(
                     sid="EC2AndEBS",
-                    actions=["ec2:DescribeVolumes","ec2:ModifyVolume","ec2:DescribeInstanceAttribute"],
+                    actions=["ec2:DescribeVolumes","ec2:ModifyVolume","ec2:DescribeInstanceAttribute","ec2:DescribeVolumesModifications"],
                     effect=iam.Effect.ALLOW,
                     resources=["*"]
                 ),
                 iam.PolicyStatement(
                     sid="ssmCommandInvocation",
-                    actions=["ssm:SendCommand","ssm:GetCommandInvocation"],
+                    actions=["ssm:SendCommand","ssm:GetCommandInvocation","ssm:ListCommandInvocations"],
                     effect=iam.Effect.ALLOW,
                     resources= ['*']    
                 ),
@@ -161,6 +320,24 @@ class EbsScaleUpAutomationStack(core.Stack):
                     actions=["sns:Publish"],
                     effect=iam.Effect.ALLOW,
                     resources=["*"]    
+                ),
+                iam.PolicyStatement(
+                    sid="cwUsageHistory",
+                    actions=["cloudwatch:GetMetricData","cloudwatch:DescribeAlarms"],
+                    effect=iam.Effect.ALLOW,
+                    resources=["*"]
+                ),
+                iam.PolicyStatement(
+                    sid="scalingStateCheckpoint",
+                    actions=["dynamodb:GetItem","dynamodb:BatchGetItem","dynamodb:PutItem","dynamodb:DeleteItem"],
+                    effect=iam.Effect.ALLOW,
+                    resources=[state_table.table_arn]
+                ),
+                iam.PolicyStatement(
+                    sid="scalingResume",
+                    actions=["sqs:SendMessage"],
+                    effect=iam.Effect.ALLOW,
+                    resources=[scaling_resume_queue.queue_arn]
                 )
             ]
         )
@@ -171,7 +348,7 @@ class EbsScaleUpAutomationStack(core.Stack):
             function_name='scale-ebs-function',
             code=_lambda.Code.from_asset(path='lambda/'),
             runtime=_lambda.Runtime.PYTHON_3_7,
-            timeout=core.Duration.seconds(300),
+            timeout=core.Duration.seconds(scale_ebs_timeout),
             memory_size=128,
             role=iam.Role(
                 self, 'ScaleEBSRole',
@@ -185,10 +362,38 @@ class EbsScaleUpAutomationStack(core.Stack):
                 'THRESHOLD_UTILISATION': theshold_util.value_as_string,
                 'DESIRED_UTILISATION': target_util.value_as_string,
                 'ENABLE_SNS':enable_sns.value_as_string,
-                'SNS_NOTIFICATION_TOPIC_ARN':sns_arn.value_as_string
+                'SNS_NOTIFICATION_TOPIC_ARN':sns_arn.value_as_string,
+                'SIZING_MODE':sizing_mode.value_as_string,
+                'GROWTH_HORIZON_HOURS':growth_horizon.value_as_string,
+                'PERFORMANCE_SCALING':performance_scaling.value_as_string,
+                'CONVERT_GP2_TO_GP3':convert_gp2.value_as_string,
+                'STATE_TABLE':state_table.table_name,
+                'RESUME_QUEUE_URL':scaling_resume_queue.queue_url,
+                'DEDUPE_WINDOW_SECONDS':'900'
             }
         )
         
-        ebs_util_exceeded_topic.add_subscription(sns_sub.LambdaSubscription(ebs_scaling_lambda))
+        ebs_util_exceeded_topic.add_subscription(sns_sub.SqsSubscription(scaling_intake_queue))
+        scaling_intake_queue.grant_consume_messages(ebs_scaling_lambda)
+        scaling_resume_queue.grant_consume_messages(ebs_scaling_lambda)
+        
+        # The function reports failed messages of a batch, the others are deleted from the queue.
+        intake_mapping = _lambda.EventSourceMapping(
+            self, 'EBSScalingIntakeMapping',
+            target=ebs_scaling_lambda,
+            event_source_arn=scaling_intake_queue.queue_arn,
+            batch_size=10,
+            max_batching_window=core.Duration.seconds(20)
+        )
+        intake_mapping.node.default_child.add_property_override('FunctionResponseTypes', ['ReportBatchItemFailures'])
+        intake_mapping.node.default_child.add_property_override('ScalingConfig.MaximumConcurrency', scaling_concurrency.value_as_number)
+        
+        resume_mapping = _lambda.EventSourceMapping(
+            self, 'EBSScalingResumeMapping',
+            target=ebs_scaling_lambda,
+            event_source_arn=scaling_resume_queue.queue_arn,
+            batch_size=1
+        )
+        resume_mapping.node.default_child.add_property_override('FunctionResponseTypes', ['ReportBatchItemFailures'])
 
         
@@ -0,0 +1,117 @@
+import threading
+import time
+import boto3
+import botocore.config
+from instrumentation import current, instrument
+from rate_limiter import limiter
+
+# Clients are created on first use and cached for the lifetime of the execution environment, so a cold start
+# only pays for the clients the invocation actually calls and warm invocations reuse their connections.
+#
+# Every thread works for a target, a region and an optional role to assume in another account. Module level
+# lazy clients resolve to the client of the target of the calling thread, the default target is the region
+# and account of the function itself.
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_ATTEMPTS = 5
+# Assumed role credentials are renewed this many seconds before they expire.
+CREDENTIALS_MARGIN = 300
+ROLE_SESSION_NAME = 'ebs-scale-up'
+
+_clients = {}
+_credentials = {}
+_lock = threading.Lock()
+_target = threading.local()
+
+
+def client_config(max_pool_connections=10):
+    # Adaptive retries add client side rate limiting on top of the exponential backoff of standard mode.
+    return botocore.config.Config(
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        max_pool_connections=max_pool_connections,
+        retries={'mode': 'adaptive', 'total_max_attempts': MAX_ATTEMPTS},
+        tcp_keepalive=True
+    )
+
+
+def use_target(region=None, role_arn=None):
+    # Also usable as the initializer of an executor, so its worker threads work for the same target.
+    _target.value = (region, role_arn)
+
+
+def current_target():
+    return getattr(_target, 'value', (None, None))
+
+
+def get_client(service_name, max_pool_connections=10, region=None, role_arn=None):
+    key = (service_name, max_pool_connections, region, role_arn)
+    client = _clients.get(key)
+    if client is not None and (role_arn is None or _credentials_valid(role_arn)):
+        return client
+    credentials = _assume_role(role_arn) if role_arn else {}
+    with _lock:
+        if key not in _clients or _clients[key] is client:
+            start = time.time()
+            client = boto3.client(service_name, region_name=region, config=client_config(max_pool_connections), **credentials)
+            instrument(client)
+            limiter.register(client, scope=(region or '') + ':' + (role_arn or ''))
+            current().add('ClientCreateTime', (time.time() - start)*1000, 'Milliseconds')
+            _clients[key] = client
+        return _clients[key]
+
+
+def _credentials_valid(role_arn):
+    credentials = _credentials.get(role_arn)
+    return credentials is not None and credentials['Expiration'] - CREDENTIALS_MARGIN > time.time()
+
+
+def _assume_role(role_arn):
+    # One set of credentials per role, shared by the clients of every region of that account.
+    with _lock:
+        if _credentials_valid(role_arn):
+            credentials = _credentials[role_arn]
+        else:
+            credentials = None
+    if credentials is None:
+        response = get_client('sts').assume_role(RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        credentials = {
+            'AccessKeyId': response['AccessKeyId'],
+            'SecretAccessKey': response['SecretAccessKey'],
+            'SessionToken': response['SessionToken'],
+            'Expiration': response['Expiration'].timestamp()
+        }
+        with _lock:
+            _credentials[role_arn] = credentials
+    return {
+        'aws_access_key_id': credentials['AccessKeyId'],
+        'aws_secret_access_key': credentials['SecretAccessKey'],
+        'aws_session_token': credentials['SessionToken']
+    }
+
+
+def clear():
+    with _lock:
+        _clients.clear()
+        _credentials.clear()
+
+
+class LazyClient:
+    # Stands in for a boto3 client at module level, the client is created by the first attribute access.
+    # max_pool_connections may be a function, it is called on every access so the pool can follow the
+    # concurrency of the calling thread's work.
+
+    def __init__(self, service_name, max_pool_connections=10):
+        self._service_name = service_name
+        self._max_pool_connections = max_pool_connections
+
+    def __getattr__(self, name):
+        max_pool_connections = self._max_pool_connections
+        if callable(max_pool_connections):
+            max_pool_connections = max_pool_connections()
+        return getattr(get_client(self._service_name, max_pool_connections, *current_target()), name)
+
+
+def lazy_client(service_name, max_pool_connections=10):
+    return LazyClient(service_name, max_pool_connections)
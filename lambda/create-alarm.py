@@ -1,164 +1,762 @@
-import json
-import boto3
 import time
+init_started = time.time()
+
+import hashlib
+import json
 import os
+import threading
 import botocore
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ssm_command import CommandRunner, deadline_from_context, MAX_BATCH_SIZE
+from disk_inventory import inventory_commands, parse_inventory, volume_id_from_block_device_mappings
+from instrumentation import MetricsRecord, current, start_invocation
+from aws_clients import lazy_client, use_target
+from state_store import state_store_from_env
+from sizing import growth_rate, performance_boost
+from usage_history import fetch_usage_history
 
 threshold = int(os.getenv('THRESHOLD_UTILISATION'))
 ebs_utilisation_topic_arn = os.getenv('UTIL_EXCEEDED_SNS_TOPIC_ARN')
+concurrency = int(os.getenv('ONBOARDING_CONCURRENCY', '10'))
+# Regions and accounts onboarded at the same time when an invocation names several targets.
+target_concurrency = int(os.getenv('TARGET_CONCURRENCY', '10'))
+# I/O saturation alarms on the EBS metrics of every onboarded volume, they scale performance instead of size.
+io_alarms_enabled = os.getenv('IO_ALARMS', 'no').lower()
+queue_length_threshold = float(os.getenv('IO_QUEUE_LENGTH_THRESHOLD', '32'))
+burst_balance_threshold = float(os.getenv('BURST_BALANCE_THRESHOLD', '20'))
+io_evaluation_periods = int(os.getenv('IO_EVALUATION_PERIODS', '5'))
+# Incremental onboarding re-onboards an unchanged instance once its record expires, records of instances with
+# attached volumes that have no alarm yet (e.g. not mounted when the attach event arrived) expire sooner.
+resync_seconds = float(os.getenv('ONBOARDING_RESYNC_HOURS', '24'))*3600
+recheck_seconds = float(os.getenv('ONBOARDING_RECHECK_MINUTES', '60'))*60
+# Tiered monitoring, hot volumes are collected every 10 seconds and get high resolution alarms while the rest stays
+# at 60 seconds. A volume is hot when it (or its instance) is tagged so or when its usage grew faster than the
+# limit, in percent points per hour, over the last hours.
+high_resolution_monitoring = os.getenv('HIGH_RESOLUTION_MONITORING', 'no').lower()
+hot_growth_rate = float(os.getenv('HOT_GROWTH_PERCENT_PER_HOUR', '10'))
+hot_growth_hours = float(os.getenv('HOT_GROWTH_WINDOW_HOURS', '6'))
+
+# Workers share the clients, so the connection pool has to be at least as large as the pool of workers, which
+# an event or target can set per onboarding. Each of these resolves to the client of the region and account the
+# calling thread is onboarding.
+def pool_size():
+    onboarding = getattr(_local, 'onboarding', None)
+    return max(10, onboarding.concurrency if onboarding else concurrency)
+
+ssm = lazy_client('ssm', max_pool_connections=pool_size)
+ec2 = lazy_client('ec2', max_pool_connections=pool_size)
+cw = lazy_client('cloudwatch', max_pool_connections=pool_size)
+
+store = state_store_from_env(lazy_client('dynamodb', max_pool_connections=pool_size))
+
+ALARM_PREFIX = 'ebs-utilisation-exceeded-alarm:'
+IO_ALARM_PREFIX = 'ebs-io-saturation-alarm:'
+# Only these volume types have a burst bucket.
+BURST_VOLUME_TYPES = ('gp2', 'st1', 'sc1')
+ALARM_FIELDS = ('AlarmActions', 'AlarmDescription', 'ComparisonOperator', 'EvaluationPeriods', 'DatapointsToAlarm', 'Threshold',
+                'MetricName', 'Namespace', 'Statistic', 'Dimensions', 'Period')
+function_name = 'create-ebs-metric-alarm-function'
+cold_start = True
+
+# Fingerprint of the agent configuration last applied to the instance, which is the hash in the name of its parameter.
+AGENT_CONFIG_TAG = 'ebs-scale-up:agent-config'
+# Pins the monitoring tier of a volume or of every volume of an instance, the tag of the volume wins.
+MONITORING_TAG = 'ebs-scale-up:monitoring'
+# Agent collection interval and alarm period in seconds of every tier.
+MONITORING_TIERS = {'standard': 60, 'high-resolution': 10}
+
+_local = threading.local()
+
+class Onboarding:
+    # Everything an invocation keeps while it onboards one target, a region and optionally a role to assume in
+    # another account. Targets are onboarded in parallel, every thread working for a target finds it with
+    # current_onboarding().
+    
+    def __init__(self, target, event, context):
+        self.region = target.get('Region')
+        self.role_arn = target.get('RoleArn')
+        self.topic_arn = target.get('TopicArn') or target_topic_arn(self.region, self.role_arn)
+        self.concurrency = int(target.get('Concurrency', event.get('Concurrency', concurrency)))
+        self.runner = CommandRunner(ssm, deadline_from_context(context, 30))
+        self.force_agent_install = event.get('ForceAgentInstall', False)
+        # A forced agent installation has to reach every instance, unchanged ones included.
+        self.incremental = event.get('Incremental', False) and not self.force_agent_install
+        self.existing_alarms = {}
+        self.alarm_changes = {'Created': 0, 'Updated': 0, 'Unchanged': 0, 'Deleted': 0}
+        self.unchanged_instances = 0
+        self.agent_config_templates = {}
+        self.agent_config_parameters = {}
+        self.volume_tiers = None
+        self.lock = threading.Lock()
+    
+    def name(self):
+        return (self.region or 'default') + ('/' + account_of(self.role_arn) if self.role_arn else '')
+
+def enter_onboarding(onboarding):
+    # Also the initializer of the worker pool of the target.
+    use_target(onboarding.region, onboarding.role_arn)
+    _local.onboarding = onboarding
 
-ssm = boto3.client('ssm')
-ec2 = boto3.client('ec2')
-cw = boto3.client('cloudwatch')
+def current_onboarding():
+    return _local.onboarding
+
+def account_of(role_arn):
+    # arn:aws:iam::123456789012:role/name
+    return role_arn.split(':')[4] if role_arn else None
+
+def target_topic_arn(region, role_arn):
+    # Alarms notify the topic of the same name in the region and account of the target, which the stack creates
+    # wherever it is deployed.
+    parts = (ebs_utilisation_topic_arn or '').split(':')
+    if len(parts) < 6:
+        return ebs_utilisation_topic_arn
+    parts[3] = region or parts[3]
+    parts[4] = account_of(role_arn) or parts[4]
+    return ':'.join(parts)
 
 def lambda_handler(event, context):
+    global function_name, cold_start
+    function_name = getattr(context, 'function_name', 'create-ebs-metric-alarm-function')
+    metrics = start_invocation(function_name)
+    if cold_start:
+        metrics.add('ColdStart')
+        metrics.add('InitTime', init_seconds*1000, 'Milliseconds')
+        cold_start = False
+    use_target()
+    event = onboarding_event(event)
+    targets = event.get('Targets') or [{}]
+    with metrics.span('Onboarding'):
+        if len(targets) == 1:
+            reports = [onboard_target(targets[0], event, context)]
+        else:
+            # The invocation takes as long as the slowest target instead of the sum of all of them.
+            print('Onboarding ' + str(len(targets)) + ' target(s).')
+            workers = min(len(targets), int(event.get('TargetConcurrency', target_concurrency)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                reports = list(executor.map(lambda target: onboard_target(target, event, context), targets))
+    
+    summary = {'Total': 0, 'Succeeded': 0, 'Failed': 0}
+    alarm_changes = {'Created': 0, 'Updated': 0, 'Unchanged': 0, 'Deleted': 0}
+    commands = {'ApiCalls': {}, 'Commands': 0, 'Polls': 0, 'Throttles': 0, 'WaitSeconds': 0.0}
+    instances = []
+    for report in reports:
+        for key in ('Total', 'Succeeded', 'Failed', 'Unchanged'):
+            if key in report['Summary']:
+                summary[key] = summary.get(key, 0) + report['Summary'][key]
+        for action, count in report['Summary']['Alarms'].items():
+            alarm_changes[action] += count
+        for key, value in report['Commands'].items():
+            if key == 'ApiCalls':
+                for operation, count in value.items():
+                    commands['ApiCalls'][operation] = commands['ApiCalls'].get(operation, 0) + count
+            else:
+                commands[key] += value
+        instances.extend(report['Instances'])
+    summary['Alarms'] = alarm_changes
+    
+    metrics.add('Instances', summary['Total'])
+    metrics.add('Unchanged', summary.get('Unchanged', 0))
+    metrics.add('Failed', summary['Failed'])
+    for action, count in alarm_changes.items():
+        metrics.add('Alarms' + action, count)
+    metrics.add('CommandPolls', commands['Polls'])
+    metrics.add('CommandWaitTime', commands['WaitSeconds'], 'Seconds')
+    if 'Targets' in event:
+        metrics.add('Targets', len(reports))
+        metrics.add('FailedTargets', sum(1 for report in reports if report.get('Error')))
+    metrics.emit()
+    response = {'Summary': summary, 'Instances': instances, 'Commands': commands}
+    if 'Targets' in event:
+        response['Targets'] = [{key: value for key, value in report.items() if key != 'Instances'} for report in reports]
+    return response
+
+def onboard_target(target, event, context):
+    onboarding = Onboarding(target, event, context)
+    enter_onboarding(onboarding)
+    report = {'Target': onboarding.name()}
+    try:
+        if event.get('Offboard'):
+            offboard_instances(event['InstanceIds'])
+            print('Offboarding summary :', json.dumps(onboarding.alarm_changes))
+            results = []
+        else:
+            results = onboard_instances(event)
+    except Exception as e:
+        # One unreachable region or account does not fail the others.
+        print('ERROR OCCURED :: Failed to onboard "' + onboarding.name() + '". ' + str(e))
+        report['Error'] = str(e)
+        results = []
+    summary = {'Total': len(results), 'Succeeded': 0, 'Failed': 0}
+    if onboarding.incremental:
+        summary['Unchanged'] = onboarding.unchanged_instances
+    for result in results:
+        if result['Status']=='Success':
+            summary['Succeeded'] += 1
+        else:
+            summary['Failed'] += 1
+    summary['Alarms'] = onboarding.alarm_changes
+    print('Onboarding summary of "' + onboarding.name() + '" :', json.dumps(summary))
+    print('SSM command statistics of "' + onboarding.name() + '" :', json.dumps(onboarding.runner.stats.as_dict()))
+    report.update({'Summary': summary, 'Instances': results, 'Commands': onboarding.runner.stats.as_dict()})
+    return report
+
+def onboard_instances(event):
+    onboarding = current_onboarding()
+    if onboarding.incremental:
+        # Alarms are loaded per instance as it is onboarded, so an incremental sweep only reads the alarms of changed instances.
+        onboarding.existing_alarms = {}
+    elif event['InstanceIds']=='*':
+        onboarding.existing_alarms = load_existing_alarms([ALARM_PREFIX, IO_ALARM_PREFIX])
+    else:
+        onboarding.existing_alarms = load_existing_alarms(alarm_prefixes(event['InstanceIds']))
+    print('Loaded ' + str(len(onboarding.existing_alarms)) + ' existing alarm(s).')
+    workers = onboarding.concurrency
+    print('Onboarding instances with ' + str(workers) + ' worker(s).')
+    results = []
+    with ThreadPoolExecutor(max_workers=workers, initializer=enter_onboarding, initargs=(onboarding,)) as executor:
+        # Instances are submitted as soon as their page is discovered. Bounding the number of queued
+        # tasks keeps memory flat no matter how large the fleet is.
+        pending = {}
+        
+        def drain(return_when):
+            done, _ = wait(list(pending), return_when=return_when)
+            for future in done:
+                if pending.pop(future)=='batch':
+                    for instance, discovery, tiers in future.result():
+                        pending[executor.submit(onboard_instance, instance, discovery, tiers)] = 'instance'
+                else:
+                    results.append(future.result())
+        
+        for batch in batch_instances(discover_instances(event), MAX_BATCH_SIZE):
+            while len(pending) >= 2*workers:
+                drain(FIRST_COMPLETED)
+            pending[executor.submit(discover_disks, batch)] = 'batch'
+        while pending:
+            drain(FIRST_COMPLETED)
+    
+    if event.get('DeleteStaleAlarms', True):
+        with current().span('StaleAlarms'):
+            delete_stale_alarms(results)
+    return results
+
+def onboarding_event(event):
+    # EventBridge events are turned into onboarding requests for the instances they name, anything else is
+    # already a request.
+    detail = event.get('detail', {})
+    if event.get('detail-type')=='EC2 Instance State-change Notification':
+        instance_ids = [detail['instance-id']]
+        if detail.get('state')=='terminated':
+            return {'InstanceIds': instance_ids, 'Offboard': True}
+        return {'InstanceIds': instance_ids, 'Incremental': True}
+    if event.get('detail-type')=='AWS API Call via CloudTrail':
+        # Calls that failed attached nothing.
+        if detail.get('errorCode'):
+            return {'InstanceIds': []}
+        return {'InstanceIds': [detail['requestParameters']['instanceId']], 'Incremental': True}
+    return event
+
+def discover_instances(event):
+    onboarding = current_onboarding()
+    if event['InstanceIds']!='*' and not event['InstanceIds']:
+        # describe_instances without instance ids would describe the whole fleet.
+        return
+    filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
+    for key, values in event.get('Tags', {}).items():
+        filters.append({'Name': 'tag:' + key, 'Values': values if isinstance(values, list) else [values]})
+    platform = event.get('Platform', '').lower()
+    if platform == 'windows':
+        filters.append({'Name': 'platform', 'Values': ['windows']})
+    
     if event['InstanceIds']=='*':
-        reservations = ec2.describe_instances()['Reservations']
-        for reservation in reservations:
-            for instance in reservation['Instances']:
-                initiate_create_alarm(instance)
+        pages = ec2.get_paginator('describe_instances').paginate(
+            Filters=filters,
+            PaginationConfig={'PageSize': 100}
+        )
     else:
-        reservations = ec2.describe_instances(InstanceIds=event['InstanceIds'])['Reservations']
-        for reservation in reservations:
-            for instance in reservation['Instances']:
-                initiate_create_alarm(instance)
+        pages = ec2.get_paginator('describe_instances').paginate(
+            InstanceIds=event['InstanceIds'],
+            Filters=filters
+        )
+    
+    for page in pages:
+        instances = [instance for reservation in page['Reservations'] for instance in reservation['Instances']]
+        # EC2 has no filter matching linux, those are the instances without a platform.
+        if platform == 'linux':
+            instances = [instance for instance in instances if 'Platform' not in instance]
+        if onboarding.incremental:
+            changed = changed_instances(instances)
+            onboarding.unchanged_instances += len(instances) - len(changed)
+            instances = changed
+        if event.get('ManagedOnly', True):
+            managed = find_managed_instances([instance['InstanceId'] for instance in instances])
+            for instance in instances:
+                if instance['InstanceId'] not in managed:
+                    log(instance['InstanceId'], 'Skipping instance, it is not managed by ssm or ssm agent is offline.')
+            instances = [instance for instance in instances if instance['InstanceId'] in managed]
+        for instance in instances:
+            yield instance
+
+def find_managed_instances(instance_ids):
+    managed = set()
+    for i in range(0, len(instance_ids), 50):
+        pages = ssm.get_paginator('describe_instance_information').paginate(
+            Filters=[
+                {'Key': 'InstanceIds', 'Values': instance_ids[i:i+50]},
+                {'Key': 'PingStatus', 'Values': ['Online']}
+            ]
+        )
+        for page in pages:
+            managed.update(info['InstanceId'] for info in page['InstanceInformationList'])
+    return managed
+
+def changed_instances(instances):
+    # Instances whose record matches what describe_instances returns now were onboarded with the same volumes
+    # and settings, they are skipped before any ssm or cloudwatch call is made.
+    records = store.get_many([onboarding_key(instance['InstanceId']) for instance in instances])
+    changed = []
+    for instance in instances:
+        record = records.get(onboarding_key(instance['InstanceId']))
+        if record!=None and record['Fingerprint']==instance_fingerprint(instance):
+            continue
+        changed.append(instance)
+    if len(changed) < len(instances):
+        print('Skipping ' + str(len(instances) - len(changed)) + ' unchanged instance(s).')
+    return changed
+
+def onboarding_key(instance_id):
+    return 'onboarded:' + instance_id
+
+def attached_volumes(instance):
+    return sorted(mapping['Ebs']['VolumeId'] for mapping in instance.get('BlockDeviceMappings', []) if 'Ebs' in mapping)
+
+def instance_fingerprint(instance):
+    # Everything the alarms of an instance are derived from that is known before its disks are inventoried.
+    # Mount changes on the same volumes are picked up when the record expires.
+    platform = instance.get('Platform', 'linux')
+    fingerprint = {
+        'Platform': platform,
+        'Volumes': attached_volumes(instance),
+        'Threshold': threshold,
+        'Topic': current_onboarding().topic_arn,
+        'IoAlarms': [io_alarms_enabled, queue_length_threshold, burst_balance_threshold, io_evaluation_periods],
+        'Monitoring': [high_resolution_monitoring, hot_growth_rate, hot_growth_hours, resource_tags(instance).get(MONITORING_TAG)],
+        'AgentConfig': load_agent_config('/CWAgent/' + platform.capitalize() + '/Disk')
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def record_onboarding(instance, disks, result):
+    covered = {disk.volume_id or (disk.disk and volume_id_from_block_device_mappings(instance.get('BlockDeviceMappings', []), disk.disk)) for disk in disks}
+    # When the volume of a disk is unknown there is no telling which attached volume has no alarm.
+    uncovered = None not in covered and [volume_id for volume_id in attached_volumes(instance) if volume_id not in covered]
+    store.put(
+        onboarding_key(instance['InstanceId']),
+        {'Fingerprint': instance_fingerprint(instance), 'Alarms': result['Alarms'], 'OnboardedAt': time.time()},
+        recheck_seconds if uncovered else resync_seconds
+    )
+
+def offboard_instances(instance_ids):
+    alarm_names = sorted(load_existing_alarms(alarm_prefixes(instance_ids)))
+    delete_alarms(alarm_names)
+    for instance_id in instance_ids:
+        log(instance_id, 'Instance terminated, deleted ' + str(len(alarm_names)) + ' alarm(s).')
+        store.delete(onboarding_key(instance_id))
+
+def batch_instances(instances, size):
+    batches = {}
+    for instance in instances:
+        platform = instance.get('Platform', 'linux')
+        batch = batches.setdefault(platform, [])
+        batch.append(instance)
+        if len(batch) == size:
+            yield batches.pop(platform)
+    for batch in batches.values():
+        yield batch
+
+def discover_disks(instances):
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    platform = instances[0].get('Platform', 'linux')
+    inventories = {}
+    try:
+        print('Extracting disk inventory - {device, fstype, mount, volume} from ' + str(len(instance_ids)) + ' instance(s).')
+        document = 'AWS-RunPowerShellScript' if platform == 'windows' else 'AWS-RunShellScript'
+        with current().span('Inventory'):
+            results = send_ssm_command_batch(instance_ids, document, inventory_commands(platform))
+        for instance_id, result in results.items():
+            if result['Status']!='Success':
+                continue
+            try:
+                inventories[instance_id] = parse_inventory(platform, result['StandardOutputContent'])
+            except (ValueError, KeyError, TypeError) as e:
+                log(instance_id, 'Failed to parse disk inventory. ' + str(e))
+    except Exception as e:
+        print('ERROR OCCURED :: ' + str(e))
+    tiers = {}
+    if high_resolution_monitoring == 'yes':
+        try:
+            with current().span('MonitoringTiers'):
+                tiers = monitoring_tiers([(instance, inventories.get(instance['InstanceId'])) for instance in instances])
+        except Exception as e:
+            # The disks stay at the standard tier.
+            print('ERROR OCCURED :: Failed to find hot volumes. ' + str(e))
+    return [(instance, inventories.get(instance['InstanceId']), tiers.get(instance['InstanceId'])) for instance in instances]
+
+def monitoring_tiers(discoveries):
+    # Tier of every disk by instance and mountpoint. Disks without a tag are hot when their usage grew fast,
+    # the growth of every disk of the batch is read with one get_metric_data call.
+    tagged = tagged_volume_tiers()
+    tiers = {}
+    untagged = []
+    for instance, disks in discoveries:
+        platform = instance.get('Platform', 'linux')
+        instance_tier = resource_tags(instance).get(MONITORING_TAG)
+        for disk in disks or []:
+            metric_name, dimensions, volume_id = disk_metric(instance, platform, disk)
+            tier = tagged.get(volume_id) or instance_tier
+            if tier in MONITORING_TIERS:
+                tiers.setdefault(instance['InstanceId'], {})[disk.mountpoint] = tier
+            else:
+                untagged.append((instance['InstanceId'], disk.mountpoint, {'Namespace': 'CWAgent', 'MetricName': metric_name, 'Dimensions': dimensions}))
+    rates = observed_growth([metric for _, _, metric in untagged])
+    for (instance_id, mountpoint, _), rate in zip(untagged, rates):
+        tiers.setdefault(instance_id, {})[mountpoint] = 'high-resolution' if rate >= hot_growth_rate else 'standard'
+    return tiers
+
+def tagged_volume_tiers():
+    # Tagged volumes are few, they are read once per run with a single paginated call.
+    onboarding = current_onboarding()
+    with onboarding.lock:
+        if onboarding.volume_tiers is None:
+            onboarding.volume_tiers = {}
+            pages = ec2.get_paginator('describe_volumes').paginate(Filters=[{'Name': 'tag-key', 'Values': [MONITORING_TAG]}])
+            for page in pages:
+                for volume in page['Volumes']:
+                    onboarding.volume_tiers[volume['VolumeId']] = resource_tags(volume).get(MONITORING_TAG)
+        return onboarding.volume_tiers
+
+def observed_growth(metrics):
+    # Least squares growth of used space in percent points per hour over the last hot_growth_hours, 0 for
+    # disks without data, e.g. the ones onboarded for the first time. With a size of 100 GB the growth in
+    # GB per hour is the growth in percent points.
+    histories = fetch_usage_history(cw, metrics, hot_growth_hours)
+    return [growth_rate(history[0], history[1], 100) if history else 0.0 for history in histories]
+
+def resource_tags(resource):
+    return {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
+
+def disk_metric(instance, platform, disk):
+    # The agent metric of a disk, which its alarm watches, and the volume of the disk.
+    dimensions=[{'Name': 'InstanceId','Value': instance['InstanceId']}]
+    if platform == 'linux':
+        dimensions.append({'Name':'device','Value':disk.device})
+        dimensions.append({'Name':'fstype','Value':disk.fstype})
+        dimensions.append({'Name':'path','Value':disk.mountpoint})
+        volume_id = disk.volume_id or (disk.disk and volume_id_from_block_device_mappings(instance.get('BlockDeviceMappings', []), disk.disk))
+        return 'disk_used_percent', dimensions, volume_id
+    dimensions.append({'Name':'instance','Value':disk.mountpoint})
+    dimensions.append({'Name':'objectname','Value':'LogicalDisk'})
+    return 'LogicalDisk % Free Space', dimensions, disk.volume_id
+
+def onboard_instance(instance, disks, tiers=None):
+    # One metrics record per instance, api calls made while onboarding it are counted on it.
+    record = MetricsRecord(
+        {'Function': function_name, 'Platform': instance.get('Platform', 'linux')},
+        {'InstanceId': instance['InstanceId']}
+    )
+    with record.active(), record.span('Onboard'):
+        try:
+            if current_onboarding().incremental:
+                current_onboarding().existing_alarms.update(load_existing_alarms(alarm_prefixes([instance['InstanceId']])))
+            result = initiate_create_alarm(instance, disks, tiers)
+            if result['Status']=='Success':
+                record_onboarding(instance, disks, result)
+        except Exception as e:
+            log(instance['InstanceId'], 'ERROR OCCURED :: ' + str(e))
+            result = onboarding_result(instance['InstanceId'], 'Failed', str(e))
+    record.add('Disks', len(disks or []))
+    record.add('HighResolutionDisks', sum(1 for tier in (tiers or {}).values() if tier == 'high-resolution'))
+    record.add('Failed', 0 if result['Status']=='Success' else 1)
+    record.put_property('Outcome', result['Status'])
+    record.put_property('Reason', result['Reason'])
+    record.emit()
+    return result
+
+def onboarding_result(instance_id, status, reason='', alarms=None):
+    return {'InstanceId': instance_id, 'Status': status, 'Reason': reason, 'Alarms': alarms or []}
+
+def log(instance_id, *message):
+    # Build the whole line first, print is not atomic across worker threads.
+    print(' '.join(['[' + instance_id + ']'] + [str(part) for part in message]))
         
-def initiate_create_alarm(instance):
-    print('===================================================================================================')
+def initiate_create_alarm(instance, disks, tiers=None):
     instance_id = instance['InstanceId']
-    print('Initiating EBS scaling on "' + instance_id + '".')
+    log(instance_id, 'Initiating EBS scaling on "' + instance_id + '".')
     platform='linux'
     try:
         platform = instance['Platform']
     except:
         pass
-    print('Platform detected - ' + platform)
-    print('Loading cloudwatch agent configuration file.')
-    try:
-        parameter = json.loads(ssm.get_parameter(
-            Name='/CWAgent/'+ platform.capitalize() +'/Disk'
-        )['Parameter']['Value'])
-    except botocore.exceptions.ClientError as e:
-        print('ERROR OCCURED :: ' + e.response['Error']['Message'])
+    log(instance_id, 'Platform detected - ' + platform)
+    if not disks:
+        log(instance_id, 'Failed to extract disk inventory.')
+        return onboarding_result(instance_id, 'Failed', 'Failed to extract disk inventory.')
+    mountpoints = [disk.mountpoint for disk in disks]
+    log(instance_id, 'Mountpoints extracted :', mountpoints)
+    # The agent collects every disk of the instance at the same interval, the fastest tier any of them needs.
+    tiers = tiers or {}
+    agent_tier = 'high-resolution' if 'high-resolution' in tiers.values() else 'standard'
+    if agent_tier == 'high-resolution':
+        log(instance_id, 'High resolution monitoring for :', sorted(mountpoint for mountpoint, tier in tiers.items() if tier == 'high-resolution'))
     
-    print('Extracting EBS mount points.')   
-    if platform == 'linux':
-        parameters = {'commands': ["lsblk -o name,fstype,mountpoint| grep 'ext4\|xfs' | awk '{print $3}'"]}
-        result = send_ssm_command(instance_id,'AWS-RunShellScript',parameters)
-        mountpoints = result['StandardOutputContent'].split('\n')[:-1]
-        if result['Status']=='Success' and len(mountpoints)!=0:
-            print('Mountpoints extracted :', mountpoints)
-            parameter['metrics']['metrics_collected']['disk']['resources'] = mountpoints
-        else:
-            print('Failed to extract mountpoints.')
-            return
-    else:
-        parameters = {'commands': ["Get-Partition | Select-Object -ExpandProperty DriveLetter"]}
-        result = send_ssm_command(instance_id,'AWS-RunPowerShellScript',parameters)
-        mountpoints = result['StandardOutputContent'].replace("\r", ":").split('\n')[:-1]
-        if result['Status']=='Success' and len(mountpoints)!=0:
-            print('Mountpoints extracted :',mountpoints)
-            parameter['metrics']['metrics_collected']['LogicalDisk']['resources'] = mountpoints
-        else:
-            print('Failed to extract mountpoints.')
-            return
-        
-    print('Updating cloudwatch agent configuration file.')
-    try:   
-        response = ssm.put_parameter(
-            Name='/CWAgent/' + platform.capitalize() + '/Disk',
-            Value=json.dumps(parameter),
-            Type='String',
-            Overwrite=True,
-            DataType='text'
-        )
+    log(instance_id, 'Loading cloudwatch agent configuration file.')
+    try:
+        with current().span('AgentConfig'):
+            configuration_location = agent_config_parameter(platform, mountpoints, agent_tier)
     except botocore.exceptions.ClientError as e:
-        print('ERROR OCCURED :: ' + e.response['Error']['Message'])
+        log(instance_id, 'ERROR OCCURED :: ' + e.response['Error']['Message'])
+        return onboarding_result(instance_id, 'Failed', 'Failed to load cloudwatch agent configuration file.')
+    log(instance_id, 'CloudWatch agent configuration file - ' + configuration_location)
             
-    print('Installing and configuring CloudWatch agent on "' + instance_id +'".')
-    parameters = {'configurationLocation': ['/CWAgent/' + platform.capitalize() + '/Disk']}
-    result = send_ssm_command(instance_id,'CloudWatchAgent-Installation',parameters)
-    if result['Status']=='Success':
-        print('CloudWatch agent successfully installed.')
+    fingerprint = configuration_location.split('/')[-1]
+    tags = resource_tags(instance)
+    if tags.get(AGENT_CONFIG_TAG)==fingerprint and not current_onboarding().force_agent_install:
+        log(instance_id, 'CloudWatch agent is already configured with this configuration, skipping installation.')
     else:
-        print('Failed to install CloudWatch agent.')
-        return
-    
-    if platform == 'linux': 
-        print('Extracting disk metadata - {device, fstype, mount} from "'+ instance_id +'".')
-        parameters={'commands': ["lsblk -i -o name,fstype,mountpoint|grep 'ext4\|xfs'|sed 's/|-//g' | sed 's/`-//g'|awk -v OFS='\t' '{ print $1,$2,$3}'"]}
-        result = send_ssm_command(instance_id, 'AWS-RunShellScript',parameters)
+        log(instance_id, 'Installing and configuring CloudWatch agent on "' + instance_id +'".')
+        parameters = {'configurationLocation': [configuration_location]}
+        with current().span('AgentInstall'):
+            result = send_ssm_command(instance_id,'CloudWatchAgent',parameters)
         if result['Status']=='Success':
-            print('Metadata successfully extracted.')
-            print('Creating CloudWatch alarms on disk utilisation metrics to inititate scale-up automation.')
-            i=1
-            for disk in result['StandardOutputContent'].split('\n')[:-1]:
-                dimensions=[{'Name': 'InstanceId','Value': instance_id}]
-                disk_attributes = disk.split('\t')
-                dimensions.append({'Name':'device','Value':disk_attributes[0]})
-                dimensions.append({'Name':'fstype','Value':disk_attributes[1]})
-                dimensions.append({'Name':'path','Value':disk_attributes[2]})
-                print('Disk ' + str(i) + ' : {'+disk_attributes[0]+','+disk_attributes[1]+','+disk_attributes[2]+'}')
-                i+=1
-                create_alarm(instance_id,'disk_used_percent',dimensions,disk_attributes[0],threshold,"GreaterThanThreshold")
+            log(instance_id, 'CloudWatch agent successfully installed.')
         else:
-            print('Failed to extract metadata.')
-            return
-    else:
-        print('Creating CloudWatch alarms on disk utilisation metrics to inititate scale-up automation.')
-        dimensions={}
-        i=1
-        for mountpoint in parameter['metrics']['metrics_collected']['LogicalDisk']['resources']:
-            dimensions=[{'Name':'InstanceId','Value':instance_id}]
-            dimensions.append({'Name':'instance','Value':mountpoint})
-            dimensions.append({'Name':'objectname','Value':'LogicalDisk'})
-            print('Disk ' + str(i) + ' : {'+mountpoint+'}')
+            log(instance_id, 'Failed to install CloudWatch agent.')
+            return onboarding_result(instance_id, 'Failed', 'Failed to install CloudWatch agent.')
+        try:
+            ec2.create_tags(
+                Resources=[instance_id],
+                Tags=[{'Key': AGENT_CONFIG_TAG, 'Value': fingerprint}]
+            )
+        except botocore.exceptions.ClientError as e:
+            # Only the next run is affected, it installs the agent again.
+            log(instance_id, 'Failed to tag instance with agent configuration. ' + e.response['Error']['Message'])
+    
+    log(instance_id, 'Creating CloudWatch alarms on disk utilisation metrics to inititate scale-up automation.')
+    alarms = []
+    volume_ids = []
+    i=1
+    with current().span('Alarms'):
+        for disk in disks:
+            metric_name, dimensions, volume_id = disk_metric(instance, platform, disk)
+            period = MONITORING_TIERS[tiers.get(disk.mountpoint, 'standard')]
+            if platform == 'linux':
+                log(instance_id, 'Disk ' + str(i) + ' : {'+disk.device+','+disk.fstype+','+disk.mountpoint+','+str(volume_id)+'}')
+                alarms.append(create_alarm(instance_id,metric_name,dimensions,disk.device,threshold,"GreaterThanThreshold",volume_id,period=period))
+            else:
+                log(instance_id, 'Disk ' + str(i) + ' : {'+disk.mountpoint+','+str(volume_id)+'}')
+                alarms.append(create_alarm(instance_id,metric_name,dimensions,disk.mountpoint,100-threshold,"LessThanThreshold",volume_id,period=period))
+            volume_ids.append(volume_id)
             i+=1
-            create_alarm(instance_id,'LogicalDisk % Free Space',dimensions,mountpoint,100-threshold,"LessThanThreshold")
+        if io_alarms_enabled == 'yes':
+            alarms.extend(create_io_alarms(instance_id, sorted(set(volume_id for volume_id in volume_ids if volume_id))))
+    
+    return onboarding_result(instance_id, 'Success', alarms=alarms)
 
-def send_ssm_command(instance_id, document, parameters):
+def create_io_alarms(instance_id, volume_ids):
+    # EBS publishes these for every volume, so no agent configuration is needed and windows is covered as well.
+    alarms = []
+    if not volume_ids:
+        return alarms
     try:
-        response = ssm.send_command(
-            InstanceIds=[instance_id],
-            DocumentName=document,
-            Parameters=parameters
+        volumes = ec2.describe_volumes(VolumeIds=volume_ids)['Volumes']
+    except botocore.exceptions.ClientError as e:
+        log(instance_id, 'Failed to describe volumes, skipping I/O alarms. ' + e.response['Error']['Message'])
+        return alarms
+    for volume in volumes:
+        volume_id = volume['VolumeId']
+        # scale-ebs-function can only raise provisioned performance of gp2 (by converting it), gp3, io1 and io2
+        # volumes below their limits, alarms on any other volume would only end in failed scaling jobs.
+        if performance_boost(volume) == None:
+            log(instance_id, 'Volume : {'+volume_id+','+volume['VolumeType']+'} has no provisioned performance that can be raised, skipping I/O alarms.')
+            continue
+        dimensions = [{'Name': 'VolumeId', 'Value': volume_id}]
+        log(instance_id, 'Volume : {'+volume_id+','+volume['VolumeType']+'}')
+        alarms.append(create_alarm(
+            instance_id,'VolumeQueueLength',dimensions,volume_id+':VolumeQueueLength',queue_length_threshold,"GreaterThanThreshold",volume_id,
+            namespace='AWS/EBS',evaluation_periods=io_evaluation_periods,prefix=IO_ALARM_PREFIX,scale_mode='performance'
+        ))
+        if volume['VolumeType'] in BURST_VOLUME_TYPES:
+            alarms.append(create_alarm(
+                instance_id,'BurstBalance',dimensions,volume_id+':BurstBalance',burst_balance_threshold,"LessThanThreshold",volume_id,
+                namespace='AWS/EBS',evaluation_periods=io_evaluation_periods,prefix=IO_ALARM_PREFIX,scale_mode='performance'
+            ))
+    return alarms
+
+def agent_config_parameter(platform, mountpoints, tier='standard'):
+    # Every disk layout gets its own parameter named after the hash of its content, so concurrent onboardings
+    # never overwrite each other and hosts with the same layout share one parameter that is written once.
+    base = '/CWAgent/' + platform.capitalize() + '/Disk'
+    config = load_agent_config(base)
+    resources = sorted(set(mountpoints))
+    disk_metrics = config['metrics']['metrics_collected']['disk' if platform == 'linux' else 'LogicalDisk']
+    disk_metrics['resources'] = resources
+    if tier != 'standard':
+        # Metrics collected more often than every 60 seconds are published at high resolution, they are
+        # buffered for 60 seconds unless flushed as often as they are collected. Standard layouts keep the
+        # template as it is.
+        disk_metrics['metrics_collection_interval'] = MONITORING_TIERS[tier]
+        config['metrics']['force_flush_interval'] = MONITORING_TIERS[tier]
+    value = json.dumps(config, sort_keys=True, separators=(',', ':'))
+    name = base + '/' + hashlib.sha256(value.encode('utf-8')).hexdigest()[:16]
+    
+    onboarding = current_onboarding()
+    with onboarding.lock:
+        if base not in onboarding.agent_config_parameters:
+            onboarding.agent_config_parameters[base] = set()
+            pages = ssm.get_paginator('get_parameters_by_path').paginate(Path=base, Recursive=False)
+            for page in pages:
+                onboarding.agent_config_parameters[base].update(parameter['Name'] for parameter in page['Parameters'])
+        if name in onboarding.agent_config_parameters[base]:
+            return name
+    try:
+        ssm.put_parameter(
+            Name=name,
+            Value=value,
+            Type='String',
+            Overwrite=False,
+            DataType='text'
         )
-        while True:
-            time.sleep(1)
-            result = ssm.list_commands(
-                CommandId=response['Command']['CommandId'],
-                InstanceId=instance_id
-            )['Commands'][0]
-            if result['Status']=='InProgress' or result['Status']=='Pending':
-                pass
-            elif result['Status']=='Success':
-                if document!='CloudWatchAgent':
-                    result = ssm.get_command_invocation(
-                        CommandId=response['Command']['CommandId'],
-                        InstanceId=instance_id
-                    )
-                return result
-            else:
-                return result
-    except:
-        print('Failed to send command. Make sure ssm agent is installed on instance and appropriate role is attached to ec2 instance.')
-        return {'Status':'Failed', 'StandardOutputContent':''}
+    except botocore.exceptions.ClientError as e:
+        # Another onboarding wrote the same layout first, the content is identical.
+        if e.response['Error']['Code']!='ParameterAlreadyExists':
+            raise
+    with onboarding.lock:
+        onboarding.agent_config_parameters[base].add(name)
+    return name
+
+def load_agent_config(base):
+    # The stack owned parameter is the template every layout is derived from, it is read once per run.
+    onboarding = current_onboarding()
+    with onboarding.lock:
+        if base not in onboarding.agent_config_templates:
+            onboarding.agent_config_templates[base] = ssm.get_parameter(Name=base)['Parameter']['Value']
+        config = json.loads(onboarding.agent_config_templates[base])
+    # The files under ssm/ hold the configuration as a json encoded string and the stack stores them as they are.
+    if isinstance(config, str):
+        config = json.loads(config)
+    return config
+
+def send_ssm_command(instance_id, document, parameters):
+    result = current_onboarding().runner.send(instance_id, document, parameters)
+    if result['Status']!='Success':
+        log(instance_id, 'Command ended with status "' + result['Status'] + '". ' + result['Error'])
+    return result
+
+def send_ssm_command_batch(instance_ids, document, parameters):
+    results = current_onboarding().runner.send_batch(instance_ids, document, parameters)
+    for instance_id, result in results.items():
+        if result['Status']!='Success':
+            log(instance_id, 'Command ended with status "' + result['Status'] + '". ' + result['Error'])
+    return results
         
-def create_alarm(instance_id,metric_name,dimensions,volume,threshold,comparison):
-    print('Creating "'+'ebs-utilisation-exceeded-alarm:'+instance_id+':'+volume+'" CloudWatch alarm.')
-    cw.put_metric_alarm(
+def load_existing_alarms(prefixes):
+    alarms = {}
+    for prefix in prefixes:
+        pages = cw.get_paginator('describe_alarms').paginate(
+            AlarmNamePrefix=prefix,
+            AlarmTypes=['MetricAlarm']
+        )
+        for page in pages:
+            for alarm in page['MetricAlarms']:
+                alarms[alarm['AlarmName']] = alarm_settings(alarm)
+    return alarms
+
+def alarm_prefixes(instance_ids):
+    return [prefix + instance_id + ':' for prefix in (ALARM_PREFIX, IO_ALARM_PREFIX) for instance_id in instance_ids]
+
+def alarm_settings(alarm):
+    # The part of an alarm onboarding manages, normalised so desired and existing alarms compare equal.
+    settings = {field: alarm.get(field) for field in ALARM_FIELDS}
+    settings['AlarmActions'] = sorted(alarm.get('AlarmActions', []))
+    settings['Dimensions'] = sorted((dimension['Name'], dimension['Value']) for dimension in alarm.get('Dimensions', []))
+    settings['Threshold'] = float(alarm['Threshold'])
+    settings['AlarmDescription'] = alarm.get('AlarmDescription') or ''
+    return settings
+
+def count_alarm_change(action):
+    onboarding = current_onboarding()
+    with onboarding.lock:
+        onboarding.alarm_changes[action] += 1
+
+def delete_stale_alarms(results):
+    onboarded = {result['InstanceId'] for result in results if result['Status']=='Success'}
+    desired = {alarm_name for result in results for alarm_name in result['Alarms']}
+    stale = []
+    unknown = {}
+    for alarm_name in current_onboarding().existing_alarms:
+        instance_id = alarm_name.split(':')[1]
+        if instance_id in onboarded:
+            # The disk is no longer mounted on an instance that has just been onboarded.
+            if alarm_name not in desired:
+                stale.append(alarm_name)
+        else:
+            unknown.setdefault(instance_id, []).append(alarm_name)
+    
+    # Alarms of instances that were not onboarded are only removed once the instance is gone.
+    instance_ids = list(unknown)
+    for i in range(0, len(instance_ids), 200):
+        alive = set()
+        pages = ec2.get_paginator('describe_instances').paginate(
+            Filters=[
+                {'Name': 'instance-id', 'Values': instance_ids[i:i+200]},
+                {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
+            ]
+        )
+        for page in pages:
+            alive.update(instance['InstanceId'] for reservation in page['Reservations'] for instance in reservation['Instances'])
+        for instance_id in instance_ids[i:i+200]:
+            if instance_id not in alive:
+                stale.extend(unknown[instance_id])
+    
+    delete_alarms(stale)
+
+def delete_alarms(alarm_names):
+    for i in range(0, len(alarm_names), 100):
+        print('Deleting stale alarms :', alarm_names[i:i+100])
+        cw.delete_alarms(AlarmNames=alarm_names[i:i+100])
+    current_onboarding().alarm_changes['Deleted'] += len(alarm_names)
+
+def create_alarm(instance_id,metric_name,dimensions,volume,threshold,comparison,volume_id=None,
+                 namespace='CWAgent',evaluation_periods=1,prefix=ALARM_PREFIX,scale_mode=None,period=60):
+    alarm_name = prefix+instance_id+':'+volume
+    # scale-ebs-function reads the volume id back from the alarm notification and skips discovery.
+    description = {'VolumeId': volume_id} if volume_id else {}
+    if scale_mode:
+        description['ScaleMode'] = scale_mode
+    alarm = dict(
         AlarmActions=[
-            ebs_utilisation_topic_arn,
+            current_onboarding().topic_arn,
         ],
+        AlarmDescription=json.dumps(description) if description else '',
         ComparisonOperator=comparison,
-        EvaluationPeriods=1,
-        DatapointsToAlarm=1,
+        EvaluationPeriods=evaluation_periods,
+        DatapointsToAlarm=evaluation_periods,
         Threshold=threshold,
-        AlarmName='ebs-utilisation-exceeded-alarm:'+instance_id+':'+volume,
+        AlarmName=alarm_name,
         MetricName=metric_name,
-        Namespace='CWAgent',
+        Namespace=namespace,
         Statistic='Average',
         Dimensions=dimensions,
-        Period=60,
+        # 10 and 30 seconds make a high resolution alarm.
+        Period=period,
     )
-    print('Alarm created successfully.')
\ No newline at end of file
+    existing = current_onboarding().existing_alarms.get(alarm_name)
+    if existing == alarm_settings(alarm):
+        log(instance_id, '"'+alarm_name+'" CloudWatch alarm is up to date.')
+        count_alarm_change('Unchanged')
+        return alarm_name
+    log(instance_id, ('Creating "' if existing == None else 'Updating "')+alarm_name+'" CloudWatch alarm.')
+    cw.put_metric_alarm(**alarm)
+    count_alarm_change('Created' if existing == None else 'Updated')
+    log(instance_id, 'Alarm created successfully.')
+    return alarm_name
+
+init_seconds = time.time() - init_started
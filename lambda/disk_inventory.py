@@ -0,0 +1,124 @@
+import collections
+import json
+import re
+
+SUPPORTED_FILE_SYSTEMS = ('ext4', 'xfs')
+
+# One command per host collects everything onboarding needs, the output is parsed once into Disk tuples.
+LINUX_INVENTORY_COMMANDS = [
+    "lsblk -J -o NAME,PKNAME,TYPE,FSTYPE,MOUNTPOINT,SERIAL"
+]
+WINDOWS_INVENTORY_COMMANDS = [
+    "$partitions = Get-Partition | Where-Object { [string]$_.DriveLetter -match '^[A-Za-z]$' }",
+    "$inventory = foreach ($p in $partitions) { $d = Get-Disk -Number $p.DiskNumber; "
+    "[pscustomobject]@{DriveLetter=[string]$p.DriveLetter; DiskNumber=$p.DiskNumber; "
+    "PartitionNumber=$p.PartitionNumber; SerialNumber=[string]$d.SerialNumber; FileSystem=[string]($p | Get-Volume).FileSystem} }",
+    "ConvertTo-Json -Compress -InputObject @($inventory)"
+]
+
+# device     - block device holding the file system, e.g. nvme1n1p1 or xvda1 (linux)
+# disk       - whole disk the device belongs to, e.g. nvme1n1 or xvda (linux)
+# partition  - partition number on the disk, empty when the file system spans the whole disk
+# mountpoint - mount path on linux, drive like "C:" on windows
+# volume_id  - EBS volume id when it can be read from the disk serial (nvme), otherwise None
+Disk = collections.namedtuple(
+    'Disk',
+    ['device', 'disk', 'partition', 'fstype', 'mountpoint', 'serial', 'volume_id', 'disk_number', 'drive']
+)
+
+
+def inventory_commands(platform):
+    if platform == 'windows':
+        return {'commands': WINDOWS_INVENTORY_COMMANDS}
+    return {'commands': LINUX_INVENTORY_COMMANDS}
+
+
+def parse_inventory(platform, output):
+    # Raises ValueError when the output is not the expected json.
+    if platform == 'windows':
+        return parse_windows_inventory(output)
+    return parse_linux_inventory(output)
+
+
+def parse_linux_inventory(output):
+    disks = []
+    for device in json.loads(output)['blockdevices']:
+        _walk_linux_device(device, None, disks)
+    return disks
+
+
+def _walk_linux_device(device, parent, disks):
+    name = device.get('name') or ''
+    serial = (device.get('serial') or '').strip()
+    if not serial and parent is not None:
+        serial = parent['serial']
+    disk_name = device.get('pkname') or (parent['name'] if parent is not None else name)
+
+    if device.get('fstype') in SUPPORTED_FILE_SYSTEMS and device.get('mountpoint'):
+        partition = ''
+        if device.get('type') == 'part' and name.startswith(disk_name):
+            partition = name[len(disk_name):].lstrip('p')
+        disks.append(Disk(
+            device=name,
+            disk=disk_name,
+            partition=partition,
+            fstype=device['fstype'],
+            mountpoint=device['mountpoint'],
+            serial=serial,
+            volume_id=volume_id_from_serial(serial),
+            disk_number=None,
+            drive=None
+        ))
+
+    for child in device.get('children', []):
+        _walk_linux_device(child, {'name': name, 'serial': serial}, disks)
+
+
+def parse_windows_inventory(output):
+    partitions = json.loads(output)
+    # ConvertTo-Json returns a bare object instead of a list when there is only one partition.
+    if isinstance(partitions, dict):
+        partitions = [partitions]
+    disks = []
+    for partition in partitions:
+        # Recovery and reserved partitions have no drive letter, there is nothing to alarm on.
+        drive = (partition.get('DriveLetter') or '').strip().upper()
+        if not re.match(r'^[A-Z]$', drive):
+            continue
+        serial = (partition.get('SerialNumber') or '').strip()
+        disks.append(Disk(
+            device=None,
+            disk=None,
+            partition=str(partition.get('PartitionNumber', '')),
+            fstype=partition.get('FileSystem') or '',
+            mountpoint=drive + ':',
+            serial=serial,
+            volume_id=volume_id_from_serial(serial.split('_')[0]),
+            disk_number=partition.get('DiskNumber'),
+            drive=drive
+        ))
+    return disks
+
+
+def volume_id_from_serial(serial):
+    # EBS exposes the volume id without its dash as the nvme serial, e.g. vol0123456789abcdef0.
+    match = re.match(r'^vol-?([0-9a-f]{8,17})$', serial or '')
+    if match is None:
+        return None
+    return 'vol-' + match.group(1)
+
+
+def volume_id_from_block_device_mappings(mappings, disk_name):
+    # Xen instances expose xvdX or sdX, the block device mapping may name the same device either way.
+    if disk_name.startswith('xvd'):
+        letter = disk_name[3:]
+    elif disk_name.startswith('sd'):
+        letter = disk_name[2:]
+    else:
+        return None
+    for mapping in mappings:
+        # The root device is often mapped as a partition, e.g. /dev/sda1.
+        device_name = re.sub(r'[0-9]+$', '', mapping['DeviceName'].replace('/dev/', ''))
+        if device_name in ('xvd' + letter, 'sd' + letter) and 'Ebs' in mapping:
+            return mapping['Ebs']['VolumeId']
+    return None
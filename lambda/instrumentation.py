@@ -0,0 +1,143 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Timing spans and api call counters written to the log as CloudWatch Embedded Metric Format, CloudWatch
+# extracts the metrics from the log lines so no PutMetricData calls are needed. Instance and volume ids
+# are written as properties instead of dimensions, they can be queried in Logs Insights without creating
+# a custom metric per volume.
+
+NAMESPACE = os.getenv('METRICS_NAMESPACE', 'EBSScaleUpAutomation')
+
+_local = threading.local()
+
+
+class MetricsRecord:
+
+    def __init__(self, dimensions, properties=None):
+        # Dimensions are rolled up in order, e.g. {Function, Platform} is published by Function and by
+        # Function and Platform.
+        self.lock = threading.Lock()
+        self.dimensions = dict(dimensions)
+        self.properties = dict(properties or {})
+        self.metrics = {}
+
+    def add(self, name, value=1, unit='Count'):
+        with self.lock:
+            if name in self.metrics:
+                self.metrics[name][0] += value
+            else:
+                self.metrics[name] = [value, unit]
+
+    def put_property(self, name, value):
+        with self.lock:
+            self.properties[name] = value
+
+    def count_operation(self, operation):
+        with self.lock:
+            operations = self.properties.setdefault('Operations', {})
+            operations[operation] = operations.get(operation, 0) + 1
+
+    @contextlib.contextmanager
+    def span(self, name):
+        # Adds the elapsed time of the block as <name>Time in milliseconds, also when the block raises.
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name + 'Time', (time.time() - start)*1000, 'Milliseconds')
+
+    @contextlib.contextmanager
+    def active(self):
+        # Api calls made by this thread inside the block are counted on this record as well.
+        previous = getattr(_local, 'record', None)
+        _local.record = self
+        try:
+            yield self
+        finally:
+            _local.record = previous
+
+    def emit(self):
+        with self.lock:
+            metrics = {name: list(value) for name, value in self.metrics.items()}
+            document = dict(self.properties)
+        keys = list(self.dimensions)
+        document.update(self.dimensions)
+        document['_aws'] = {
+            'Timestamp': int(time.time()*1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [keys[:i] for i in range(1, len(keys) + 1)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+            }]
+        }
+        for name, (value, _) in metrics.items():
+            document[name] = round(value, 3) if isinstance(value, float) else value
+        print(json.dumps(document, default=str))
+
+
+def start_invocation(function_name):
+    # The record every api call of the invocation is counted on, whichever thread makes it.
+    global _invocation
+    _invocation = MetricsRecord({'Function': function_name})
+    return _invocation
+
+
+_invocation = MetricsRecord({'Function': os.getenv('AWS_LAMBDA_FUNCTION_NAME', 'local')})
+
+
+def current():
+    # The record activated by this thread, the invocation record otherwise.
+    return getattr(_local, 'record', None) or _invocation
+
+
+def instrument(*clients):
+    # Clients without an event system, like the fakes of the benchmark, are left as they are.
+    for client in clients:
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            continue
+        events.register('before-call', _before_call)
+        events.register('after-call', _after_call)
+        events.register('after-call-error', _after_call_error)
+
+
+def _records():
+    record = getattr(_local, 'record', None)
+    if record is None or record is _invocation:
+        return [_invocation]
+    return [_invocation, record]
+
+
+def _before_call(context, **kwargs):
+    context['instrumentation_start'] = time.time()
+
+
+def _after_call(event_name, context, parsed=None, **kwargs):
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    code = (parsed or {}).get('Error', {}).get('Code')
+    _count_call(event_name, context, retries, code)
+
+
+def _after_call_error(event_name, context=None, exception=None, **kwargs):
+    # Emitted for connection errors and timeouts, without the operation model.
+    _count_call(event_name, context or {}, 0, type(exception).__name__)
+
+
+def _count_call(event_name, context, retries, code):
+    start = context.pop('instrumentation_start', None)
+    elapsed = (time.time() - start)*1000 if start is not None else 0.0
+    # after-call.<service>.<operation>
+    _, service, name = event_name.split('.', 2)
+    operation = service + ':' + name
+    for record in _records():
+        record.add('ApiCalls')
+        record.add('ApiTime', elapsed, 'Milliseconds')
+        record.add('ApiRetries', retries)
+        if code:
+            record.add('ApiErrors')
+            if 'Throttl' in code or code in ('RequestLimitExceeded', 'TooManyRequestsException'):
+                record.add('ApiThrottles')
+        record.count_operation(operation)
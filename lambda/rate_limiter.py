@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+from instrumentation import current
+from ssm_command import THROTTLING_ERRORS
+
+# Token buckets per api operation shared by every thread of the execution environment. The rate starts at the
+# configured limit, is halved on every throttling response and grows back by a twentieth of the limit on
+# every successful call (additive increase, multiplicative decrease). Operations without a limit are not
+# rate limited. Quotas apply per region and account, so every client scope (its target) has buckets of its own.
+
+# Requests per second, below the default account quotas so both functions can run at the same time.
+DEFAULT_LIMITS = {
+    'ssm:SendCommand': 10,
+    'ssm:ListCommandInvocations': 20,
+    'ssm:GetCommandInvocation': 20,
+    'ssm:DescribeInstanceInformation': 10,
+    'ssm:GetParameter': 20,
+    'ssm:GetParametersByPath': 10,
+    'ssm:PutParameter': 3,
+    'cloudwatch:PutMetricAlarm': 3,
+    'cloudwatch:DescribeAlarms': 9,
+    'cloudwatch:DeleteAlarms': 3,
+    'cloudwatch:GetMetricData': 50,
+    'ec2:DescribeInstances': 20,
+    'ec2:DescribeVolumes': 20,
+    'ec2:DescribeVolumesModifications': 20,
+    'ec2:DescribeInstanceAttribute': 20,
+    'ec2:ModifyVolume': 5,
+    'ec2:CreateTags': 5
+}
+MIN_RATE = 0.2
+
+
+class TokenBucket:
+
+    def __init__(self, limit):
+        self.lock = threading.Lock()
+        self.limit = float(limit)
+        self.rate = float(limit)
+        self.tokens = max(1.0, self.limit)
+        self.updated = time.time()
+
+    def acquire(self):
+        # Reserves a token and returns how long the caller has to wait for it. Tokens may go negative,
+        # so concurrent callers queue up behind each other instead of all waking up at the same time.
+        with self.lock:
+            now = time.time()
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens/self.rate
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate/2)
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.limit, self.rate + self.limit/20)
+
+
+class RateLimiter:
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, operation, scope=''):
+        if operation not in self.limits:
+            return None
+        with self.lock:
+            if (scope, operation) not in self.buckets:
+                self.buckets[(scope, operation)] = TokenBucket(self.limits[operation])
+            return self.buckets[(scope, operation)]
+
+    def register(self, client, scope=''):
+        # before-send and needs-retry are emitted for every attempt, retries of botocore are limited as well.
+        # Clients without an event system, like the fakes of the benchmark, are left as they are.
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+        events.register('before-send', lambda event_name, **kwargs: self._before_send(event_name, scope, **kwargs))
+        events.register('needs-retry', lambda event_name, **kwargs: self._needs_retry(event_name, scope, **kwargs))
+
+    def _before_send(self, event_name, scope='', **kwargs):
+        bucket = self.bucket(operation_from_event(event_name), scope)
+        if bucket is None:
+            return
+        delay = bucket.acquire()
+        if delay > 0:
+            time.sleep(delay)
+            current().add('RateLimitWaitTime', delay*1000, 'Milliseconds')
+
+    def _needs_retry(self, event_name, scope='', response=None, **kwargs):
+        bucket = self.bucket(operation_from_event(event_name), scope)
+        if bucket is None or response is None:
+            return
+        code = response[1].get('Error', {}).get('Code')
+        if code in THROTTLING_ERRORS:
+            bucket.throttled()
+            current().add('RateLimitThrottles')
+        elif response[0].status_code < 400:
+            bucket.succeeded()
+
+
+def operation_from_event(event_name):
+    # e.g. before-send.ssm.SendCommand
+    parts = event_name.split('.')
+    return parts[1] + ':' + parts[2] if len(parts) >= 3 else ''
+
+
+def limits_from_env():
+    # API_RATE_LIMITS overrides single limits, e.g. {"ssm:SendCommand": 5}, a limit of 0 disables it.
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(json.loads(os.getenv('API_RATE_LIMITS') or '{}'))
+    return {operation: limit for operation, limit in limits.items() if limit}
+
+
+limiter = RateLimiter(limits_from_env())
@@ -1,18 +1,72 @@
+import time
+init_started = time.time()
+
+import datetime
 import json
 import os
-import boto3
-import time
-import math
+import re
+import uuid
 import botocore
+from ssm_command import CommandRunner, deadline_from_context
+from disk_inventory import volume_id_from_block_device_mappings
+from state_store import state_store_from_env
+from sizing import ratio_target_size, growth_rate, growth_target_size, performance_target, performance_boost, MODIFICATION_COOLDOWN_HOURS
+from instrumentation import MetricsRecord, current, start_invocation
+from aws_clients import lazy_client
+from usage_history import fetch_usage_history
 
 sns_enabled = os.getenv('ENABLE_SNS').lower()
 sns_arn = os.getenv('SNS_NOTIFICATION_TOPIC_ARN')
 req_utilisation = os.getenv('DESIRED_UTILISATION')
 threshold = os.getenv('THRESHOLD_UTILISATION')
+resume_queue_url = os.getenv('RESUME_QUEUE_URL')
+# Seconds spent polling the volume modification before the job is suspended and resumed by a later invocation.
+wait_budget = int(os.getenv('MODIFICATION_WAIT_SECONDS', '30'))
+resume_delay = int(os.getenv('RESUME_DELAY_SECONDS', '30'))
+max_wait = 3600
+# "ratio" keeps the threshold to target ratio, "growth" sizes for the observed growth rate.
+sizing_mode = os.getenv('SIZING_MODE', 'ratio').lower()
+growth_horizon = float(os.getenv('GROWTH_HORIZON_HOURS', '24'))
+history_hours = float(os.getenv('SIZING_HISTORY_HOURS', '24'))
+max_volume_size = int(os.getenv('MAX_VOLUME_SIZE_GB', '16384'))
+# Provisioned iops and throughput grow with the size, optionally to a fixed ratio per GB.
+performance_scaling = os.getenv('PERFORMANCE_SCALING', 'yes').lower()
+iops_per_gb = float(os.getenv('IOPS_PER_GB')) if os.getenv('IOPS_PER_GB') else None
+throughput_per_gb = float(os.getenv('THROUGHPUT_PER_GB')) if os.getenv('THROUGHPUT_PER_GB') else None
+convert_gp2 = os.getenv('CONVERT_GP2_TO_GP3', 'no').lower()
+# I/O saturation alarms raise iops and throughput by this factor instead of growing the volume. gp2 has no
+# provisioned performance, it is always converted to gp3 by these alarms.
+performance_boost_factor = float(os.getenv('PERFORMANCE_BOOST_FACTOR', '1.5'))
+# Caps of the iops and throughput these alarms raise a volume to, below the limits of its volume type.
+max_boost_iops = int(os.getenv('MAX_BOOST_IOPS')) if os.getenv('MAX_BOOST_IOPS') else None
+max_boost_throughput = int(os.getenv('MAX_BOOST_THROUGHPUT')) if os.getenv('MAX_BOOST_THROUGHPUT') else None
+# A performance change takes the modification slot of the volume for the cooldown. Disks on the volume whose
+# utilisation is within this many percent points of the threshold are grown in the same modification.
+capacity_margin = float(os.getenv('CAPACITY_MARGIN_PERCENT', '10'))
+job_ttl = 24*3600
+# Alarms of a disk that arrive within this many seconds of an accepted one are dropped, so flapping alarms
+# do not scale a volume that is already being modified.
+dedupe_window = int(os.getenv('DEDUPE_WINDOW_SECONDS', '900'))
+# A job locks its volumes from discovery until it is done, so concurrent jobs do not modify the same volume. Once
+# the volume is modified, its modification state keeps other jobs away for the rest of the cooldown.
+volume_lock_ttl = int(os.getenv('VOLUME_LOCK_SECONDS', '900'))
+# Tolerated difference between the clock of the function and the start time EC2 records for a modification.
+CLOCK_SKEW_SECONDS = 60
+
+# Nothing is connected until it is used, sns is only created when notifications are enabled.
+ec2 = lazy_client('ec2')
+ssm = lazy_client('ssm')
+sns= lazy_client('sns')
+sqs = lazy_client('sqs')
+cw = lazy_client('cloudwatch')
 
-ec2 = boto3.client('ec2')
-ssm = boto3.client('ssm')
-sns= boto3.client('sns')
+store = state_store_from_env(lazy_client('dynamodb'))
+
+ALARM_PREFIX = 'ebs-utilisation-exceeded-alarm:'
+
+runner = CommandRunner(ssm)
+function_name = 'scale-ebs-function'
+cold_start = True
 
 def find_volume_id(params):   
     instance_id = params['instance_id']
@@ -46,12 +100,7 @@ def find_volume_id(params):
         
     #if instace is non-nvme    
     else:
-        mapping_letter=''
-        if 'xvd' in params['device']:
-            mapping_letter=params['device'][3]
-        elif 'sd' in params['device']:
-            mapping_letter=params['device'][2]
-        else:
+        if not params['device'].startswith(('xvd', 'sd')):
             return
         
         print('Extracting block device mapping.')
@@ -59,45 +108,233 @@ def find_volume_id(params):
             Attribute='blockDeviceMapping',
             InstanceId=instance_id
         )['BlockDeviceMappings']
-        
-        for volume in volumes:
-            if 'xvd'+mapping_letter in volume['DeviceName'] or 'sd'+mapping_letter in volume['DeviceName']:
-                return volume['Ebs']['VolumeId']
-        return
- 
-def send_ssm_command(instance_id, document, parameters):
+        return volume_id_from_block_device_mappings(volumes, re.sub(r'[0-9]+$', '', params['device']))
+
+def cached_volume_id(message):
+    # Onboarding stores the volume id in the alarm description.
+    return alarm_description(message).get('VolumeId')
+
+def scale_mode(message):
+    # "capacity" grows the volume and the file system, "performance" raises provisioned iops and throughput.
+    return alarm_description(message).get('ScaleMode') or 'capacity'
+
+def alarm_description(message):
+    try:
+        description = json.loads(message.get('AlarmDescription') or '{}')
+    except ValueError:
+        return {}
+    return description if isinstance(description, dict) else {}
+
+def describe_volumes(volume_ids):
+    # One call for every volume of the event. An unknown id fails the whole call, so fall back to
+    # describing the volumes one by one and skip the ones that no longer exist.
+    volume_ids = sorted(set(volume_ids))
+    if not volume_ids:
+        return {}
+    try:
+        volumes = []
+        for page in ec2.get_paginator('describe_volumes').paginate(VolumeIds=volume_ids):
+            volumes.extend(page['Volumes'])
+    except botocore.exceptions.ClientError as e:
+        if len(volume_ids) == 1:
+            print('ERROR OCCURED :: ' + e.response['Error']['Message'])
+            return {}
+        volumes = {}
+        for volume_id in volume_ids:
+            volumes.update(describe_volumes([volume_id]))
+        return volumes
+    return {volume['VolumeId']: volume for volume in volumes}
+
+def is_attached(volume, instance_id):
+    for attachment in volume['Attachments']:
+        if attachment['InstanceId']==instance_id and attachment['State']=='attached':
+            return True
+    return False
+
+def latest_modifications(volume_ids):
+    # The volume-id filter, unlike VolumeIds, does not fail for volumes that were never modified.
+    modifications = {}
+    if not volume_ids:
+        return modifications
     try:
-        response = ssm.send_command(
-            InstanceIds=[instance_id],
-            DocumentName=document,
-            Parameters=parameters
+        pages = ec2.get_paginator('describe_volumes_modifications').paginate(
+            Filters=[{'Name': 'volume-id', 'Values': sorted(set(volume_ids))}]
         )
-        while True:
-            time.sleep(3)
-            result = ssm.get_command_invocation(
-                        CommandId=response['Command']['CommandId'],
-                        InstanceId=instance_id
-                    )
-            if result['Status']=='InProgress' or result['Status']=='Pending':
-                pass
-            else:
-                return result
-    except:
-        print('Failed to send command. Make sure ssm agent is installed on instance and appropriate role is attached to ec2 instance.')
-        return {'Status':'Failed', 'StandardOutputContent':''}
+        for page in pages:
+            for modification in page['VolumesModifications']:
+                latest = modifications.get(modification['VolumeId'])
+                if latest == None or modification['StartTime'] > latest['StartTime']:
+                    modifications[modification['VolumeId']] = modification
+    except botocore.exceptions.ClientError as e:
+        print('ERROR OCCURED :: ' + e.response['Error']['Message'])
+    return modifications
+ 
+def wait_for_volume_modifications(volumes, deadline=None):
+    # The new size is visible to the OS as soon as the modification is optimizing. Reads are eventually
+    # consistent, until the requested modification is listed the latest one may still be an earlier one.
+    delay = 1
+    states = {volume_id: 'modifying' for volume_id in volumes}
+    while True:
+        for volume_id, modification in latest_modifications(list(volumes)).items():
+            if requested_modification(modification, volumes[volume_id]):
+                states[volume_id] = modification['ModificationState']
+        if all(state in ('optimizing', 'completed', 'failed') for state in states.values()):
+            return states
+        if deadline is not None and time.time() + delay > deadline:
+            return states
+        time.sleep(delay)
+        delay = min(delay*2, 8)
+ 
+def requested_modification(modification, volume):
+    # The modification started when the job modified the volume, or the one growing it to the size the job asked for.
+    if modification['StartTime'].timestamp() >= volume.get('ModifiedAt', 0) - CLOCK_SKEW_SECONDS:
+        return True
+    target_size = volume.get('TargetSize', volume['CurrentSize'])
+    return target_size > volume['CurrentSize'] and modification.get('TargetSize') == target_size
+
+def send_ssm_command(instance_id, document, parameters):
+    result = runner.send(instance_id, document, parameters)
+    if result['Status']!='Success':
+        print('Command ended with status "' + result['Status'] + '". ' + result['Error'])
+    return result
 
 
 def lambda_handler(event, context):
-    alarm_name = json.loads(event['Records'][0]['Sns']['Message'])['AlarmName']
-    instance_id = alarm_name.split(':')[1]
-    print('"'+ alarm_name +'" CloudWatch alarm triggered.')
-    sns_notification_msg = '"'+ alarm_name +'" CloudWatch alarm triggered.'
-    print('Starting EBS scaling for "'+ instance_id +'".')
-    sns_notification_msg += '\nStarting EBS scaling for "'+ instance_id +'".'
+    global runner, function_name, cold_start
+    function_name = getattr(context, 'function_name', 'scale-ebs-function')
+    metrics = start_invocation(function_name)
+    if cold_start:
+        metrics.add('ColdStart')
+        metrics.add('InitTime', init_seconds*1000, 'Milliseconds')
+        cold_start = False
+    runner = CommandRunner(ssm, deadline_from_context(context, 15))
+    # Alarms arrive in batches from the intake queue (or one by one from the topic) and resumed jobs from the
+    # resume queue. The alarms of a batch are scaled together, the outcome is reported per message.
+    jobs = []
+    alarms = []
+    failures = []
+    for record in event['Records']:
+        if record.get('eventSource') != 'aws:sqs':
+            alarms.append((None, json.loads(record['Sns']['Message'])))
+            continue
+        try:
+            body = json.loads(record['body'])
+            if 'ResumeJob' in body:
+                job = store.get(body['ResumeJob'])
+                if job == None:
+                    print('Scaling job "' + body['ResumeJob'] + '" not found, it has expired.')
+                    continue
+                # A resume message delivered twice finds the job already done.
+                if job['Stage'] == 'done':
+                    print('Scaling job "' + job['Key'] + '" has already completed.')
+                    continue
+                print('Resuming scaling job "' + job['Key'] + '" at stage "' + job['Stage'] + '".')
+                jobs.append((job, [(None, record['messageId'])]))
+                continue
+            # The topic wraps the alarm in a notification unless raw message delivery is enabled.
+            message = json.loads(body['Message']) if 'Message' in body else body
+            if not claim_disk(message):
+                print('"' + message['AlarmName'] + '" CloudWatch alarm is a duplicate within ' + str(dedupe_window) + ' seconds, skipping.')
+                metrics.add('Deduplicated')
+                continue
+        except Exception as e:
+            print('ERROR OCCURED :: Message "' + record['messageId'] + '" could not be read. ' + str(e))
+            failures.append(record['messageId'])
+            continue
+        alarms.append((record['messageId'], message))
+    jobs.extend(alarm_jobs(alarms))
+    
+    for job, messages in jobs:
+        try:
+            run_job(job, context)
+        except Exception as e:
+            print('ERROR OCCURED :: Scaling job "' + job['Key'] + '" failed at stage "' + job['Stage'] + '". ' + str(e))
+            release_locks(job)
+            # Sns invocations have no batch to report on, they are retried by raising.
+            if any(message_id == None for _, message_id in messages):
+                raise
+            failures.extend(message_id for _, message_id in messages)
+            continue
+        failures.extend(message_id for identity, message_id in messages if message_id != None and retry_alarm(job, identity))
     
+    stats = runner.stats.as_dict()
+    metrics.add('Jobs', len(jobs))
+    metrics.add('Alarms', len(alarms))
+    metrics.add('FailedMessages', len(failures))
+    metrics.add('CommandPolls', stats['Polls'])
+    metrics.add('CommandWaitTime', stats['WaitSeconds'], 'Seconds')
+    metrics.emit()
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
+
+def claim_disk(message):
+    # The first alarm of a disk claims it for the window. A redelivery of that same alarm (after a failed or
+    # timed out attempt) is let through, its job resumes from the checkpoint.
+    key = 'intake:' + message['AlarmName'].split(':', 1)[1]
+    identity = alarm_identity(message)
+    if store.add(key, {'Alarm': identity}, dedupe_window):
+        return True
+    claim = store.get(key)
+    return claim == None or claim['Alarm'] == identity
+
+def alarm_identity(message):
+    return message['AlarmName'] + ':' + message.get('StateChangeTime', '')
+
+def alarm_key(identity):
+    return 'alarm:' + identity
+
+def alarm_jobs(alarms):
+    # A redelivered alarm continues the job it was started in, unless that job could not scale its disk. The other
+    # alarms are scaled by a new job. Returns the jobs with the (alarm, message id) pairs each of them scales.
+    identities = [alarm_identity(message) for _, message in alarms]
+    pointers = store.get_many([alarm_key(identity) for identity in identities])
+    started = store.get_many(sorted({pointer['Job'] for pointer in pointers.values()}))
+    jobs = {}
+    new = []
+    for identity, (message_id, message) in zip(identities, alarms):
+        job = started.get(pointers.get(alarm_key(identity), {}).get('Job'))
+        if job == None or retry_alarm(job, identity):
+            new.append((identity, message_id, message))
+            continue
+        if job['Stage'] == 'done':
+            print('Scaling job "' + job['Key'] + '" of "' + message['AlarmName'] + '" has already completed.')
+            continue
+        if job['Key'] not in jobs:
+            print('Resuming scaling job "' + job['Key'] + '" at stage "' + job['Stage'] + '".')
+            jobs[job['Key']] = (job, [])
+        jobs[job['Key']][1].append((identity, message_id))
+    if new:
+        job = start_job([(identity, message) for identity, _, message in new])
+        jobs[job['Key']] = (job, [(identity, message_id) for identity, message_id, _ in new])
+    return list(jobs.values())
+
+def start_job(alarms):
+    # All alarms of a batch are scaled by one job. Volumes of all alarms are described with a single call, each
+    # distinct volume is modified once and all disks of an instance are extended with one command. Redelivery of
+    # an alarm finds its job through the alarm key.
+    job = {'Key': 'scale:' + uuid.uuid4().hex, 'Stage': 'discover', 'CreatedAt': time.time(), 'Disks': [], 'Volumes': {}, 'Locks': [], 'Notification': ''}
+    for identity, message in dict(alarms).items():
+        report(job, '"'+ message['AlarmName'] +'" CloudWatch alarm triggered.')
+        report(job, 'Starting EBS scaling for "'+ message['AlarmName'].split(':')[1] +'".')
+        disk = alarm_disk(message)
+        disk['Alarm'] = identity
+        job['Disks'].append(disk)
+        store.put(alarm_key(identity), {'Job': job['Key']}, job_ttl)
+    return job
+
+def retry_alarm(job, identity):
+    # An alarm whose disk failed before its volume was modified left nothing behind, it is scaled again by a
+    # later job. Disks that were skipped or failed after the modify call are not.
+    for disk in job['Disks']:
+        if disk.get('Alarm') == identity:
+            volume = job['Volumes'].get(disk['VolumeId']) or {}
+            return disk['Failed'] and not disk.get('Skipped') and not volume.get('ModifyAttempted')
+    return False
+
+def alarm_disk(message):
+    alarm_name = message['AlarmName']
     print("Extracting metric metadata.")
     params = {'mount_point':'','instance_id':'','device':'','file_system':'','drive':''}
-    for element in json.loads(event['Records'][0]['Sns']['Message'])['Trigger']['Dimensions']:
+    for element in message['Trigger']['Dimensions']:
         if element['name']=='path':
             params['mount_point']=element['value']
         elif element['name']=='InstanceId':
@@ -110,53 +347,407 @@ def lambda_handler(event, context):
             params['drive']=element['value'][0]
     print('Metadata extracted -')
     print(json.dumps(params))
-    
-    print('Finding EBS volume id.')
-    sns_notification_msg += '\nFinding EBS volume id.'
-    volume_id = find_volume_id(params)
-    if volume_id == None:
-        print("Failed to find volume id.\nFailed to execute EBS Scaling.")
-        sns_notification_msg += "\nFailed to find volume id.\nFailed to execute EBS Scaling."
-        publish_sns(sns_notification_msg)
-        return
-    else:
-        print("VolumeId : " + volume_id)
-        sns_notification_msg += "\nVolumeId : " + volume_id
+    return {
+        'AlarmName': alarm_name,
+        'InstanceId': alarm_name.split(':')[1],
+        'Params': params,
+        'CachedVolumeId': cached_volume_id(message),
+        'Mode': scale_mode(message),
+        'VolumeId': None,
+        'Failed': False,
+        'Metric': {
+            'Namespace': message['Trigger']['Namespace'],
+            'MetricName': message['Trigger']['MetricName'],
+            'Dimensions': [{'Name': element['name'], 'Value': element['value']} for element in message['Trigger']['Dimensions']]
+        }
+    }
+
+def run_job(job, context):
+    # Every completed stage is checkpointed, a retried or resumed invocation continues from the last one.
+    record = MetricsRecord({'Function': function_name, 'Platform': job_platform(job)}, {'JobKey': job['Key']})
+    with record.active():
+        while job['Stage'] != 'done':
+            with record.span(job['Stage'].capitalize()):
+                next_stage = STAGES[job['Stage']](job, context)
+            if next_stage == None:
+                store.put(job['Key'], job, job_ttl)
+                schedule_resume(job)
+                record.add('Suspended')
+                record.emit()
+                return
+            if next_stage != 'done' and not active_disks(job):
+                next_stage = 'done'
+            job['Stage'] = next_stage
+            store.put(job['Key'], job, job_ttl)
+        
+        print('SSM command statistics :', json.dumps(runner.stats.as_dict()))
+        release_locks(job)
+        publish_sns(job['Notification'])
+    record.add('Suspended', 0)
+    record.emit()
+    emit_volume_metrics(job)
+
+def job_platform(job):
+    if job['Disks'] and job['Disks'][0]['Params']['drive']:
+        return 'windows'
+    return 'linux'
+
+def emit_volume_metrics(job):
+    # Time to headroom is measured from the first invocation of the job, suspended time included.
+    for volume_id, volume in job['Volumes'].items():
+        record = MetricsRecord(
+            {'Function': function_name, 'Platform': job_platform(job)},
+            {'JobKey': job['Key'], 'InstanceId': volume['InstanceId'], 'VolumeId': volume_id}
+        )
+        succeeded = not volume['Failed'] and volume.get('Extended', False)
+        record.put_property('Outcome', 'Succeeded' if succeeded else 'Failed')
+        record.add('Failed', 0 if succeeded else 1)
+        record.add('TimeToHeadroom', time.time() - job['CreatedAt'], 'Seconds')
+        if volume.get('TargetSize'):
+            record.add('SizeIncrease', volume['TargetSize'] - volume['CurrentSize'], 'Gigabytes')
+        record.emit()
+
+def schedule_resume(job):
+    print('Suspending scaling job, it will resume in ' + str(resume_delay) + ' seconds.')
+    sqs.send_message(
+        QueueUrl=resume_queue_url,
+        MessageBody=json.dumps({'ResumeJob': job['Key']}),
+        DelaySeconds=resume_delay
+    )
+
+def report(job, message):
+    print(message)
+    job['Notification'] += ('\n' if job['Notification'] else '') + message
+
+def active_disks(job):
+    return [disk for disk in job['Disks'] if not disk['Failed']]
+
+def fail_disk(job, disk, message):
+    report(job, '"' + disk['AlarmName'] + '" :: ' + message)
+    disk['Failed'] = True
+
+def fail_volume(job, volume_id, message):
+    job['Volumes'][volume_id]['Failed'] = True
+    for disk in active_disks(job):
+        if disk['VolumeId'] == volume_id:
+            fail_disk(job, disk, message)
+
+def skip_volume(job, volume_id, message):
+    # Skipped disks leave the job like failed ones, they are counted apart since nothing went wrong.
+    for disk in active_disks(job):
+        if disk['VolumeId'] == volume_id:
+            fail_disk(job, disk, 'Skipping EBS scaling. ' + message)
+            disk['Skipped'] = True
+            current().add('Skipped')
+
+def active_volumes(job):
+    return {disk['VolumeId']: job['Volumes'][disk['VolumeId']] for disk in active_disks(job)}
+
+def discover_stage(job, context):
+    report(job, 'Finding EBS volume id.')
+    volumes = describe_volumes([disk['CachedVolumeId'] for disk in job['Disks'] if disk['CachedVolumeId']])
+    for disk in active_disks(job):
+        volume = volumes.get(disk['CachedVolumeId'])
+        if volume != None and is_attached(volume, disk['InstanceId']):
+            disk['VolumeId'] = disk['CachedVolumeId']
+    # Volumes known from the alarm are checked before any command is sent to the instance.
+    guard_volumes(job)
+    for disk in active_disks(job):
+        if disk['VolumeId']:
+            continue
+        if disk['CachedVolumeId']:
+            print('Recorded volume id "' + disk['CachedVolumeId'] + '" is no longer attached to "' + disk['InstanceId'] + '", discovering volume id.')
+        try:
+            disk['VolumeId'] = find_volume_id(disk['Params'])
+        except botocore.exceptions.ClientError as e:
+            fail_disk(job, disk, 'Failed to find volume id.\nERROR OCCURED :: ' + e.response['Error']['Message'])
+            continue
+        if disk['VolumeId'] == None:
+            fail_disk(job, disk, "Failed to find volume id.\nFailed to execute EBS Scaling.")
+    guard_volumes(job)
     
     print("Extracting EBS volume current size.")
-    current_ebs_size=0
+    volumes.update(describe_volumes([disk['VolumeId'] for disk in active_disks(job) if disk['VolumeId'] not in volumes]))
+    for disk in active_disks(job):
+        volume = volumes.get(disk['VolumeId'])
+        if volume == None or not is_attached(volume, disk['InstanceId']):
+            fail_disk(job, disk, 'Failed to describe volume "' + disk['VolumeId'] + '".')
+            continue
+        report(job, '"' + disk['AlarmName'] + '" :: VolumeId : ' + disk['VolumeId'])
+        job['Volumes'][disk['VolumeId']] = {
+            'InstanceId': disk['InstanceId'],
+            'CurrentSize': volume['Size'],
+            'VolumeType': volume.get('VolumeType'),
+            'Iops': volume.get('Iops'),
+            'Throughput': volume.get('Throughput'),
+            'Mode': 'performance',
+            'Failed': False
+        }
+    fold_capacity(job)
+    # A volume that is also running out of space is grown, its performance grows along with the size.
+    for disk in active_disks(job):
+        if disk.get('Mode', 'capacity') == 'capacity':
+            job['Volumes'][disk['VolumeId']]['Mode'] = 'capacity'
+    return 'modify'
+
+def fold_capacity(job):
+    # A performance change takes the modification slot of the volume for the cooldown, a disk on it that is close
+    # to its threshold could not be grown before the cooldown ends. Such disks join the job through their
+    # utilisation alarm and the volume is grown and boosted in the same modification.
+    capacity = {disk['VolumeId'] for disk in active_disks(job) if disk.get('Mode', 'capacity') == 'capacity'}
+    performance = {volume_id: volume for volume_id, volume in active_volumes(job).items() if volume_id not in capacity}
+    if not performance:
+        return
+    disks = []
     try:
-        response = ec2.describe_volumes(
-            VolumeIds=[volume_id]
-        )
-        current_ebs_size = response['Volumes'][0]['Size']
+        for instance_id in sorted({volume['InstanceId'] for volume in performance.values()}):
+            pages = cw.get_paginator('describe_alarms').paginate(AlarmNamePrefix=ALARM_PREFIX + instance_id + ':', AlarmTypes=['MetricAlarm'])
+            for page in pages:
+                for alarm in page['MetricAlarms']:
+                    message = {
+                        'AlarmName': alarm['AlarmName'],
+                        'AlarmDescription': alarm.get('AlarmDescription'),
+                        'Trigger': {
+                            'Namespace': alarm['Namespace'],
+                            'MetricName': alarm['MetricName'],
+                            'Dimensions': [{'name': dimension['Name'], 'value': dimension['Value']} for dimension in alarm['Dimensions']]
+                        }
+                    }
+                    if cached_volume_id(message) in performance:
+                        disks.append(alarm_disk(message))
     except botocore.exceptions.ClientError as e:
-        print('ERROR OCCURED :: ' + e.response['Error']['Message'])
-        sns_notification_msg += "\nERROR OCCURED :: " + e.response['Error']['Message']
-        publish_sns(sns_notification_msg)
+        print('ERROR OCCURED :: Failed to read utilisation alarms. ' + e.response['Error']['Message'])
         return
-    print("Current volume size : " + str(current_ebs_size) + 'GB')
-    sns_notification_msg += "\nCurrent volume size : " + str(current_ebs_size) + 'GB'
-    req_ebs_size = int(math.ceil(int(threshold)*current_ebs_size)/int(req_utilisation))
-    print("Target volume size  : " + str(req_ebs_size) + 'GB')
-    sns_notification_msg += "\nTarget volume size  : " + str(req_ebs_size) + 'GB'
-    
-    print("Modifying volume.")
-    sns_notification_msg += "\nModifying volume."
+    for disk, history in zip(disks, fetch_usage_history(cw, [disk['Metric'] for disk in disks], history_hours)):
+        if history == None:
+            continue
+        latest = max(zip(*history))[1]
+        if latest < float(threshold) - capacity_margin:
+            continue
+        disk['VolumeId'] = disk['CachedVolumeId']
+        disk['Mode'] = 'capacity'
+        job['Disks'].append(disk)
+        report(job, '"' + disk['AlarmName'] + '" :: Disk is ' + str(round(latest, 1)) + '% used, growing "' + disk['VolumeId'] + '" in the same modification.')
 
-    try:
-        response = ec2.modify_volume(
-            VolumeId=volume_id,
-            Size=int(req_ebs_size)
+def guard_volumes(job):
+    # Pre-flight check of every volume the job has not locked yet. Volumes that are being modified, are in the
+    # modification cooldown or are locked by another job are skipped, the modification would fail anyway and
+    # the file system would be extended a second time.
+    locks = job.setdefault('Locks', [])
+    volume_ids = sorted({disk['VolumeId'] for disk in active_disks(job) if disk['VolumeId'] and disk['VolumeId'] not in locks})
+    if not volume_ids:
+        return
+    modifications = latest_modifications(volume_ids)
+    for volume_id in volume_ids:
+        reason = modification_guard(modifications.get(volume_id), job['Volumes'].get(volume_id))
+        if reason == None and not lock_volume(job, volume_id):
+            reason = 'Another scaling job is working on the volume.'
+        if reason != None:
+            skip_volume(job, volume_id, reason)
+            continue
+        locks.append(volume_id)
+
+def modification_guard(modification, volume):
+    # Modifications requested by this job (an attempt that did not reach its checkpoint) are handled by the modify stage.
+    if modification == None or own_modification(modification, volume):
+        return None
+    if modification['ModificationState'] in ('modifying', 'optimizing'):
+        return 'Volume modification is already in "' + modification['ModificationState'] + '" state.'
+    cooldown_ends = modification['StartTime'].timestamp() + MODIFICATION_COOLDOWN_HOURS*3600
+    if modification['ModificationState'] == 'completed' and cooldown_ends > time.time():
+        return 'Volume was modified at ' + modification['StartTime'].isoformat() + ', it can not be modified again before ' + \
+            datetime.datetime.fromtimestamp(cooldown_ends, datetime.timezone.utc).isoformat() + '.'
+    return None
+
+def own_modification(modification, volume):
+    # Only the job that recorded the modify call knows the modification is its own, other jobs created before
+    # it see a modification that started after them.
+    if volume == None or not volume.get('ModifyAttempted'):
+        return False
+    return modification['StartTime'].timestamp() >= volume['ModifiedAt'] - CLOCK_SKEW_SECONDS
+
+def volume_lock_key(volume_id):
+    return 'volume-lock:' + volume_id
+
+def release_locks(job):
+    # Only locks still held by the job are released, an expired lock may have been taken by another job since.
+    for volume_id in job.get('Locks', []):
+        lock = store.get(volume_lock_key(volume_id))
+        if lock != None and lock['Job'] == job['Key']:
+            store.delete(volume_lock_key(volume_id))
+    if job.get('Locks'):
+        job['Locks'] = []
+        try:
+            store.put(job['Key'], job, job_ttl)
+        except Exception as e:
+            print('Scaling job "' + job['Key'] + '" could not be checkpointed after releasing its locks. ' + str(e))
+
+def lock_volume(job, volume_id):
+    # A retried discovery finds its own lock.
+    if store.add(volume_lock_key(volume_id), {'Job': job['Key']}, volume_lock_ttl):
+        return True
+    lock = store.get(volume_lock_key(volume_id))
+    return lock == None or lock['Job'] == job['Key']
+
+def modify_stage(job, context):
+    # Several alarms on the same volume result in a single modification.
+    volumes = active_volumes(job)
+    targets = target_sizes(job)
+    saturated = {disk['VolumeId'] for disk in active_disks(job) if disk.get('Mode', 'capacity') == 'performance'}
+    attempted = [volume_id for volume_id, volume in volumes.items() if volume.get('ModifyAttempted')]
+    modifications = latest_modifications(attempted)
+    for volume_id, volume in volumes.items():
+        if volume.get('Modified'):
+            continue
+        if volume.get('Mode') == 'performance':
+            target = performance_boost(
+                {'VolumeType': volume.get('VolumeType'), 'Size': volume['CurrentSize'], 'Iops': volume.get('Iops'), 'Throughput': volume.get('Throughput')},
+                performance_boost_factor, max_iops=max_boost_iops, max_throughput=max_boost_throughput
+            )
+            if target == None:
+                fail_volume(job, volume_id, 'Volume type "' + str(volume.get('VolumeType')) + '" has no provisioned performance that can be raised or it is at its limits.')
+                continue
+        else:
+            report(job, volume_id + " :: Current volume size : " + str(volume['CurrentSize']) + 'GB')
+            report(job, volume_id + " :: Target volume size  : " + str(targets[volume_id]) + 'GB')
+            target = modify_target(volume, int(targets[volume_id]))
+            if volume_id in saturated:
+                # The volume is also saturated on I/O, it gets the larger of the grown and the boosted performance.
+                boost = performance_boost(
+                    {'VolumeType': volume.get('VolumeType'), 'Size': target['Size'], 'Iops': volume.get('Iops'), 'Throughput': volume.get('Throughput')},
+                    performance_boost_factor, max_iops=max_boost_iops, max_throughput=max_boost_throughput
+                )
+                for key, value in (boost or {}).items():
+                    if key == 'VolumeType' or value > target.get(key, 0):
+                        target[key] = value
+        
+        # A previous attempt may have modified the volume without reaching its checkpoint.
+        modification = modifications.get(volume_id)
+        if modification != None and own_modification(modification, volume):
+            report(job, volume_id + ' :: Volume modification was already requested.')
+            volume['Modified'] = True
+            volume['ModifiedAt'] = modification['StartTime'].timestamp()
+            volume['TargetSize'] = modification.get('TargetSize', target.get('Size', volume['CurrentSize']))
+            continue
+        volume['ModifyAttempted'] = True
+        volume['ModifiedAt'] = time.time()
+        store.put(job['Key'], job, job_ttl)
+        
+        for key in ('VolumeType', 'Iops', 'Throughput'):
+            if key in target:
+                report(job, volume_id + ' :: Target ' + key + ' : ' + str(volume.get(key)) + ' -> ' + str(target[key]))
+        report(job, volume_id + " :: Modifying volume.")
+        try:
+            response = ec2.modify_volume(
+                VolumeId=volume_id,
+                **target
+            )
+            report(job, volume_id + ' :: Successfully modified volume.')
+            volume['Modified'] = True
+            volume['TargetSize'] = target.get('Size', volume['CurrentSize'])
+        except botocore.exceptions.ClientError as e:
+            fail_volume(job, volume_id, 'Failed to modify volume.\nERROR OCCURED :: ' + e.response['Error']['Message'])
+    return 'wait'
+
+def modify_target(volume, size):
+    if performance_scaling != 'yes':
+        return {'Size': size}
+    return performance_target(
+        {'VolumeType': volume.get('VolumeType'), 'Size': volume['CurrentSize'], 'Iops': volume.get('Iops'), 'Throughput': volume.get('Throughput')},
+        size, iops_per_gb, throughput_per_gb, convert_gp2 == 'yes'
+    )
+
+def target_sizes(job):
+    volumes = active_volumes(job)
+    targets = {volume_id: ratio_target_size(volume['CurrentSize'], threshold, req_utilisation) for volume_id, volume in volumes.items()}
+    if sizing_mode != 'growth':
+        return targets
+    
+    disks = [disk for disk in active_disks(job) if disk.get('Mode', 'capacity') == 'capacity']
+    histories = fetch_usage_history(cw, [disk['Metric'] for disk in disks], history_hours)
+    growth_targets = {}
+    for disk, history in zip(disks, histories):
+        volume_id = disk['VolumeId']
+        if history == None:
+            report(job, '"' + disk['AlarmName'] + '" :: Usage history is not available, falling back to ratio based sizing.')
+            growth_targets[volume_id] = max(growth_targets.get(volume_id, 0), targets[volume_id])
+            continue
+        timestamps, used_percent = history
+        current_ebs_size = volumes[volume_id]['CurrentSize']
+        report(job, '"' + disk['AlarmName'] + '" :: Growth rate : ' + str(round(growth_rate(timestamps, used_percent, current_ebs_size), 3)) + 'GB/hour')
+        size = growth_target_size(
+            current_ebs_size, timestamps, used_percent, threshold, req_utilisation,
+            horizon_hours=growth_horizon, max_size=max_volume_size
         )
-        print('Successfully modified volume.')
-        sns_notification_msg += "\nSuccessfully modified volume."
-    except botocore.exceptions.ClientError as e:
-        print('Failed to modify volume.\nERROR OCCURED :: ' + e.response['Error']['Message'])
-        sns_notification_msg += '\nFailed to modify volume.\nERROR OCCURED :: ' + e.response['Error']['Message']
-        publish_sns(sns_notification_msg)
+        growth_targets[volume_id] = max(growth_targets.get(volume_id, 0), size)
+    return growth_targets
+
+def wait_stage(job, context):
+    volumes = active_volumes(job)
+    if not job.get('Waiting'):
+        job['Waiting'] = True
+        report(job, 'Waiting for volume modification to reach optimizing state.')
+    # The OS level extension itself needs some time, do not spend all of the remaining time waiting.
+    deadline = deadline_from_context(context, 60)
+    if resume_queue_url:
+        deadline = min(deadline or float('inf'), time.time() + wait_budget)
+    pending = {volume_id: volume for volume_id, volume in volumes.items() if volume.get('State') not in ('optimizing', 'completed')}
+    states = wait_for_volume_modifications(pending, deadline)
+    for volume_id, modification_state in states.items():
+        volumes[volume_id]['State'] = modification_state
+        if modification_state in ('optimizing', 'completed'):
+            report(job, volume_id + ' :: Volume modification is in "' + modification_state + '" state.')
+    
+    waiting = [volume_id for volume_id, state in states.items() if state not in ('optimizing', 'completed', 'failed')]
+    if waiting and resume_queue_url and time.time() - job['CreatedAt'] < max_wait:
+        # Volumes that are ready do not wait for the slowest one, only the pending ones are resumed.
+        extend_ready_disks(job)
         return
+    for volume_id, modification_state in states.items():
+        if modification_state not in ('optimizing', 'completed'):
+            fail_volume(job, volume_id, 'Volume modification is in "' + modification_state + '" state, partition can not be extended yet.\nFailed to complete EBS scaling at OS level.')
+    return 'extend'
+
+def extend_stage(job, context):
+    extend_ready_disks(job)
+    return 'done'
 
+def extend_ready_disks(job):
+    # One script per instance extends every disk that alarmed on it whose volume is ready and was not extended
+    # yet. Performance changes need nothing at OS level.
+    instances = {}
+    for disk in active_disks(job):
+        volume = job['Volumes'][disk['VolumeId']]
+        if 'Extended' in volume or volume.get('State') not in ('optimizing', 'completed'):
+            continue
+        if disk.get('Mode', 'capacity') == 'performance':
+            if job['Volumes'][disk['VolumeId']].get('Mode') == 'performance':
+                job['Volumes'][disk['VolumeId']]['Extended'] = True
+            continue
+        instances.setdefault(disk['InstanceId'], []).append(disk)
+    for instance_id, disks in instances.items():
+        if disks[0]['Params']['drive']:
+            document = 'AWS-RunPowerShellScript'
+            commands = ["$failed = @()"]
+        else:
+            document = 'AWS-RunShellScript'
+            commands = ["failed=''"]
+        for disk in disks:
+            commands.extend(extend_commands(job, disk['Params']))
+        if disks[0]['Params']['drive']:
+            commands.append("if ($failed) { Write-Output \"Failed to extend $failed\"; exit 1 }")
+        else:
+            commands.append("if [ -n \"$failed\" ]; then echo \"Failed to extend$failed\"; exit 1; fi")
+        
+        result = send_ssm_command(instance_id, document, {'commands': commands})
+        for disk in disks:
+            job['Volumes'][disk['VolumeId']]['Extended'] = result['Status']=='Success'
+        if result['Status']=='Success':
+            report(job, '"' + instance_id + '" :: EBS scaling completed successfully.')
+        else:
+            report(job, '"' + instance_id + '" :: Failed to complete EBS scaling at OS level. ' + result['StandardOutputContent'].strip())
+
+def extend_commands(job, params):
     partition_number = ''
     dev_wout_partition=''
     if len(params['device'])==9 or len(params['device'])==5 or(len(params['device'])==4 and 'sd' in params['device']):
@@ -170,44 +761,26 @@ def lambda_handler(event, context):
         dev_wout_partition=params['device'][0:3]
         
     if params['drive']:
-        print('Starting to extend partition "'+params['drive']+'" at OS level.')
-        sns_notification_msg += '\nStarting to extend partition "'+params['drive']+'" at OS level.'
-        parameters = {
-            'commands': [
-                "Start-Sleep -s 60",
-                "$a = Get-PartitionSupportedSize -DriveLetter " + params['drive'] + " | Select-Object -ExpandProperty SizeMax",
-                "$b = [math]::floor($a/1024)",
-                "iex \"Resize-Partition -DriveLetter " + params['drive'] + " -Size $($b)KB\""
-            ]
-        }
-        result = send_ssm_command(instance_id,'AWS-RunPowerShellScript',parameters)
-        if result['Status']=='Success':
-            print('EBS scaling completed successfully.')
-            sns_notification_msg += '\nEBS scaling completed successfully.'
-            
-        else:
-            print('Failed to complete EBS scaling at OS level.')
-            sns_notification_msg += '\nFailed to complete EBS scaling at OS level.'
+        report(job, 'Starting to extend partition "'+params['drive']+'" at OS level.')
+        return [
+            "try {",
+            "$a = Get-PartitionSupportedSize -DriveLetter " + params['drive'] + " | Select-Object -ExpandProperty SizeMax",
+            "$b = [math]::floor($a/1024)",
+            "iex \"Resize-Partition -DriveLetter " + params['drive'] + " -Size $($b)KB -ErrorAction Stop\"",
+            "} catch { $failed += '" + params['drive'] + "' }"
+        ]
+    report(job, 'Starting to extend partition "'+params['device']+'" at OS level.')
+    return [
+        "if [ \"" + partition_number + "\" != \"\" ];then growpart /dev/" + dev_wout_partition + " " + partition_number + ";fi;",
+        "if [ \"" + params['file_system'] + "\" = \"ext4\" ];then resize2fs /dev/" + params['device'] + "; else xfs_growfs -d " + params['mount_point'] + "; fi || failed=\"$failed " + params['device'] + "\""
+    ]
 
-    else:
-        print('Starting to extend partition "'+params['device']+'" at OS level.')
-        sns_notification_msg += '\nStarting to extend partition "'+params['device']+'" at OS level.'
-        parameters = {
-            'commands': [
-                "sleep 60",
-                "if [ \"" + partition_number + "\" != \"\" ];then growpart /dev/" + dev_wout_partition + " " + partition_number + ";fi;",
-                "if [ \"" + params['file_system'] + "\" = \"ext4\" ];then resize2fs /dev/" + params['device'] + "; else xfs_growfs -d " + params['mount_point'] + "; fi"
-            ]
-        }
-        result = send_ssm_command(instance_id,'AWS-RunShellScript',parameters)
-        if result['Status']=='Success':
-            print('EBS scaling completed successfully.')
-            sns_notification_msg += '\nEBS scaling completed successfully.'
-        else:
-            print('Failed to complete EBS scaling at OS level.')
-            sns_notification_msg += '\nFailed to complete EBS scaling at OS level.'
-    
-    publish_sns(sns_notification_msg)        
+STAGES = {
+    'discover': discover_stage,
+    'modify': modify_stage,
+    'wait': wait_stage,
+    'extend': extend_stage
+}
     
 
 def publish_sns(sns_notification_msg):
@@ -215,4 +788,6 @@ def publish_sns(sns_notification_msg):
         response = sns.publish(
            TopicArn=sns_arn,
            Message=sns_notification_msg
-        )
\ No newline at end of file
+        )
+
+init_seconds = time.time() - init_started
@@ -0,0 +1,151 @@
+import math
+
+# EBS allows one modification per volume every 6 hours.
+MODIFICATION_COOLDOWN_HOURS = 6
+MAX_VOLUME_SIZE_GB = 16384
+
+
+def ratio_target_size(current_size, threshold, target):
+    # Size at which the usage that crossed the threshold becomes the target utilisation.
+    return int(math.ceil(int(threshold)*current_size/float(target)))
+
+
+def growth_rate(timestamps, used_percent, current_size, reset_drop=5):
+    # Least squares slope of used space in GB per hour. Only the samples after the last large drop are
+    # used, a drop means data was deleted or the volume was resized and the older samples no longer apply.
+    # Returns 0 when there are not enough samples to fit.
+    points = sorted(zip(timestamps, used_percent))
+    start = 0
+    for i in range(1, len(points)):
+        if points[i-1][1] - points[i][1] > reset_drop:
+            start = i
+    points = points[start:]
+    n = len(points)
+    if n < 2:
+        return 0.0
+
+    t0 = points[0][0]
+    xs = [(t - t0)/3600.0 for t, _ in points]
+    ys = [p*current_size/100.0 for _, p in points]
+    mean_x = sum(xs)/n
+    mean_y = sum(ys)/n
+    sxx = sum((x - mean_x)**2 for x in xs)
+    if sxx == 0:
+        return 0.0
+    sxy = sum((x - mean_x)*(y - mean_y) for x, y in zip(xs, ys))
+    return sxy/sxx
+
+
+def growth_target_size(current_size, timestamps, used_percent, threshold, target,
+                       horizon_hours=24, cooldown_hours=MODIFICATION_COOLDOWN_HOURS,
+                       min_size=None, max_size=MAX_VOLUME_SIZE_GB):
+    # Smallest size whose threshold is not reached again before the modification cooldown plus the horizon
+    # has passed, assuming the recent growth continues. Never smaller than the ratio based size or min_size
+    # and never larger than max_size.
+    size = ratio_target_size(current_size, threshold, target)
+    if used_percent:
+        latest = max(zip(timestamps, used_percent))[1]
+        rate = max(growth_rate(timestamps, used_percent, current_size), 0.0)
+        used = latest*current_size/100.0 + rate*(cooldown_hours + horizon_hours)
+        size = max(size, int(math.ceil(used*100.0/int(threshold))))
+    if min_size is not None:
+        size = max(size, min_size)
+    return max(current_size, min(size, max_size))
+
+
+# Provisioned performance limits per volume type - (minimum iops, maximum iops, maximum iops per GB).
+IOPS_LIMITS = {
+    'gp3': (3000, 16000, 500),
+    'io1': (100, 64000, 50),
+    'io2': (100, 64000, 500)
+}
+# gp3 includes 125 MiB/s, at most 1000 MiB/s and 0.25 MiB/s per provisioned iops.
+GP3_THROUGHPUT_LIMITS = (125, 1000, 0.25)
+
+
+def performance_target(volume, size, iops_per_gb=None, throughput_per_gb=None, convert_gp2=False):
+    # Arguments for modify_volume besides VolumeId, so performance grows in the same modification as the
+    # size. Iops and throughput provisioned above the baseline keep their ratio to the size unless a ratio
+    # per GB is given, they never go down. Volume types without provisioned performance only change size.
+    target = {'Size': size}
+    volume_type = volume.get('VolumeType')
+    current_size = volume['Size']
+    if volume_type == 'gp2' and convert_gp2:
+        # Matches what gp2 would have offered at the new size, 3 iops per GB and up to 250 MiB/s.
+        target['VolumeType'] = 'gp3'
+        target['Iops'] = _clamp(3*size, *IOPS_LIMITS['gp3'][:2])
+        target['Throughput'] = _clamp(250 if size > 170 else 125, *GP3_THROUGHPUT_LIMITS[:2])
+        target['Throughput'] = min(target['Throughput'], int(target['Iops']*GP3_THROUGHPUT_LIMITS[2]))
+        return target
+    if volume_type not in IOPS_LIMITS:
+        return target
+
+    min_iops, max_iops, max_iops_per_gb = IOPS_LIMITS[volume_type]
+    current_iops = volume.get('Iops') or min_iops
+    iops = _scaled(current_iops, current_size, size, iops_per_gb, min_iops)
+    iops = max(current_iops, _clamp(iops, min_iops, min(max_iops, max_iops_per_gb*size)))
+    if iops != current_iops:
+        target['Iops'] = iops
+
+    if volume_type == 'gp3':
+        min_throughput, max_throughput, max_throughput_per_iops = GP3_THROUGHPUT_LIMITS
+        current_throughput = volume.get('Throughput') or min_throughput
+        throughput = _scaled(current_throughput, current_size, size, throughput_per_gb, min_throughput)
+        throughput = max(current_throughput, _clamp(throughput, min_throughput, min(max_throughput, int(iops*max_throughput_per_iops))))
+        if throughput != current_throughput:
+            target['Throughput'] = throughput
+    return target
+
+
+def _scaled(current, current_size, size, per_gb, baseline):
+    if per_gb is not None:
+        return int(math.ceil(per_gb*size))
+    # Performance included in the price of the volume type was not chosen for the size, it stays as it is.
+    if current <= baseline:
+        return current
+    return int(math.ceil(current*size/float(current_size)))
+
+
+def _clamp(value, low, high):
+    return int(max(low, min(value, high)))
+
+
+def performance_boost(volume, factor=1.5, convert_gp2=True, max_iops=None, max_throughput=None):
+    # Arguments for modify_volume besides VolumeId that raise provisioned iops and throughput by factor
+    # without changing the size, for volumes that have space left but are saturated on I/O. gp2 is
+    # converted to gp3 when allowed. max_iops and max_throughput cap repeated boosts below the limits of
+    # the volume type. Returns None when the volume type has no provisioned performance or it is already
+    # at its limits.
+    volume_type = volume.get('VolumeType')
+    size = volume['Size']
+    if volume_type == 'gp2':
+        if not convert_gp2:
+            return None
+        # Boosts what gp2 offers at this size, never less than the gp3 baseline.
+        gp3 = {
+            'VolumeType': 'gp3',
+            'Size': size,
+            'Iops': _clamp(3*size, *IOPS_LIMITS['gp3'][:2]),
+            'Throughput': 250 if size > 170 else 125
+        }
+        target = {'VolumeType': 'gp3', 'Iops': gp3['Iops'], 'Throughput': gp3['Throughput']}
+        target.update(performance_boost(gp3, factor, max_iops=max_iops, max_throughput=max_throughput) or {})
+        return target
+    if volume_type not in IOPS_LIMITS:
+        return None
+
+    target = {}
+    iops_cap = max_iops if max_iops is not None else float('inf')
+    throughput_cap = max_throughput if max_throughput is not None else float('inf')
+    min_iops, max_iops, max_iops_per_gb = IOPS_LIMITS[volume_type]
+    current_iops = volume.get('Iops') or min_iops
+    iops = _clamp(math.ceil(current_iops*factor), min_iops, min(max_iops, max_iops_per_gb*size, iops_cap))
+    if iops > current_iops:
+        target['Iops'] = iops
+    if volume_type == 'gp3':
+        min_throughput, max_throughput, max_throughput_per_iops = GP3_THROUGHPUT_LIMITS
+        current_throughput = volume.get('Throughput') or min_throughput
+        throughput = _clamp(math.ceil(current_throughput*factor), min_throughput, min(max_throughput, int(max(iops, current_iops)*max_throughput_per_iops), throughput_cap))
+        if throughput > current_throughput:
+            target['Throughput'] = throughput
+    return target or None
@@ -0,0 +1,182 @@
+import random
+import threading
+import time
+import botocore.exceptions
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+PENDING_STATUSES = ('Pending', 'InProgress', 'Delayed', 'Cancelling')
+
+# Plugin output returned by ListCommandInvocations is truncated at 2500 characters.
+PLUGIN_OUTPUT_LIMIT = 2500
+# SendCommand accepts at most 50 instance ids.
+MAX_BATCH_SIZE = 50
+
+
+class CommandDeadlineExceeded(Exception):
+    pass
+
+
+def deadline_from_context(context, reserve_seconds=10):
+    # Leave some of the remaining time to the caller so it can still report the outcome.
+    if context is None:
+        return None
+    return time.time() + context.get_remaining_time_in_millis()/1000.0 - reserve_seconds
+
+
+def failed_result(status='Failed', error=''):
+    return {'Status': status, 'StandardOutputContent': '', 'Error': error}
+
+
+class CommandStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api_calls = {}
+        self.commands = 0
+        self.polls = 0
+        self.throttles = 0
+        self.wait_seconds = 0.0
+
+    def add_call(self, operation):
+        with self.lock:
+            self.api_calls[operation] = self.api_calls.get(operation, 0) + 1
+
+    def add(self, name, value=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'ApiCalls': dict(self.api_calls),
+                'Commands': self.commands,
+                'Polls': self.polls,
+                'Throttles': self.throttles,
+                'WaitSeconds': round(self.wait_seconds, 3)
+            }
+
+
+class CommandRunner:
+
+    def __init__(self, ssm, deadline=None, initial_delay=0.5, max_delay=8, stats=None):
+        self.ssm = ssm
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.stats = stats or CommandStats()
+
+    def send(self, instance_id, document, parameters, timeout=None):
+        return self.send_batch([instance_id], document, parameters, timeout)[instance_id]
+
+    def send_batch(self, instance_ids, document, parameters, timeout=None):
+        results = {}
+        for i in range(0, len(instance_ids), MAX_BATCH_SIZE):
+            results.update(self._send_batch(instance_ids[i:i+MAX_BATCH_SIZE], document, parameters, timeout))
+        return results
+
+    def _send_batch(self, instance_ids, document, parameters, timeout):
+        deadline = self._command_deadline(timeout)
+        try:
+            response = self._call(
+                'send_command', deadline,
+                InstanceIds=instance_ids,
+                DocumentName=document,
+                Parameters=parameters
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code']=='InvalidInstanceId' and len(instance_ids) > 1:
+                # A single unreachable instance rejects the whole command, so retry the halves to let the rest of the batch run.
+                half = len(instance_ids)//2
+                results = self._send_batch(instance_ids[:half], document, parameters, timeout)
+                results.update(self._send_batch(instance_ids[half:], document, parameters, timeout))
+                return results
+            status = 'Undeliverable' if e.response['Error']['Code']=='InvalidInstanceId' else 'Failed'
+            return {instance_id: failed_result(status, e.response['Error']['Message']) for instance_id in instance_ids}
+        except CommandDeadlineExceeded as e:
+            return {instance_id: failed_result('DeadlineExceeded', str(e)) for instance_id in instance_ids}
+        self.stats.add('commands')
+
+        command_id = response['Command']['CommandId']
+        results = {}
+        remaining = set(instance_ids)
+        attempt = 0
+        try:
+            while remaining:
+                self._sleep(self._backoff(attempt), deadline)
+                attempt += 1
+                self.stats.add('polls')
+                for invocation in self._list_invocations(command_id, instance_ids, deadline):
+                    instance_id = invocation['InstanceId']
+                    if instance_id not in remaining or invocation['Status'] in PENDING_STATUSES:
+                        continue
+                    results[instance_id] = self._invocation_result(command_id, invocation, deadline)
+                    remaining.discard(instance_id)
+        except CommandDeadlineExceeded as e:
+            for instance_id in remaining:
+                results[instance_id] = failed_result('DeadlineExceeded', str(e))
+        except botocore.exceptions.ClientError as e:
+            for instance_id in remaining:
+                results[instance_id] = failed_result('Failed', e.response['Error']['Message'])
+        return results
+
+    def _list_invocations(self, command_id, instance_ids, deadline):
+        kwargs = {'CommandId': command_id, 'Details': True}
+        if len(instance_ids) == 1:
+            kwargs['InstanceId'] = instance_ids[0]
+        while True:
+            page = self._call('list_command_invocations', deadline, **kwargs)
+            for invocation in page['CommandInvocations']:
+                yield invocation
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+    def _invocation_result(self, command_id, invocation, deadline):
+        output = ''.join(plugin.get('Output', '') for plugin in invocation.get('CommandPlugins', []))
+        # Only the single plugin documents can be fetched without naming the plugin.
+        if invocation['Status']=='Success' and len(output) >= PLUGIN_OUTPUT_LIMIT and len(invocation['CommandPlugins'])==1:
+            output = self._call(
+                'get_command_invocation', deadline,
+                CommandId=command_id,
+                InstanceId=invocation['InstanceId']
+            )['StandardOutputContent']
+        return {
+            'Status': invocation['Status'],
+            'StandardOutputContent': output.split('----------ERROR-------')[0],
+            'Error': invocation.get('StatusDetails', '') if invocation['Status']!='Success' else ''
+        }
+
+    def _call(self, operation, deadline, **kwargs):
+        attempt = 0
+        while True:
+            self.stats.add_call(operation)
+            try:
+                return getattr(self.ssm, operation)(**kwargs)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    raise
+                self.stats.add('throttles')
+                self._sleep(self._backoff(attempt), deadline)
+                attempt += 1
+
+    def _backoff(self, attempt):
+        # Exponential backoff with equal jitter, so short commands are picked up quickly
+        # while long ones do not hammer the api.
+        delay = min(self.max_delay, self.initial_delay * 2 ** attempt)
+        return delay/2 + random.uniform(0, delay/2)
+
+    def _sleep(self, delay, deadline):
+        if deadline is not None:
+            left = deadline - time.time()
+            if left <= 0:
+                raise CommandDeadlineExceeded('Deadline exceeded while waiting for command.')
+            delay = min(delay, left)
+        time.sleep(delay)
+        self.stats.add('wait_seconds', delay)
+
+    def _command_deadline(self, timeout):
+        if timeout is None:
+            return self.deadline
+        if self.deadline is None:
+            return time.time() + timeout
+        return min(self.deadline, time.time() + timeout)
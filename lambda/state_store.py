@@ -0,0 +1,177 @@
+import json
+import os
+import threading
+import time
+import botocore.exceptions
+
+# Checkpoints and other small records shared between invocations. Every store keeps json-serialisable
+# dicts under a string key, an optional ttl makes the record disappear after the given number of seconds.
+
+
+class DictStateStore:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or _expired(item):
+                return None
+            return json.loads(item['Value'])
+
+    def get_many(self, keys):
+        # Missing and expired keys are left out of the result.
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.items[key] = _item(value, ttl)
+
+    def add(self, key, value, ttl=None):
+        # Stores the value only when the key is missing or expired, returns whether it was stored.
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and not _expired(item):
+                return False
+            self.items[key] = _item(value, ttl)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+class FileStateStore(DictStateStore):
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.items = json.load(f)
+
+    def put(self, key, value, ttl=None):
+        super().put(key, value, ttl)
+        self._save()
+
+    def add(self, key, value, ttl=None):
+        added = super().add(key, value, ttl)
+        if added:
+            self._save()
+        return added
+
+    def delete(self, key):
+        super().delete(key)
+        self._save()
+
+    def _save(self):
+        with self.lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.items, f)
+            os.replace(self.path + '.tmp', self.path)
+
+
+class DynamoDBStateStore:
+
+    def __init__(self, table_name, dynamodb):
+        self.table_name = table_name
+        self.dynamodb = dynamodb
+
+    def get(self, key):
+        item = self.dynamodb.get_item(
+            TableName=self.table_name,
+            Key={'Key': {'S': key}},
+            ConsistentRead=True
+        ).get('Item')
+        if item is None:
+            return None
+        return self._value(item)
+
+    def get_many(self, keys):
+        # BatchGetItem reads up to 100 keys per call, keys it could not read in time are returned as unprocessed.
+        values = {}
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), 100):
+            request = {self.table_name: {'Keys': [{'Key': {'S': key}} for key in keys[i:i+100]], 'ConsistentRead': True}}
+            attempt = 0
+            while request:
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.table_name, []):
+                    value = self._value(item)
+                    if value is not None:
+                        values[item['Key']['S']] = value
+                request = response.get('UnprocessedKeys') or None
+                if request:
+                    attempt += 1
+                    time.sleep(min(2.0, 0.05*2**attempt))
+        return values
+
+    def put(self, key, value, ttl=None):
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item=self._item(key, value, ttl)
+        )
+
+    def add(self, key, value, ttl=None):
+        # Expired items may not have been removed yet, they are overwritten like missing ones.
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table_name,
+                Item=self._item(key, value, ttl),
+                ConditionExpression='attribute_not_exists(#key) OR ExpiresAt <= :now',
+                ExpressionAttributeNames={'#key': 'Key'},
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}}
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.dynamodb.delete_item(
+            TableName=self.table_name,
+            Key={'Key': {'S': key}}
+        )
+
+    def _value(self, item):
+        # DynamoDB removes expired items lazily, so the expiry is checked on read as well.
+        if 'ExpiresAt' in item and float(item['ExpiresAt']['N']) <= time.time():
+            return None
+        return json.loads(item['Value']['S'])
+
+    def _item(self, key, value, ttl):
+        item = {'Key': {'S': key}, 'Value': {'S': json.dumps(value)}}
+        if ttl is not None:
+            item['ExpiresAt'] = {'N': str(int(time.time() + ttl))}
+        return item
+
+
+def state_store_from_env(dynamodb=None):
+    # STATE_TABLE is set by the stack, STATE_FILE is meant for running the functions locally.
+    if os.getenv('STATE_TABLE'):
+        if dynamodb is None:
+            import boto3
+            dynamodb = boto3.client('dynamodb')
+        return DynamoDBStateStore(os.getenv('STATE_TABLE'), dynamodb)
+    if os.getenv('STATE_FILE'):
+        return FileStateStore(os.getenv('STATE_FILE'))
+    return DictStateStore()
+
+
+def _item(value, ttl):
+    item = {'Value': json.dumps(value)}
+    if ttl is not None:
+        item['ExpiresAt'] = time.time() + ttl
+    return item
+
+
+def _expired(item):
+    return 'ExpiresAt' in item and item['ExpiresAt'] <= time.time()
@@ -0,0 +1,44 @@
+import datetime
+import botocore
+
+# One get_metric_data call serves up to 500 metrics.
+MAX_METRICS_PER_CALL = 500
+# Windows reports free space instead of used space.
+FREE_SPACE_METRIC = 'LogicalDisk % Free Space'
+
+
+def fetch_usage_history(cw, metrics, hours, period=300):
+    # Used space of the agent disk metrics over the last hours. Returns (timestamps, used percent) per metric,
+    # None for metrics without data. A failed call leaves its metrics without data.
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(hours=hours)
+    histories = [None]*len(metrics)
+    for i in range(0, len(metrics), MAX_METRICS_PER_CALL):
+        kwargs = {
+            'MetricDataQueries': [{
+                'Id': 'm' + str(j),
+                'MetricStat': {'Metric': metric, 'Period': period, 'Stat': 'Average'}
+            } for j, metric in enumerate(metrics[i:i+MAX_METRICS_PER_CALL], i)],
+            'StartTime': start,
+            'EndTime': end
+        }
+        try:
+            while True:
+                response = cw.get_metric_data(**kwargs)
+                for result in response['MetricDataResults']:
+                    j = int(result['Id'][1:])
+                    if not result['Values']:
+                        continue
+                    timestamps, used_percent = histories[j] or ([], [])
+                    timestamps.extend(timestamp.timestamp() for timestamp in result['Timestamps'])
+                    if metrics[j]['MetricName'] == FREE_SPACE_METRIC:
+                        used_percent.extend(100 - value for value in result['Values'])
+                    else:
+                        used_percent.extend(result['Values'])
+                    histories[j] = (timestamps, used_percent)
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        except botocore.exceptions.ClientError as e:
+            print('ERROR OCCURED :: ' + e.response['Error']['Message'])
+    return histories
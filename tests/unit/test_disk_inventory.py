@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambda'))
+from disk_inventory import parse_inventory, volume_id_from_serial, volume_id_from_block_device_mappings
+
+
+def lsblk(*devices):
+    return json.dumps({'blockdevices': list(devices)})
+
+
+class VolumeIdFromSerialTest(unittest.TestCase):
+
+    def test_nvme_serial_without_dash(self):
+        self.assertEqual(volume_id_from_serial('vol0123456789abcdef0'), 'vol-0123456789abcdef0')
+
+    def test_serial_with_dash(self):
+        self.assertEqual(volume_id_from_serial('vol-0123456789abcdef0'), 'vol-0123456789abcdef0')
+
+    def test_short_volume_id(self):
+        self.assertEqual(volume_id_from_serial('vol01234567'), 'vol-01234567')
+
+    def test_serial_without_vol_prefix(self):
+        # Instance store disks and the serials of other devices are not EBS volumes.
+        self.assertIsNone(volume_id_from_serial('0123456789abcdef0'))
+        self.assertIsNone(volume_id_from_serial('AWS2D5F4A8B2C1E3F7A'))
+
+    def test_empty_serial(self):
+        self.assertIsNone(volume_id_from_serial(''))
+        self.assertIsNone(volume_id_from_serial(None))
+
+
+class VolumeIdFromBlockDeviceMappingsTest(unittest.TestCase):
+
+    MAPPINGS = [
+        {'DeviceName': '/dev/sda1', 'Ebs': {'VolumeId': 'vol-root'}},
+        {'DeviceName': '/dev/sdf', 'Ebs': {'VolumeId': 'vol-data'}},
+        {'DeviceName': 'xvdg', 'Ebs': {'VolumeId': 'vol-logs'}},
+        {'DeviceName': '/dev/sdh', 'VirtualName': 'ephemeral0'}
+    ]
+
+    def test_xvd_device_mapped_as_sd(self):
+        self.assertEqual(volume_id_from_block_device_mappings(self.MAPPINGS, 'xvdf'), 'vol-data')
+
+    def test_sd_device_mapped_as_xvd(self):
+        self.assertEqual(volume_id_from_block_device_mappings(self.MAPPINGS, 'sdg'), 'vol-logs')
+
+    def test_root_device_mapped_as_partition(self):
+        self.assertEqual(volume_id_from_block_device_mappings(self.MAPPINGS, 'xvda'), 'vol-root')
+
+    def test_unmapped_and_instance_store_devices(self):
+        self.assertIsNone(volume_id_from_block_device_mappings(self.MAPPINGS, 'xvdz'))
+        self.assertIsNone(volume_id_from_block_device_mappings(self.MAPPINGS, 'sdh'))
+
+    def test_nvme_device(self):
+        self.assertIsNone(volume_id_from_block_device_mappings(self.MAPPINGS, 'nvme1n1'))
+
+
+class LinuxInventoryTest(unittest.TestCase):
+
+    def test_nvme_partition_inherits_disk_serial(self):
+        output = lsblk({
+            'name': 'nvme0n1', 'pkname': None, 'type': 'disk', 'fstype': None, 'mountpoint': None, 'serial': 'vol0123456789abcdef0',
+            'children': [
+                {'name': 'nvme0n1p1', 'pkname': 'nvme0n1', 'type': 'part', 'fstype': 'xfs', 'mountpoint': '/', 'serial': None},
+                {'name': 'nvme0n1p128', 'pkname': 'nvme0n1', 'type': 'part', 'fstype': None, 'mountpoint': None, 'serial': None}
+            ]
+        })
+        disks = parse_inventory('linux', output)
+        self.assertEqual(len(disks), 1)
+        self.assertEqual(disks[0].device, 'nvme0n1p1')
+        self.assertEqual(disks[0].disk, 'nvme0n1')
+        self.assertEqual(disks[0].partition, '1')
+        self.assertEqual(disks[0].volume_id, 'vol-0123456789abcdef0')
+
+    def test_whole_disk_file_system(self):
+        output = lsblk({'name': 'nvme1n1', 'type': 'disk', 'fstype': 'ext4', 'mountpoint': '/data', 'serial': 'vol-0aaaaaaaaaaaaaaaa'})
+        disk, = parse_inventory('linux', output)
+        self.assertEqual((disk.device, disk.disk, disk.partition), ('nvme1n1', 'nvme1n1', ''))
+        self.assertEqual(disk.volume_id, 'vol-0aaaaaaaaaaaaaaaa')
+
+    def test_xen_devices_have_no_volume_id(self):
+        output = lsblk(
+            {'name': 'xvda', 'type': 'disk', 'fstype': None, 'mountpoint': None, 'serial': None, 'children': [
+                {'name': 'xvda1', 'pkname': 'xvda', 'type': 'part', 'fstype': 'xfs', 'mountpoint': '/', 'serial': None}
+            ]},
+            {'name': 'sdf', 'type': 'disk', 'fstype': 'ext4', 'mountpoint': '/data', 'serial': ''}
+        )
+        disks = parse_inventory('linux', output)
+        self.assertEqual([(disk.device, disk.disk, disk.partition) for disk in disks], [('xvda1', 'xvda', '1'), ('sdf', 'sdf', '')])
+        self.assertEqual([disk.volume_id for disk in disks], [None, None])
+
+    def test_unsupported_and_unmounted_file_systems(self):
+        output = lsblk(
+            {'name': 'nvme1n1', 'type': 'disk', 'fstype': 'vfat', 'mountpoint': '/boot/efi', 'serial': 'vol0123456789abcdef0'},
+            {'name': 'nvme2n1', 'type': 'disk', 'fstype': 'xfs', 'mountpoint': None, 'serial': 'vol0123456789abcdef1'}
+        )
+        self.assertEqual(parse_inventory('linux', output), [])
+
+    def test_empty_output(self):
+        self.assertEqual(parse_inventory('linux', lsblk()), [])
+        with self.assertRaises(ValueError):
+            parse_inventory('linux', '')
+
+
+class WindowsInventoryTest(unittest.TestCase):
+
+    def test_single_partition_object(self):
+        output = json.dumps({'DriveLetter': 'c', 'DiskNumber': 0, 'PartitionNumber': 2, 'SerialNumber': 'vol0123456789abcdef0_00000001.', 'FileSystem': 'NTFS'})
+        disk, = parse_inventory('windows', output)
+        self.assertEqual((disk.drive, disk.mountpoint, disk.partition, disk.disk_number), ('C', 'C:', '2', 0))
+        self.assertEqual(disk.volume_id, 'vol-0123456789abcdef0')
+
+    def test_partitions_without_drive_letter(self):
+        output = json.dumps([
+            {'DriveLetter': '', 'DiskNumber': 0, 'PartitionNumber': 1, 'SerialNumber': 'vol0123456789abcdef0_00000001.', 'FileSystem': 'NTFS'},
+            {'DriveLetter': None, 'DiskNumber': 0, 'PartitionNumber': 3, 'SerialNumber': 'vol0123456789abcdef0_00000001.', 'FileSystem': ''},
+            {'DriveLetter': '\u0000', 'DiskNumber': 1, 'PartitionNumber': 1, 'SerialNumber': 'vol0123456789abcdef1_00000001.', 'FileSystem': 'NTFS'},
+            {'DriveLetter': 'D', 'DiskNumber': 1, 'PartitionNumber': 2, 'SerialNumber': 'vol0123456789abcdef1_00000001.', 'FileSystem': 'NTFS'}
+        ])
+        disks = parse_inventory('windows', output)
+        self.assertEqual([disk.drive for disk in disks], ['D'])
+        self.assertEqual(disks[0].volume_id, 'vol-0123456789abcdef1')
+
+    def test_serial_that_is_not_a_volume(self):
+        output = json.dumps([{'DriveLetter': 'E', 'DiskNumber': 2, 'PartitionNumber': 1, 'SerialNumber': 'AWS2D5F4A8B2C1E3F7A', 'FileSystem': 'NTFS'}])
+        disk, = parse_inventory('windows', output)
+        self.assertIsNone(disk.volume_id)
+
+    def test_empty_output(self):
+        self.assertEqual(parse_inventory('windows', '[]'), [])
+        with self.assertRaises(ValueError):
+            parse_inventory('windows', '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import os
+import sys
+import unittest
+
+import boto3
+import botocore
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambda'))
+from instrumentation import instrument, start_invocation
+
+
+class ConnectionErrorTest(unittest.TestCase):
+
+    def test_failed_call_is_counted(self):
+        # Nothing listens on port 9 of the loopback interface, the connection is refused right away.
+        client = boto3.client(
+            'ec2', region_name='us-east-1', endpoint_url='http://127.0.0.1:9',
+            aws_access_key_id='test', aws_secret_access_key='test',
+            config=Config(connect_timeout=1, retries={'max_attempts': 0})
+        )
+        instrument(client)
+        record = start_invocation('test')
+        with self.assertRaises(botocore.exceptions.EndpointConnectionError):
+            client.describe_volumes()
+        self.assertEqual(record.metrics['ApiCalls'][0], 1)
+        self.assertEqual(record.metrics['ApiErrors'][0], 1)
+        self.assertEqual(record.properties['Operations'], {'ec2:DescribeVolumes': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
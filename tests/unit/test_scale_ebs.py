@@ -0,0 +1,123 @@
+import json
+import os
+import sys
+import time
+import unittest
+
+import boto3
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+import aws_clients
+import ssm_command
+from fake_aws import VirtualClock, FakeContext, FakeAWS
+from run_benchmark import load_function
+
+
+def nvme_disk(volume_id, n, size=100):
+    return {'VolumeId': volume_id, 'Size': size, 'VolumeType': 'gp3', 'Iops': 3000, 'Throughput': 125, 'Tags': {},
+            'disk': 'nvme%dn1' % n, 'partition': '', 'fstype': 'xfs', 'mountpoint': '/data%d' % n, 'device_name': '/dev/sd' + 'fghij'[n]}
+
+
+def alarm(instance_id, volume_id, device, path, clock):
+    # The notification of a utilisation alarm as onboarding creates it.
+    return {
+        'AlarmName': 'ebs-utilisation-exceeded-alarm:' + instance_id + ':' + device,
+        'AlarmDescription': json.dumps({'VolumeId': volume_id}),
+        'NewStateValue': 'ALARM',
+        'StateChangeTime': clock.now().isoformat(),
+        'Trigger': {
+            'Namespace': 'CWAgent',
+            'MetricName': 'disk_used_percent',
+            'Dimensions': [
+                {'name': 'path', 'value': path},
+                {'name': 'InstanceId', 'value': instance_id},
+                {'name': 'device', 'value': device},
+                {'name': 'fstype', 'value': 'xfs'}
+            ]
+        }
+    }
+
+
+class ScaleJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(1000)
+        self.instance = {'InstanceId': 'i-00000000000000001', 'Platform': None, 'Online': True, 'Tags': {},
+                         'Disks': [nvme_disk('vol-00000000000000001', 1), nvme_disk('vol-00000000000000002', 2)]}
+        self.aws = FakeAWS([self.instance], self.clock, api_latency=0, command_latency=1, modify_latency=2)
+        self.client = boto3.client
+        boto3.client = self.aws.client
+        aws_clients.clear()
+        for name in ('RESUME_QUEUE_URL', 'STATE_TABLE', 'STATE_FILE', 'SIZING_MODE'):
+            os.environ.pop(name, None)
+        self.scale = load_function('scale-ebs.py', self.clock, {
+            'ENABLE_SNS': 'no',
+            'SNS_NOTIFICATION_TOPIC_ARN': '',
+            'DESIRED_UTILISATION': '60',
+            'THRESHOLD_UTILISATION': '80'
+        })
+
+    def tearDown(self):
+        boto3.client = self.client
+        aws_clients.clear()
+        ssm_command.time = time
+
+    def calls(self, operation):
+        service, name = operation.split(':')
+        return self.aws.api_calls().get(service, {}).get(name, 0)
+
+    def start_job(self, message):
+        return self.scale.start_job([(self.scale.alarm_identity(message), message)])
+
+    def handle(self, *bodies):
+        # One batch of the intake queue, the message ids are m0, m1, ...
+        records = [{'eventSource': 'aws:sqs', 'messageId': 'm%d' % i, 'body': body if isinstance(body, str) else json.dumps({'Message': json.dumps(body)})}
+                   for i, body in enumerate(bodies)]
+        response = self.scale.lambda_handler({'Records': records}, FakeContext(self.clock, 300))
+        return sorted(failure['itemIdentifier'] for failure in response['batchItemFailures'])
+
+    def test_batch_is_grouped_by_volume_and_instance(self):
+        # Two partitions of one volume and a second volume of the same instance alarm in one batch.
+        instance_id = self.instance['InstanceId']
+        self.assertEqual(self.handle(
+            alarm(instance_id, 'vol-00000000000000001', 'nvme1n1p1', '/data1', self.clock),
+            alarm(instance_id, 'vol-00000000000000001', 'nvme1n1p2', '/data3', self.clock),
+            alarm(instance_id, 'vol-00000000000000002', 'nvme2n1', '/data2', self.clock)
+        ), [])
+        self.assertEqual(self.calls('ec2:DescribeVolumes'), 1)
+        self.assertEqual(self.calls('ec2:ModifyVolume'), 2)
+        self.assertEqual(self.calls('ssm:SendCommand'), 1)
+        self.assertEqual(sorted(self.aws.modifications), ['vol-00000000000000001', 'vol-00000000000000002'])
+
+    def test_jobs_created_together_modify_a_volume_once(self):
+        # Two partitions of one volume alarm in separate invocations, both jobs exist before either runs.
+        first = self.start_job(alarm(self.instance['InstanceId'], 'vol-00000000000000001', 'nvme1n1p1', '/data1', self.clock))
+        second = self.start_job(alarm(self.instance['InstanceId'], 'vol-00000000000000001', 'nvme1n1p2', '/data2', self.clock))
+        self.scale.run_job(first, FakeContext(self.clock, 300))
+        self.scale.run_job(second, FakeContext(self.clock, 300))
+
+        self.assertEqual(self.calls('ec2:ModifyVolume'), 1)
+        self.assertTrue(first['Volumes']['vol-00000000000000001']['Extended'])
+        self.assertTrue(second['Disks'][0].get('Skipped'))
+        self.assertEqual(second['Volumes'], {})
+        self.assertIsNone(self.scale.store.get(self.scale.volume_lock_key('vol-00000000000000001')))
+
+    def test_failures_are_reported_per_message(self):
+        instance_id = self.instance['InstanceId']
+        lost = alarm(instance_id, 'vol-0000000000000000f', 'nvme9n1', '/data9', self.clock)
+        scaled = alarm(instance_id, 'vol-00000000000000002', 'nvme2n1', '/data2', self.clock)
+        self.assertEqual(self.handle('{not json', lost, scaled), ['m0', 'm1'])
+        self.assertEqual(self.calls('ec2:ModifyVolume'), 1)
+
+        # The disk of the lost alarm failed before any modification, its retry is scaled again. The scaled
+        # alarm delivered again finds its job done.
+        self.assertEqual(self.handle(lost), ['m0'])
+        self.assertEqual(self.handle(scaled), [])
+        self.assertEqual(self.calls('ec2:ModifyVolume'), 1)
+        self.assertEqual(self.calls('ssm:SendCommand'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lambda'))
+from sizing import ratio_target_size, growth_rate, growth_target_size, performance_target, performance_boost
+
+
+def hourly(hours, start_percent, percent_per_hour):
+    # Synthetic usage, one sample per hour growing linearly.
+    timestamps = [1600000000 + h*3600 for h in range(hours + 1)]
+    used_percent = [start_percent + percent_per_hour*h for h in range(hours + 1)]
+    return timestamps, used_percent
+
+
+class RatioTargetSizeTest(unittest.TestCase):
+
+    def test_rounds_up(self):
+        self.assertEqual(ratio_target_size(100, 80, 60), 134)
+        # 8 GB at 80/75 is 8.53 GB, rounding down would not grow the volume at all.
+        self.assertEqual(ratio_target_size(8, 80, 75), 9)
+
+    def test_accepts_strings(self):
+        # Thresholds come from the environment of the function.
+        self.assertEqual(ratio_target_size(100, '80', '60'), 134)
+
+
+class GrowthRateTest(unittest.TestCase):
+
+    def test_linear_growth(self):
+        timestamps, used_percent = hourly(24, 50, 1)
+        self.assertAlmostEqual(growth_rate(timestamps, used_percent, 100), 1.0)
+        self.assertAlmostEqual(growth_rate(timestamps, used_percent, 200), 2.0)
+
+    def test_unsorted_samples(self):
+        timestamps, used_percent = hourly(24, 50, 1)
+        self.assertAlmostEqual(growth_rate(timestamps[::-1], used_percent[::-1], 100), 1.0)
+
+    def test_only_samples_after_last_drop(self):
+        timestamps, used_percent = hourly(10, 50, 1)
+        after, after_percent = hourly(10, 30, 2)
+        timestamps += [t + 11*3600 for t in after]
+        self.assertAlmostEqual(growth_rate(timestamps, used_percent + after_percent, 100), 2.0)
+
+    def test_not_enough_samples(self):
+        self.assertEqual(growth_rate([], [], 100), 0.0)
+        self.assertEqual(growth_rate([1600000000], [80], 100), 0.0)
+        self.assertEqual(growth_rate([1600000000, 1600000000], [70, 80], 100), 0.0)
+
+
+class GrowthTargetSizeTest(unittest.TestCase):
+
+    def test_flat_usage_is_ratio_size(self):
+        timestamps, used_percent = hourly(24, 81, 0)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60), ratio_target_size(100, 80, 60))
+
+    def test_no_history_is_ratio_size(self):
+        self.assertEqual(growth_target_size(100, [], [], 80, 60), 134)
+
+    def test_lasts_cooldown_and_horizon(self):
+        # 80 GB used growing 1 GB per hour, 110 GB after 6 + 24 hours must stay below 80%.
+        timestamps, used_percent = hourly(10, 70, 1)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60), 138)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60, horizon_hours=0), 134)
+
+    def test_shrinking_usage_is_ratio_size(self):
+        timestamps, used_percent = hourly(10, 84, -0.4)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60), 134)
+
+    def test_limits(self):
+        timestamps, used_percent = hourly(10, 70, 1)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60, max_size=120), 120)
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60, min_size=500), 500)
+        # Never smaller than the volume.
+        self.assertEqual(growth_target_size(100, timestamps, used_percent, 80, 60, max_size=50), 100)
+
+
+class PerformanceTargetTest(unittest.TestCase):
+
+    def test_baseline_gp3_keeps_performance(self):
+        volume = {'VolumeType': 'gp3', 'Size': 100, 'Iops': 3000, 'Throughput': 125}
+        self.assertEqual(performance_target(volume, 200), {'Size': 200})
+
+    def test_provisioned_performance_keeps_ratio(self):
+        volume = {'VolumeType': 'gp3', 'Size': 100, 'Iops': 6000, 'Throughput': 250}
+        self.assertEqual(performance_target(volume, 200), {'Size': 200, 'Iops': 12000, 'Throughput': 500})
+        volume = {'VolumeType': 'io1', 'Size': 100, 'Iops': 5000}
+        self.assertEqual(performance_target(volume, 200), {'Size': 200, 'Iops': 10000})
+
+    def test_limits_of_volume_type(self):
+        volume = {'VolumeType': 'gp3', 'Size': 1000, 'Iops': 12000, 'Throughput': 800}
+        self.assertEqual(performance_target(volume, 2000), {'Size': 2000, 'Iops': 16000, 'Throughput': 1000})
+
+    def test_ratio_per_gb(self):
+        volume = {'VolumeType': 'gp3', 'Size': 500, 'Iops': 3000, 'Throughput': 125}
+        self.assertEqual(performance_target(volume, 1000, iops_per_gb=10, throughput_per_gb=0.5), {'Size': 1000, 'Iops': 10000, 'Throughput': 500})
+
+    def test_gp2_conversion(self):
+        volume = {'VolumeType': 'gp2', 'Size': 100, 'Iops': 300}
+        self.assertEqual(performance_target(volume, 200), {'Size': 200})
+        self.assertEqual(performance_target(volume, 200, convert_gp2=True), {'Size': 200, 'VolumeType': 'gp3', 'Iops': 3000, 'Throughput': 250})
+
+    def test_no_provisioned_performance(self):
+        self.assertEqual(performance_target({'VolumeType': 'st1', 'Size': 500}, 1000), {'Size': 1000})
+
+
+class PerformanceBoostTest(unittest.TestCase):
+
+    def test_boost(self):
+        volume = {'VolumeType': 'gp3', 'Size': 100, 'Iops': 3000, 'Throughput': 125}
+        self.assertEqual(performance_boost(volume, 1.5), {'Iops': 4500, 'Throughput': 188})
+
+    def test_caps(self):
+        volume = {'VolumeType': 'gp3', 'Size': 100, 'Iops': 4000, 'Throughput': 200}
+        self.assertEqual(performance_boost(volume, 1.5, max_iops=5000, max_throughput=250), {'Iops': 5000, 'Throughput': 250})
+        # Repeated boosts stop at the cap.
+        self.assertIsNone(performance_boost({'VolumeType': 'gp3', 'Size': 100, 'Iops': 5000, 'Throughput': 250}, 1.5, max_iops=5000, max_throughput=250))
+
+    def test_at_limits(self):
+        self.assertIsNone(performance_boost({'VolumeType': 'gp3', 'Size': 1000, 'Iops': 16000, 'Throughput': 1000}))
+        self.assertIsNone(performance_boost({'VolumeType': 'st1', 'Size': 500}))
+
+
+if __name__ == '__main__':
+    unittest.main()